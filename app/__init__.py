@@ -10,6 +10,9 @@ except ImportError:
         def enable_tx(self):
             pass
 
+        def disable_tx(self):
+            pass
+
         def cleanup(self):
             pass
 
@@ -27,13 +30,27 @@ except ImportError:
         BCM = 1
         HIGH = 1
         LOW = 0
+        BOTH = 33
+        PUD_DOWN = 21
 
         @staticmethod
         def setmode(a):
             pass
 
         @staticmethod
-        def setup(a, b):
+        def setup(a, b, **kwargs):
+            pass
+
+        @staticmethod
+        def input(a):
+            return 0
+
+        @staticmethod
+        def add_event_detect(a, b, callback=None, **kwargs):
+            pass
+
+        @staticmethod
+        def remove_event_detect(a):
             pass
 
         @staticmethod
@@ -41,7 +58,7 @@ except ImportError:
             pass
 
         @staticmethod
-        def cleanup():
+        def cleanup(channel=None):
             pass
 
         @staticmethod
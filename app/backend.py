@@ -0,0 +1,242 @@
+"""
+Transmit backends turn a list of pulses `(pin, level, duration)` (duration
+in microseconds) into a signal on a GPIO pin.
+"""
+
+import atexit
+import os
+import threading
+import time
+from abc import abstractmethod
+
+import attr
+
+from . import GPIO, transmitter
+from .realtime import burst
+from .util import LogMixin
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+
+class BackendUnavailableError(Exception):
+    """Raised when a transmit backend cannot be used on this machine."""
+    pass
+
+
+_connections = dict()
+_connections_lock = threading.Lock()
+# The waves of the daemon are shared by all connections
+_wave_lock = threading.Lock()
+
+
+def pigpio_connection(host):
+    """
+    The connection of the process to the pigpio daemon on `host`, opened
+    on first use and closed on exit.
+    Raises:
+        `BackendUnavailableError` if pigpio is missing or the daemon
+        cannot be reached.
+    """
+    if pigpio is None:
+        raise BackendUnavailableError("Python module pigpio is missing")
+    with _connections_lock:
+        pi = _connections.get(host)
+        if pi is None:
+            pi = pigpio.pi(host)
+            if not pi.connected:
+                raise BackendUnavailableError(
+                    "Cannot connect to pigpiod on '{}'".format(host)
+                )
+            if not _connections:
+                atexit.register(close_pigpio_connections)
+            _connections[host] = pi
+        return pi
+
+
+def close_pigpio_connections():
+    with _connections_lock:
+        for pi in _connections.values():
+            pi.stop()
+        _connections.clear()
+
+
+@attr.s
+class TransmitBackend(LogMixin):
+    """
+    Abstract base class for transmit backends.
+    """
+
+    @abstractmethod
+    def setup(self, pin):
+        """
+        Prepares the given pin for transmitting.
+        Concrete class must implement details
+        """
+        pass
+
+    @abstractmethod
+    def transmit(self, pulses):
+        """
+        Sends the pulses.
+        Args:
+            pulses: list of (pin, level, duration in microseconds) tuples
+        Returns:
+            Returns True if the pulses were sent; otherwise False.
+        """
+        pass
+
+    def cleanup(self):
+        """Releases the resources of the backend."""
+        pass
+
+
+@attr.s
+class GPIOBackend(TransmitBackend):
+    """
+    Bit-bangs the pulses from Python via `GPIO.output` and `time.sleep`.
+    Timing depends on the interpreter and the scheduler.
+    The GPIO module and the sleep function can be replaced, e.g. by the ones
+    of an `app.simulator.Simulator`.
+    """
+    GPIOMode = GPIO.BCM
+
+    gpio = attr.ib(default=GPIO, repr=False)
+    sleep = attr.ib(default=time.sleep, repr=False)
+    pins = attr.ib(default=attr.Factory(set), init=False, repr=False)
+
+    def setup(self, pin):
+        self.gpio.setmode(GPIOBackend.GPIOMode)
+        self.gpio.setup(pin, self.gpio.OUT)
+        self.pins.add(pin)
+
+    def transmit(self, pulses):
+        airtime = sum(duration for _, _, duration in pulses) / 1000000.
+        with burst(airtime):
+            for pin, level, duration in pulses:
+                self.gpio.output(pin, level)
+                if duration:
+                    self.sleep(duration / 1000000.)
+        return True
+
+    def cleanup(self):
+        # Only the own pins, others (e.g. of a receiver) stay set up
+        for pin in self.pins:
+            self.gpio.cleanup(pin)
+        self.pins.clear()
+
+
+@attr.s
+class PigpioBackend(TransmitBackend):
+    """
+    Hands the whole pulse list to the pigpio daemon as a DMA timed wave,
+    so the CPU is not needed for every single pulse. All instances share
+    the connection of the process to the daemon (see `pigpio_connection`),
+    as a backend is created per command.
+    """
+    host = attr.ib(default=os.environ.get('PIGPIO_ADDR', 'localhost'))
+    pi = attr.ib(default=None, repr=False)
+
+    def setup(self, pin):
+        if self.pi is None:
+            self.pi = pigpio_connection(self.host)
+        self.pi.set_mode(pin, pigpio.OUTPUT)
+
+    def transmit(self, pulses):
+        with _wave_lock:
+            return self._transmit(pulses)
+
+    def _transmit(self, pulses):
+        self.pi.wave_clear()
+        self.pi.wave_add_generic([
+            pigpio.pulse(1 << pin, 0, int(duration)) if level
+            else pigpio.pulse(0, 1 << pin, int(duration))
+            for pin, level, duration in pulses
+        ])
+        wave = self.pi.wave_create()
+        if wave < 0:
+            self.logger.error("Could not create wave: {}".format(wave))
+            return False
+        try:
+            self.pi.wave_send_once(wave)
+            while self.pi.wave_tx_busy():
+                time.sleep(0.001)
+        finally:
+            self.pi.wave_delete(wave)
+        return True
+
+    def cleanup(self):
+        # The shared connection is closed on exit
+        self.pi = None
+
+
+@attr.s
+class ProcessBackend(TransmitBackend):
+    """
+    Hands the pulses to a child process which transmits them with the
+    backend named by `RC433_PROCESS_BACKEND`, see `app.transmitter`. All
+    instances share the child process of the consumer.
+    """
+    transmitter = attr.ib(default=None, repr=False)
+
+    def setup(self, pin):
+        # The child sets up the pins on their first use
+        if self.transmitter is None:
+            self.transmitter = transmitter.shared()
+
+    def transmit(self, pulses):
+        return self.transmitter.transmit(pulses)
+
+
+@attr.s
+class RecordingBackend(TransmitBackend):
+    """
+    Records the pulses instead of sending them. Meant for tests.
+    Example:
+        >>> backend = RecordingBackend()
+        >>> backend.transmit([(17, 1, 300), (17, 0, 900)])
+        True
+        >>> backend.airtime
+        1200
+    """
+    pins = attr.ib(default=attr.Factory(list), init=False)
+    transmissions = attr.ib(default=attr.Factory(list), init=False)
+
+    def setup(self, pin):
+        self.pins.append(pin)
+
+    def transmit(self, pulses):
+        self.transmissions.append(list(pulses))
+        return True
+
+    @property
+    def airtime(self):
+        """Overall duration of the recorded pulses in microseconds"""
+        return sum(
+            duration for pulses in self.transmissions
+            for _, _, duration in pulses
+        )
+
+
+BACKENDS = {
+    'gpio': GPIOBackend,
+    'pigpio': PigpioBackend,
+    'process': ProcessBackend,
+    'recording': RecordingBackend
+}
+
+
+def backend_from_env():
+    """
+    Creates the transmit backend named by the environment variable
+    `RC433_BACKEND` (default `gpio`).
+    """
+    name = os.environ.get('RC433_BACKEND', 'gpio')
+    if name not in BACKENDS:
+        raise BackendUnavailableError(
+            "Unknown transmit backend '{}', choose one of {}".format(
+                name, sorted(BACKENDS))
+        )
+    return BACKENDS[name]()
@@ -1,13 +1,19 @@
 import json
 import os
+import random
+import socket
+import threading
+import time
 from abc import abstractmethod
+from collections import OrderedDict, deque
 from typing import Any, Callable
 
 import attr
 import paho.mqtt.client as mqtt
 from schema import And, Optional, Schema, SchemaMissingKeyError, Use
 
-from .util import LogMixin
+from .spool import OutboundSpool
+from .util import LogMixin, percentile
 
 
 class InvalidClientConfigException(Exception):
@@ -85,7 +91,23 @@ class MQTTClient(GenericClient):
             'port': And(Use(int), lambda n: 0 <= n <= 65535),
             Optional('username'): str,
             Optional('password'): str,
-            'topics': dict
+            'topics': dict,
+            Optional('publisher'): {
+                Optional('max_inflight'): And(Use(int), lambda n: n > 0),
+                Optional('max_queue'): And(Use(int), lambda n: n > 0),
+                Optional('spool'): str,
+                Optional('fsync_batch'): And(Use(int), lambda n: n > 0),
+                Optional('fsync_interval'): And(Use(float), lambda n: n >= 0)
+            },
+            Optional('snapshot'): dict,
+            Optional('scheduler'): dict,
+            Optional('deadlines'): dict,
+            Optional('session'): {
+                Optional('client_id'): str,
+                Optional('persistent'): bool,
+                Optional('reconnect_min'): And(Use(float), lambda n: n > 0),
+                Optional('reconnect_max'): And(Use(float), lambda n: n > 0)
+            }
         })
 
     def validate_config(self) -> bool:
@@ -119,19 +141,21 @@ class MQTTClient(GenericClient):
         `MQTTConsumer.consume(on_message)` function
         """
         self.logger.info(
-            "Default callback: Received message '{}' on topic '{}'".format(
-                message.payload.decode('utf-8'),
-                message.topic
-            )
+            "Default callback: Received message '%s' on topic '%s'",
+            message.payload.decode('utf-8'),
+            message.topic
         )
 
+    def _create_client(self) -> mqtt.Client:
+        return mqtt.Client()
+
     def connect(self,
                 on_connect: Callable = None,
                 on_message: Callable = None,
                 *args) -> Any:
         """
         """
-        self.client = mqtt.Client()
+        self.client = self._create_client()
         self.client.on_connect = on_connect or self._on_connect
         self.client.on_message = on_message or self._on_message
         username = os.environ.get(
@@ -174,6 +198,277 @@ class MQTTPublisher(MQTTClient, GenericPublisher):
         self.client.publish(topic, payload, qos, retain)
 
 
+@attr.s
+class QueuedMQTTPublisher(MQTTPublisher):
+    """
+    Publisher which never blocks the caller. Messages are queued and handed
+    to the broker by a background thread, with at most `max_inflight`
+    messages waiting for their acknowledgement. Messages for a topic which
+    is still queued replace the queued one, so only the latest state of a
+    device is sent. The queue is bounded by `max_queue`, the oldest topic
+    is dropped when it overflows.
+    With a `spool` file messages are appended to an `OutboundSpool` while
+    the broker is unavailable, and replayed (the latest per topic) in one
+    burst once the connection is back. The replayed messages stay on disk
+    until all of them were handed to the client.
+    These settings are taken from the `publisher` section of the config.
+    """
+
+    MAX_INFLIGHT = 20
+    MAX_QUEUE = 1000
+
+    pending = attr.ib(default=attr.Factory(OrderedDict), init=False,
+                      repr=False)
+    inflight = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    latencies = attr.ib(default=attr.Factory(lambda: deque(maxlen=1000)),
+                        init=False, repr=False)
+    counters = attr.ib(
+        default=attr.Factory(lambda: dict(
+            published=0, acked=0, collapsed=0, dropped=0, failed=0,
+            spooled=0, replayed=0
+        )),
+        init=False, repr=False
+    )
+    spool = attr.ib(default=None, init=False, repr=False)
+    connected = attr.ib(default=False, init=False, repr=False)
+    _acked_early = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    # Topics of the replay which were not handed to the client yet
+    _replaying = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), init=False,
+                    repr=False)
+    _worker = attr.ib(default=None, init=False, repr=False)
+    _running = attr.ib(default=False, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        conf = self.client_conf.get('publisher', {})
+        if conf.get('spool'):
+            self.spool = OutboundSpool(
+                conf['spool'],
+                fsync_batch=conf.get('fsync_batch', 64),
+                fsync_interval=conf.get('fsync_interval', 1.)
+            )
+
+    @property
+    def max_inflight(self) -> int:
+        return int(self.client_conf.get('publisher', {}).get(
+            'max_inflight', QueuedMQTTPublisher.MAX_INFLIGHT))
+
+    @property
+    def max_queue(self) -> int:
+        return int(self.client_conf.get('publisher', {}).get(
+            'max_queue', QueuedMQTTPublisher.MAX_QUEUE))
+
+    @property
+    def backlog(self) -> int:
+        """Number of messages queued or waiting for an acknowledgement"""
+        with self._cond:
+            return len(self.pending) + len(self.inflight)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the publisher counters.
+        Returns:
+            Returns a dict with the counters, the current backlog and the
+            p50/p95/max publish latency in seconds.
+        """
+        with self._cond:
+            latencies = list(self.latencies)
+            res = dict(self.counters)
+            res.update(queued=len(self.pending), inflight=len(self.inflight))
+        res['backlog'] = res['queued'] + res['inflight']
+        res['latency_p50'] = percentile(latencies, 50)
+        res['latency_p95'] = percentile(latencies, 95)
+        res['latency_max'] = max(latencies) if latencies else None
+        return res
+
+    def start(self) -> None:
+        """
+        Connects to the broker (if not done yet) and starts the network
+        loop and the publishing thread.
+        """
+        if self._running:
+            return
+        if self.client is None:
+            try:
+                self.connect()
+            except OSError as why:
+                # The network loop keeps trying to connect
+                self.logger.warning("Broker not available: %s", why)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.loop_start()
+        self._running = True
+        self._worker = threading.Thread(
+            target=self._run, name=self.__class__.__name__, daemon=True
+        )
+        self._worker.start()
+
+    def stop(self, timeout: float = 5.) -> None:
+        """
+        Stops the publishing thread after the queue has been handed to the
+        broker (or `timeout` seconds passed) and disconnects.
+        """
+        if not self._running:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._worker.join(timeout)
+        self.client.loop_stop()
+        if self.spool is not None:
+            self.spool.close()
+        self.cleanup()
+
+    def publish(self, topic, payload=None, qos=0, retain=False) -> None:
+        now = time.monotonic()
+        with self._cond:
+            if topic in self.pending:
+                self.counters['collapsed'] += 1
+            elif len(self.pending) >= self.max_queue:
+                dropped, _ = self.pending.popitem(last=False)
+                self._replayed(dropped)
+                self.counters['dropped'] += 1
+                self.logger.warning(
+                    "Publish queue full, dropped message for '{}'".
+                    format(dropped)
+                )
+            self.pending[topic] = (payload, qos, retain, now)
+            self._cond.notify()
+
+    def _on_connect(self, client, userdata, flags, rc, *args) -> None:
+        if rc != 0:
+            return
+        now = time.monotonic()
+        with self._cond:
+            # Messages are spooled under the same lock, so none can slip in
+            # between the drain and the connected flag
+            records = self.spool.drain() if self.spool is not None else []
+            self.connected = True
+            # Replayed states are older than the queued ones
+            for topic, payload, qos, retain in reversed(records):
+                if topic not in self.pending:
+                    self.pending[topic] = (payload, qos, retain, now)
+                    self.pending.move_to_end(topic, last=False)
+                    self._replaying.add(topic)
+                    self.counters['replayed'] += 1
+            if records and not self._replaying:
+                self.spool.replayed()
+            self._cond.notify()
+        if records:
+            self.logger.info("Replaying %d spooled messages", len(records))
+
+    def _on_disconnect(self, client, userdata, rc, *args) -> None:
+        with self._cond:
+            self.connected = False
+            if self.spool is None:
+                return
+            # Unacknowledged messages may be lost with the connection
+            for topic, payload, qos, retain, _ in self.inflight.values():
+                self.spool.append(topic, payload, qos, retain)
+                self.counters['spooled'] += 1
+            self.inflight.clear()
+            self._cond.notify()
+
+    def _on_publish(self, client, userdata, mid, *args) -> None:
+        now = time.monotonic()
+        with self._cond:
+            message = self.inflight.pop(mid, None)
+            if message is None:
+                # paho may acknowledge before `publish` returned the mid
+                self._acked_early.add(mid)
+                return
+            self.latencies.append(now - message[-1])
+            self.counters['acked'] += 1
+            self._cond.notify()
+
+    def _ready(self) -> bool:
+        return bool(self.pending) and len(self.inflight) < self.max_inflight
+
+    def _next(self):
+        with self._cond:
+            while self._running and not self._ready():
+                timeout = None
+                if self.spool is not None:
+                    # A batch is fsync'ed in time without further messages
+                    timeout = self.spool.sync_due()
+                    if timeout is not None and timeout <= 0:
+                        self._flush_spool()
+                        continue
+                self._cond.wait(timeout)
+            if not self.pending:
+                return None
+            return self.pending.popitem(last=False)
+
+    def _run(self) -> None:
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            topic, (payload, qos, retain, enqueued) = item
+            with self._cond:
+                if self.spool is not None and not self.connected:
+                    self._spool(topic, payload, qos, retain)
+                    continue
+            try:
+                info = self.client.publish(topic, payload, qos, retain)
+            except Exception as why:
+                info = None
+                self.logger.error(
+                    "Publishing to '{}' failed: {}".format(topic, why)
+                )
+            with self._cond:
+                if info is None or info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    if self.spool is not None and self.connected and \
+                            info is not None and \
+                            info.rc == mqtt.MQTT_ERR_NO_CONN:
+                        # The connection is back already, try again
+                        if topic not in self.pending:
+                            self.pending[topic] = (
+                                payload, qos, retain, enqueued
+                            )
+                            self.pending.move_to_end(topic, last=False)
+                        continue
+                    self.counters['failed'] += 1
+                    if self.spool is not None:
+                        self._spool(topic, payload, qos, retain)
+                    continue
+                self._replayed(topic)
+                self.counters['published'] += 1
+                if info.mid in self._acked_early:
+                    self._acked_early.discard(info.mid)
+                    self.latencies.append(time.monotonic() - enqueued)
+                    self.counters['acked'] += 1
+                else:
+                    self.inflight[info.mid] = (
+                        topic, payload, qos, retain, enqueued
+                    )
+
+    def _spool(self, topic, payload, qos, retain) -> None:
+        # Called with `_cond` held
+        self._replayed(topic)
+        try:
+            self.spool.append(topic, payload, qos, retain)
+        except OSError as why:
+            self.logger.error("Could not spool message for '%s': %s",
+                              topic, why)
+            return
+        self.counters['spooled'] += 1
+
+    def _flush_spool(self) -> None:
+        try:
+            self.spool.flush()
+        except OSError as why:
+            self.logger.error("Could not sync the spool: %s", why)
+
+    def _replayed(self, topic) -> None:
+        # The replay file is removed once its last message left the queue
+        if topic in self._replaying:
+            self._replaying.discard(topic)
+            if not self._replaying:
+                self.spool.replayed()
+
+
 class GenericSubscriber:
 
     @abstractmethod
@@ -181,7 +476,83 @@ class GenericSubscriber:
         pass
 
 
+@attr.s
+class Backoff(object):
+    """
+    Exponential backoff with full jitter: the n-th delay is drawn uniformly
+    between `minimum` and min(`maximum`, `minimum` * 2^n) seconds, so many
+    clients do not reconnect in lockstep.
+    """
+    minimum = attr.ib(default=0.5, converter=float)
+    maximum = attr.ib(default=60., converter=float)
+    rng = attr.ib(default=attr.Factory(random.Random), repr=False)
+    attempts = attr.ib(default=0, init=False)
+
+    def next(self) -> float:
+        cap = min(self.maximum, self.minimum * 2 ** self.attempts)
+        self.attempts += 1
+        return self.rng.uniform(self.minimum, cap)
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+@attr.s
 class MQTTSubscriber(MQTTClient, GenericSubscriber):
+    """
+    Subscribes to the configured topics. By default the session is
+    persistent: the client id is stable (`client_id` of the `session`
+    config, `MQTT_CLIENT_ID` or derived from the host name) and the broker
+    keeps the subscriptions and queues QoS>=1 messages while the connection
+    is down. After a reconnect with the session still present nothing is
+    subscribed again. Reconnects are delayed by an exponential backoff with
+    jitter.
+    """
+
+    callbacks = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    backoff = attr.ib(default=None, init=False, repr=False)
+    counters = attr.ib(default=attr.Factory(lambda: dict(
+        connects=0, resumed=0, reconnect_attempts=0, subscribe_failures=0
+    )), init=False)
+    _subscribed = attr.ib(default=False, init=False, repr=False)
+    _stopping = attr.ib(default=False, init=False, repr=False)
+
+    @property
+    def session_conf(self) -> dict:
+        return self.client_conf.get('session', {})
+
+    @property
+    def persistent(self) -> bool:
+        return self.session_conf.get('persistent', True)
+
+    def client_id(self) -> str:
+        return os.environ.get(
+            'MQTT_CLIENT_ID',
+            self.session_conf.get(
+                'client_id', 'rc433mq-{}'.format(socket.gethostname())
+            )
+        )
+
+    def _create_client(self) -> mqtt.Client:
+        if not self.persistent:
+            return super()._create_client()
+        return mqtt.Client(client_id=self.client_id(), clean_session=False)
+
+    def add_callback(self, topic: str, callback: Callable, qos=0) -> None:
+        """
+        Handles the messages of an additional topic (filter), e.g. a control
+        topic, by a callback of its own instead of the consume callback.
+        """
+        self.callbacks[topic] = (callback, qos)
+
+    def _subscribe_callbacks(self) -> None:
+        for topic, (callback, qos) in self.callbacks.items():
+            self.client.message_callback_add(topic, callback)
+            res = self.client.subscribe(topic, qos)
+            if res[0] != mqtt.MQTT_ERR_SUCCESS:
+                raise SubscriptionException(
+                    "Could not connect on topic: {}".format(topic)
+                )
 
     def _on_connect(self, client, userdata, flags, rc) -> None:
         """
@@ -206,10 +577,37 @@ class MQTTSubscriber(MQTTClient, GenericSubscriber):
         self.logger.debug(
             "Connection returned result: {}".format(mqtt.connack_string(rc))
         )
+        if rc != 0:
+            return
+        self.counters['connects'] += 1
+        if self.backoff is not None:
+            self.backoff.reset()
+        if self._session_present(flags) and self._subscribed:
+            # The broker kept the subscriptions of the persistent session
+            self.counters['resumed'] += 1
+            self.logger.info("Session resumed, keeping subscriptions")
+            return
+        try:
+            self._subscribe()
+        except SubscriptionException as why:
+            # Retried with the next connection instead of killing the loop
+            self.counters['subscribe_failures'] += 1
+            self.logger.error("%s, reconnecting", why)
+            self.client.disconnect()
+
+    @staticmethod
+    def _session_present(flags) -> bool:
+        if isinstance(flags, dict):
+            return bool(flags.get('session present', 0))
+        return bool(getattr(flags, 'session_present', False))
+
+    def _subscribe(self) -> None:
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
+        self._subscribe_callbacks()
         res = self.client.subscribe(list(self.client_conf['topics'].items()))
         if res[0] == mqtt.MQTT_ERR_SUCCESS:
+            self._subscribed = True
             self.logger.debug(
                 "Succesfully connected on topics: {}".
                 format(list(self.client_conf['topics'].items()))
@@ -220,9 +618,58 @@ class MQTTSubscriber(MQTTClient, GenericSubscriber):
                 format(list(self.client_conf['topics'].items()))
             )
 
+    def _on_subscribe(self, client, userdata, mid, granted_qos,
+                      *args) -> None:
+        if any(qos == 0x80 for qos in granted_qos):
+            self.counters['subscribe_failures'] += 1
+            self.logger.error("Broker refused a subscription (mid %s)", mid)
+
+    def connect(self,
+                on_connect: Callable = None,
+                on_message: Callable = None,
+                *args) -> Any:
+        self._stopping = False
+        self.backoff = Backoff(
+            self.session_conf.get('reconnect_min', 0.5),
+            self.session_conf.get('reconnect_max', 60.)
+        )
+        try:
+            return super().connect(on_connect, on_message, *args)
+        finally:
+            if self.client is not None:
+                self.client.on_subscribe = self._on_subscribe
+
+    def loop_forever(self) -> None:
+        """
+        Runs the network loop, reconnecting with backoff until `cleanup`.
+        """
+        while not self._stopping:
+            rc = self.client.loop(timeout=1.0)
+            if rc == mqtt.MQTT_ERR_SUCCESS or self._stopping:
+                continue
+            delay = self.backoff.next()
+            self.logger.warning(
+                "Connection lost (%s), reconnecting in %.1fs",
+                mqtt.error_string(rc), delay
+            )
+            time.sleep(delay)
+            self.counters['reconnect_attempts'] += 1
+            try:
+                self.client.reconnect()
+            except OSError as why:
+                self.logger.warning("Reconnect failed: %s", why)
+
+    def cleanup(self) -> None:
+        self._stopping = True
+        super().cleanup()
+
     def consume(self, on_message_call: Callable, **kwargs) -> None:
         try:
-            self.connect(on_message=on_message_call)
-            self.client.loop_forever()
+            try:
+                self.connect(on_message=on_message_call)
+            except OSError as why:
+                # The broker is down, `loop_forever` keeps trying
+                self.logger.warning("Connecting failed: %s", why)
+            self.loop_forever()
         except KeyboardInterrupt:
             self.cleanup()
@@ -0,0 +1,345 @@
+"""
+Cluster mode for several gateways with their own transmitters.
+
+Every device is owned by exactly one node, either by a static assignment or
+by consistent hashing of the device name over the nodes which are alive.
+Nodes only subscribe to the switch topics of the devices they own and send
+heartbeats, so ownership moves to the remaining nodes when a node goes
+silent. With a `shared_group` the subscriptions are MQTT v5 shared
+subscriptions, so a command is still delivered once while two nodes
+briefly claim the same device during a failover.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+import attr
+import paho.mqtt.client as mqtt
+from schema import And, Optional, Schema, Use
+
+from .broker import MQTTSubscriber, SubscriptionException
+from .util import LogMixin
+
+HEARTBEAT_TOPIC = 'rc433/$cluster/{}'
+
+
+def device_of(topic):
+    """
+    Device name of a `rc433/<floor>/<device>/<command>` topic.
+    Example:
+        >>> device_of('rc433/groundfloor/gf_kitchen_window/switch')
+        'gf_kitchen_window'
+    """
+    parts = topic.split('/')
+    return parts[2] if len(parts) == 4 else topic
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+@attr.s
+class HashRing(object):
+    """
+    Consistent hash ring, a device only moves if its node leaves the ring.
+    Example:
+        >>> ring = HashRing(['node1', 'node2'])
+        >>> ring.owner('gf_kitchen_window') in ('node1', 'node2')
+        True
+    """
+    nodes = attr.ib(converter=sorted)
+    replicas = attr.ib(default=64, converter=int)
+    _keys = attr.ib(default=None, init=False, repr=False)
+    _owners = attr.ib(default=None, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        ring = sorted(
+            (_hash('{}#{}'.format(node, i)), node)
+            for node in self.nodes for i in range(self.replicas)
+        )
+        self._keys = [k for k, _ in ring]
+        self._owners = [n for _, n in ring]
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        idx = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._owners[idx]
+
+
+@attr.s
+class ClusterMembership(LogMixin):
+    """
+    Tracks which nodes are alive and which node owns a device.
+    Example:
+        >>> members = ClusterMembership('node1', ['node1', 'node2'],
+        ...                             assignments={'dev': 'node2'})
+        >>> members.owner('dev')
+        'node2'
+        >>> members.expire(now=members.last_seen['node2'] + 60)
+        True
+        >>> members.owner('dev')
+        'node1'
+    """
+    SCHEMA = Schema({
+        Optional('node'): str,
+        'nodes': And([str], len),
+        Optional('assignments'): {str: str},
+        Optional('heartbeat_interval'): And(Use(float), lambda n: n > 0),
+        Optional('timeout'): And(Use(float), lambda n: n > 0),
+        Optional('shared_group'): str
+    })
+
+    node = attr.ib(converter=str)
+    nodes = attr.ib(converter=list)
+    assignments = attr.ib(default=attr.Factory(dict))
+    heartbeat_interval = attr.ib(default=5., converter=float)
+    timeout = attr.ib(default=15., converter=float)
+    shared_group = attr.ib(default=None)
+    last_seen = attr.ib(default=None, init=False, repr=False)
+    ring = attr.ib(default=None, init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.RLock), init=False,
+                    repr=False)
+
+    def __attrs_post_init__(self):
+        if self.node not in self.nodes:
+            self.nodes.append(self.node)
+        # Nodes are assumed to be alive until they miss their heartbeats
+        now = time.monotonic()
+        self.last_seen = {node: now for node in self.nodes}
+        self.ring = HashRing(self.nodes)
+
+    @classmethod
+    def from_config(cls, file_name):
+        """
+        Loads the cluster config from a json file. The environment variable
+        `RC433_NODE` overrides the name of this node.
+        Args:
+            file_name (str): Path of the file to load the config from.
+        Returns:
+            Returns a `ClusterMembership` initialized from the given json.
+        """
+        with open(file_name, 'r') as fp:
+            jsonf = cls.SCHEMA.validate(json.load(fp))
+
+        jsonf['node'] = os.environ.get('RC433_NODE', jsonf.get('node'))
+        if not jsonf['node']:
+            raise ValueError("Name of the cluster node is missing")
+        return cls(**jsonf)
+
+    @property
+    def alive(self):
+        with self._lock:
+            return sorted(self.ring.nodes)
+
+    def seen(self, node, now=None, alive=True):
+        """
+        Records a heartbeat (or the goodbye) of a node.
+        Returns:
+            Returns True if the set of alive nodes changed.
+        """
+        with self._lock:
+            if alive:
+                self.last_seen[node] = time.monotonic() if now is None \
+                    else now
+            else:
+                self.last_seen[node] = float('-inf')
+            return self._rebuild(now)
+
+    def expire(self, now=None):
+        """
+        Removes nodes which missed their heartbeats from the ring.
+        Returns:
+            Returns True if the set of alive nodes changed.
+        """
+        with self._lock:
+            return self._rebuild(now)
+
+    def _rebuild(self, now):
+        now = time.monotonic() if now is None else now
+        alive = [
+            node for node, seen in self.last_seen.items()
+            if node == self.node or now - seen <= self.timeout
+        ]
+        if sorted(alive) == self.ring.nodes:
+            return False
+        self.logger.info("Alive cluster nodes: {}".format(sorted(alive)))
+        self.ring = HashRing(alive)
+        return True
+
+    def owner(self, device):
+        with self._lock:
+            assigned = self.assignments.get(device)
+            if assigned in self.ring.nodes:
+                return assigned
+            return self.ring.owner(device)
+
+    def owns(self, device):
+        return self.owner(device) == self.node
+
+    def subscription(self, topic):
+        """Topic filter to subscribe to for a switch topic."""
+        if self.shared_group:
+            return '$share/{}/{}'.format(self.shared_group, topic)
+        return topic
+
+
+@attr.s
+class ClusterSubscriber(MQTTSubscriber):
+    """
+    `MQTTSubscriber` which only subscribes to the switch topics of the
+    devices owned by this node and keeps the ownership up to date via
+    heartbeats on `rc433/$cluster/<node>`.
+    """
+    membership = attr.ib(
+        default=None,
+        validator=attr.validators.optional(
+            attr.validators.instance_of(ClusterMembership)
+        )
+    )
+    subscribed = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+    _on_message_call = attr.ib(default=None, init=False, repr=False)
+    _stop = attr.ib(default=attr.Factory(threading.Event), init=False,
+                    repr=False)
+
+    @property
+    def heartbeat_topic(self):
+        return HEARTBEAT_TOPIC.format(self.membership.node)
+
+    def owned_topics(self):
+        return {
+            topic: qos for topic, qos in self.client_conf['topics'].items()
+            if self.membership.owns(device_of(topic))
+        }
+
+    def _on_connect(self, client, userdata, flags, rc) -> None:
+        self.logger.debug(
+            "Connection returned result: {}".format(mqtt.connack_string(rc))
+        )
+        if rc != 0:
+            return
+        self.counters['connects'] += 1
+        if self.backoff is not None:
+            self.backoff.reset()
+        try:
+            res = self.client.subscribe(HEARTBEAT_TOPIC.format('+'), 1)
+            if res[0] != mqtt.MQTT_ERR_SUCCESS:
+                raise SubscriptionException(
+                    "Could not subscribe to cluster heartbeats"
+                )
+            self._subscribe_callbacks()
+            self._heartbeat()
+            # Ownership may have changed meanwhile and a persistent session
+            # keeps the subscriptions of the previous connection
+            with self._lock:
+                self._resubscribe(reset=True)
+        except SubscriptionException as why:
+            self.counters['subscribe_failures'] += 1
+            self.logger.error("%s, reconnecting", why)
+            self.client.disconnect()
+
+    def _rebalance(self) -> None:
+        """Subscribes to newly owned and unsubscribes from lost topics."""
+        with self._lock:
+            self._resubscribe()
+
+    def _resubscribe(self, reset=False) -> None:
+        """
+        Args:
+            reset (bool): subscribe to all owned and unsubscribe from all
+                other topics, whatever the broker still knows
+        """
+        owned = self.owned_topics()
+        subscribed = self.client_conf['topics'] if reset else self.subscribed
+        lost = [t for t in subscribed if t not in owned]
+        gained = [(t, q) for t, q in owned.items()
+                  if reset or t not in self.subscribed]
+        if lost:
+            self.client.unsubscribe(
+                [self.membership.subscription(t) for t in lost]
+            )
+        if gained:
+            res = self.client.subscribe([
+                (self.membership.subscription(t), q) for t, q in gained
+            ])
+            if res[0] != mqtt.MQTT_ERR_SUCCESS:
+                raise SubscriptionException(
+                    "Could not connect on topics: {}".format(gained)
+                )
+        if lost or gained:
+            self.logger.info(
+                "Node '{}' owns {} devices (lost {}, gained {})".format(
+                    self.membership.node, len(owned), len(lost), len(gained))
+            )
+        self.subscribed = owned
+
+    def _on_heartbeat(self, client, userdata, message) -> None:
+        node = message.topic.split('/')[-1]
+        alive = message.payload.decode('utf-8') != 'offline'
+        if node != self.membership.node and \
+                self.membership.seen(node, alive=alive):
+            self._rebalance()
+
+    def _on_switch(self, client, userdata, message) -> None:
+        # Ownership may have moved while the message was underway
+        if self.membership.owns(device_of(message.topic)):
+            self._on_message_call(client, userdata, message)
+
+    def _heartbeat(self) -> None:
+        self.client.publish(self.heartbeat_topic, 'online', qos=1)
+
+    def _run_heartbeats(self) -> None:
+        while not self._stop.wait(self.membership.heartbeat_interval):
+            self._heartbeat()
+            if self.membership.expire():
+                self._rebalance()
+
+    def client_id(self) -> str:
+        # The node names are unique within the cluster
+        return os.environ.get(
+            'MQTT_CLIENT_ID',
+            self.session_conf.get(
+                'client_id', 'rc433mq-{}'.format(self.membership.node)
+            )
+        )
+
+    def _create_client(self) -> mqtt.Client:
+        client = super()._create_client()
+        client.will_set(self.heartbeat_topic, 'offline', qos=1)
+        return client
+
+    def connect(self,
+                on_connect: Callable = None,
+                on_message: Callable = None,
+                *args):
+        self._on_message_call = on_message or self._on_message
+        return super().connect(
+            on_connect=on_connect, on_message=self._on_switch, *args
+        )
+
+    def consume(self, on_message_call: Callable, **kwargs) -> None:
+        heartbeats = threading.Thread(
+            target=self._run_heartbeats, name='heartbeat', daemon=True
+        )
+        try:
+            try:
+                self.connect(on_message=on_message_call)
+            except OSError as why:
+                self.logger.warning("Connecting failed: %s", why)
+            self.client.message_callback_add(
+                HEARTBEAT_TOPIC.format('+'), self._on_heartbeat
+            )
+            heartbeats.start()
+            self.loop_forever()
+        except KeyboardInterrupt:
+            self.client.publish(self.heartbeat_topic, 'offline', qos=1)
+            self.cleanup()
+        finally:
+            self._stop.set()
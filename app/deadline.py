@@ -0,0 +1,278 @@
+"""
+Earliest-deadline-first transmission of switch commands.
+
+A command waiting behind long bursts of other devices may be pointless by
+the time it is sent, e.g. a light switched on after the user left the room.
+Every command gets a deadline: its time-to-live from the message, or the
+default of its device or of the queue, counted from its receipt. The
+pending commands are transmitted in the order of their deadlines; a command
+whose deadline passed before its transmission started is discarded. A newer
+command for a device replaces its pending one, so the commands of a device
+never overtake each other.
+
+The time-to-live of a message is given in a json payload:
+
+    {"state": "on", "ttl": 5}
+
+It must be a finite number of seconds above zero, a command with any other
+ttl is dropped like a malformed one.
+"""
+
+import heapq
+import itertools
+import json
+import math
+import threading
+import time
+from collections import defaultdict, deque
+
+import attr
+from schema import And, Optional, Schema, SchemaError, Use
+
+from .util import LogMixin, percentile
+
+TTL_SCHEMA = And(Use(float), math.isfinite, lambda n: n > 0)
+
+
+def parse_payload(payload):
+    """
+    Splits the payload of a switch command into the state and the
+    time-to-live, if any.
+    Example:
+        >>> parse_payload(b'{"state": "on", "ttl": 5}')
+        ('on', 5.0)
+        >>> parse_payload(b'OFF')
+        (b'OFF', None)
+        >>> parse_payload(b'{"state": "on", "ttl": NaN}')
+        (b'{"state": "on", "ttl": NaN}', None)
+    """
+    text = payload.decode('utf-8') if isinstance(payload, bytes) \
+        else payload
+    if not text.lstrip().startswith('{'):
+        return payload, None
+    try:
+        command = json.loads(text)
+        ttl = command.get('ttl')
+        return command['state'], \
+            None if ttl is None else TTL_SCHEMA.validate(ttl)
+    except (ValueError, KeyError, TypeError, AttributeError, SchemaError):
+        # Left to the validation of the state
+        return payload, None
+
+
+@attr.s
+class PendingCommand(object):
+    """A switch command waiting for its transmission."""
+    topic = attr.ib()
+    payload = attr.ib()
+    # `time.monotonic()` the command was received and is due by
+    received = attr.ib()
+    deadline = attr.ib()
+    result = attr.ib(default=None, init=False)
+    _done = attr.ib(default=attr.Factory(threading.Event), init=False,
+                    repr=False)
+
+    @property
+    def device(self):
+        parts = self.topic.split('/')
+        return parts[2] if len(parts) > 2 else None
+
+    def complete(self, result):
+        self.result = result
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the command to be handled.
+        Returns:
+            Returns True if the device was switched; otherwise False, also
+            if the command expired or the timeout passed.
+        """
+        self._done.wait(timeout)
+        return bool(self.result)
+
+
+@attr.s
+class DeadlineQueue(LogMixin):
+    """
+    Runs the pending commands on a transmitter thread, earliest deadline
+    first.
+    Example:
+        >>> queue = DeadlineQueue(default=10, devices={'ff_floor_tree': 60})
+        >>> gateway = Gateway(registry, publisher, deadlines=queue)
+        >>> gateway.start()
+        >>> mqs.consume(gateway.enqueue_state)
+    """
+    SCHEMA = Schema({
+        Optional('default'): TTL_SCHEMA,
+        Optional('devices'): {str: TTL_SCHEMA},
+        Optional('max_pending'): And(Use(int), lambda n: n > 0)
+    })
+
+    # time-to-live of commands in seconds
+    default = attr.ib(default=10., converter=float)
+    devices = attr.ib(default=attr.Factory(dict))
+    max_pending = attr.ib(default=1000, converter=int)
+    clock = attr.ib(default=time.monotonic, repr=False)
+    counters = attr.ib(default=attr.Factory(lambda: defaultdict(int)),
+                       init=False)
+    # seconds the transmitted commands had left until their deadline
+    slack = attr.ib(default=attr.Factory(lambda: deque(maxlen=1000)),
+                    init=False, repr=False)
+    _heap = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    # The pending command of every topic, entries of the heap which are
+    # not in here were replaced and are skipped
+    _latest = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _seq = attr.ib(default=attr.Factory(itertools.count), init=False,
+                   repr=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), init=False,
+                    repr=False)
+    _worker = attr.ib(default=None, init=False, repr=False)
+    _running = attr.ib(default=False, init=False, repr=False)
+
+    @classmethod
+    def from_json(cls, config):
+        """Creates the queue from the `deadlines` section of a client config."""
+        return cls(**cls.SCHEMA.validate(config))
+
+    def __len__(self):
+        return len(self._latest)
+
+    @property
+    def running(self):
+        return self._running
+
+    def ttl(self, device):
+        """The default time-to-live of the commands for a device."""
+        return self.devices.get(device, self.default)
+
+    def submit(self, topic, payload, received=None, ttl=None):
+        """
+        Queues a command, replacing the pending one for the same topic.
+        Args:
+            received (float): `time.monotonic()` the command was received
+            ttl (float): seconds from the receipt the command expires after,
+                the default of the device if not given
+        Returns:
+            Returns the `PendingCommand`, completed right away if the queue
+            is full.
+        """
+        received = self.clock() if received is None else received
+        pending = PendingCommand(topic=topic, payload=payload,
+                                 received=received, deadline=None)
+        if ttl is None:
+            ttl = self.ttl(pending.device)
+        pending.deadline = received + ttl
+        with self._cond:
+            replaced = self._latest.pop(topic, None)
+            if replaced is not None:
+                self.counters['superseded'] += 1
+                replaced.complete(False)
+            elif len(self._latest) >= self.max_pending:
+                self.counters['rejected'] += 1
+                self.logger.warning("Too many pending commands, dropped %s",
+                                    topic)
+                pending.complete(False)
+                return pending
+            self._latest[topic] = pending
+            heapq.heappush(self._heap,
+                           (pending.deadline, next(self._seq), pending))
+            self._compact()
+            self.counters['submitted'] += 1
+            self._cond.notify()
+        return pending
+
+    def _compact(self):
+        # Entries of replaced commands are dropped lazily
+        if len(self._heap) > 2 * len(self._latest) + 64:
+            self._heap = [
+                entry for entry in self._heap
+                if self._latest.get(entry[2].topic) is entry[2]
+            ]
+            heapq.heapify(self._heap)
+
+    def get(self, timeout=None):
+        """
+        Takes the command with the earliest deadline, expired ones are
+        completed as failed on the way.
+        Returns:
+            Returns the `PendingCommand` or None after the timeout.
+        """
+        with self._cond:
+            while True:
+                while self._heap:
+                    deadline, _, pending = heapq.heappop(self._heap)
+                    if self._latest.get(pending.topic) is not pending:
+                        continue
+                    del self._latest[pending.topic]
+                    now = self.clock()
+                    if deadline < now:
+                        self._expire(pending, now)
+                        continue
+                    self.slack.append(deadline - now)
+                    return pending
+                if not self._cond.wait(timeout) or not self._running:
+                    return None
+
+    def _expire(self, pending, now):
+        self.counters['expired'] += 1
+        self.logger.warning(
+            "Discarded command on '%s', expired %.3fs ago", pending.topic,
+            now - pending.deadline
+        )
+        pending.complete(False)
+
+    def start(self, execute):
+        """
+        Passes the pending commands to `execute` on a transmitter thread,
+        its result completes the command.
+        """
+        if self._running:
+            return
+        self._running = True
+        self._worker = threading.Thread(
+            target=self._run, args=(execute, ), name='transmitter',
+            daemon=True
+        )
+        self._worker.start()
+
+    def stop(self, timeout=5.):
+        """Stops the transmitter, the commands still pending fail."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+        with self._cond:
+            for pending in self._latest.values():
+                self.counters['dropped'] += 1
+                pending.complete(False)
+            self._latest = dict()
+            self._heap = list()
+
+    def _run(self, execute):
+        while self._running:
+            pending = self.get(timeout=1.)
+            if pending is None:
+                continue
+            result = False
+            try:
+                result = execute(pending)
+            finally:
+                pending.complete(result)
+                self.counters['transmitted'] += 1
+
+    def stats(self):
+        """
+        Returns:
+            Returns the counters, the number of pending commands and the
+            median and minimum slack (seconds until the deadline) of the
+            transmitted commands.
+        """
+        slack = list(self.slack)
+        res = dict(self.counters)
+        res['pending'] = len(self)
+        res['slack_p50'] = percentile(slack, 50)
+        res['slack_min'] = min(slack) if slack else None
+        return res
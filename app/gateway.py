@@ -0,0 +1,173 @@
+"""
+Dispatch of switch commands: validates the topic and state, switches the
+device via its `RC433Service` and publishes the new state.
+"""
+
+import threading
+
+import attr
+from schema import And, Optional, Schema, Use
+
+from .deadline import parse_payload
+from .ratelimit import CommandExpired, RateLimitExceeded
+from .rc433 import RC433Factory
+from .tracing import span
+from .util import LogMixin
+
+STATE_SCHEMA = Schema(And(str, Use(str.lower), lambda s: s in ('on', 'off')))
+TOPIC_SCHEMA = Schema({
+    'topic':
+    And(str, lambda s: s == 'rc433'),
+    'floor':
+    And(str, lambda s: s in ['groundfloor', 'firstfloor', 'secondfloor']),
+    'device':
+    And(str, lambda s: s[:2] in ['gf', 'ff', 'sf']),
+    Optional('command'):
+    str
+})
+TOPICS = ['topic', 'floor', 'device', 'command']
+
+
+@attr.s
+class Gateway(LogMixin):
+    """
+    Handles switch commands for the devices of a `DeviceRegistry`.
+    With a `DeadlineQueue` the commands are switched on its transmitter
+    thread, earliest deadline first.
+    Example:
+        >>> gateway = Gateway(registry, publisher)
+        >>> mqs.consume(gateway.handle_state)
+    """
+    registry = attr.ib()
+    publisher = attr.ib()
+    limiter = attr.ib(default=None)
+    tracer = attr.ib(default=None)
+    # Optional `StateAggregator` for the snapshot of all states
+    aggregator = attr.ib(default=None)
+    # Creates the `RC433Service` for a device, e.g. `Simulator.service`
+    service_factory = attr.ib(default=None, repr=False)
+    # Optional `DeadlineQueue` ordering the commands by their deadlines
+    deadlines = attr.ib(default=None)
+    # Commands from several ingresses are switched one at a time
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+
+    def service(self, device):
+        if self.service_factory is not None:
+            svc = self.service_factory(device)
+            svc.limiter = self.limiter
+            return svc
+        return RC433Factory.service(device)(limiter=self.limiter)
+
+    def start(self):
+        """Starts the transmitter thread of the deadline queue, if any."""
+        if self.deadlines is not None:
+            self.deadlines.start(
+                lambda pending: self._handle(
+                    pending.topic, pending.payload, pending.received,
+                    pending.deadline
+                )
+            )
+
+    def stop(self):
+        if self.deadlines is not None:
+            self.deadlines.stop()
+
+    def handle_state(self, client, userdata, message) -> bool:
+        """
+        Callback for messages on the `.../switch` topics.
+        Returns:
+            Returns the result of `dispatch`.
+        """
+        payload, ttl = parse_payload(message.payload)
+        return self.dispatch(
+            message.topic, payload,
+            received=getattr(message, 'timestamp', None), ttl=ttl
+        )
+
+    def enqueue_state(self, client, userdata, message) -> None:
+        """
+        Callback for messages on the `.../switch` topics which returns
+        right away, so later commands with earlier deadlines can overtake.
+        Without a deadline queue it is the same as `handle_state`.
+        """
+        if self.deadlines is None or not self.deadlines.running:
+            self.handle_state(client, userdata, message)
+            return
+        payload, ttl = parse_payload(message.payload)
+        self.deadlines.submit(
+            message.topic, payload,
+            received=getattr(message, 'timestamp', None), ttl=ttl
+        )
+
+    def dispatch(self, topic, payload, received=None, ttl=None) -> bool:
+        """
+        Switches the device of a `rc433/<floor>/<device>/switch` topic.
+        Args:
+            topic (str): topic of the command
+            payload (bytes): the state, 'on' or 'off'
+            received (float): `time.monotonic()` the command was received
+            ttl (float): seconds after the receipt the command expires,
+                only with a deadline queue
+        Returns:
+            Returns True if the device was switched; otherwise False.
+        """
+        if self.deadlines is not None and self.deadlines.running:
+            return self.deadlines.submit(
+                topic, payload, received=received, ttl=ttl
+            ).wait()
+        return self._handle(topic, payload, received)
+
+    def _handle(self, topic, payload, received, deadline=None) -> bool:
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.start('handle_state', received, topic=topic)
+        error = None
+        try:
+            with self._lock:
+                return self._dispatch(topic, payload, deadline)
+        except RateLimitExceeded as why:
+            error = str(why)
+            self.logger.warning("%s", why)
+        except Exception as why:
+            error = repr(why)
+            self.logger.exception("Could not handle command on '%s'", topic)
+        finally:
+            if trace is not None:
+                self.tracer.finish(trace, error=error)
+        return False
+
+    def _dispatch(self, topic, payload, deadline=None) -> bool:
+        with span('validate'):
+            topic_dict = dict(zip(TOPICS, topic.split("/")))
+            TOPIC_SCHEMA.validate(topic_dict)
+            state = payload.decode("utf-8") \
+                if isinstance(payload, bytes) else payload
+            STATE_SCHEMA.validate(state)
+
+        self.logger.info("Topic %s received state %s", topic_dict, state)
+
+        with span('lookup', device=topic_dict['device']):
+            device = self.registry.lookup(topic_dict['device'])
+        with span('service'):
+            svc = self.service(device)
+        # Other ingresses may have held the lock past the deadline
+        if deadline is not None and self.deadlines.clock() > deadline:
+            raise CommandExpired(
+                "Command on '{}' expired before its transmission".format(
+                    topic)
+            )
+        with span('switch'):
+            switched = svc.switch(device=device, state=state,
+                                  deadline=deadline)
+        if switched:
+            with span('publish'):
+                state_topic = "{topic}/{floor}/{device}/state".format(
+                    **topic_dict
+                )
+                self.publisher.publish(
+                    topic=state_topic, payload=state, retain=True
+                )
+                if self.aggregator is not None:
+                    self.aggregator.update(topic_dict['device'], state)
+        return switched
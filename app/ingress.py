@@ -0,0 +1,342 @@
+"""
+Local command ingress over a Unix domain socket.
+
+Automations on the same machine switch devices without the round trip
+through the broker. The protocol is line based, one command per line:
+
+    <device or switch topic> <on|off>
+
+Commands can be pipelined, i.e. a client may write a whole batch of lines
+at once. They are handled in order and answered with one line each:
+
+    OK <device> <state>
+    ERR <device> <reason>
+
+The selector thread only reads and writes, the commands are handled on a
+worker thread, which takes them from the connections in turn, so a long
+batch on one connection does not hold up the others.
+"""
+
+import os
+import selectors
+import socket
+import stat
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable
+
+import attr
+
+from .broker import GenericSubscriber
+from .loadgen import device_topics
+from .util import LogMixin
+
+
+def _remove_socket(path):
+    """Removes a socket file, any other file at the path is kept."""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError("'{}' exists and is no socket".format(path))
+    os.unlink(path)
+
+
+@attr.s
+class LocalMessage(object):
+    """A command in the shape of a paho `MQTTMessage`."""
+    topic = attr.ib()
+    payload = attr.ib()
+    timestamp = attr.ib(default=attr.Factory(time.monotonic))
+    qos = attr.ib(default=0)
+    retain = attr.ib(default=False)
+
+
+@attr.s
+class _Connection(object):
+    sock = attr.ib()
+    inbuf = attr.ib(default=attr.Factory(bytearray))
+    outbuf = attr.ib(default=attr.Factory(bytearray))
+    events = attr.ib(default=selectors.EVENT_READ)
+    # Lines waiting for the worker, guarded by `_cond` of the subscriber
+    commands = attr.ib(default=attr.Factory(deque))
+    # Commands read but not answered yet
+    outstanding = attr.ib(default=0)
+    eof = attr.ib(default=False)
+    closed = attr.ib(default=False)
+
+
+@attr.s
+class UnixSocketSubscriber(GenericSubscriber, LogMixin):
+    """
+    Accepts commands for the devices of the `rc433/<floor>/<device>/switch`
+    topics on a Unix domain socket and passes them as messages to the
+    consume callback, e.g. `Gateway.handle_state`. A callback returning
+    False is answered with an error.
+    Example:
+        >>> ingress = UnixSocketSubscriber('/run/rc433mq.sock', topics)
+        >>> ingress.start(gateway.handle_state)
+    """
+    MAX_LINE = 1024
+
+    path = attr.ib()
+    topics = attr.ib(converter=list)
+    mode = attr.ib(default=0o660)
+    counters = attr.ib(default=attr.Factory(lambda: defaultdict(int)),
+                       init=False)
+    _server = attr.ib(default=None, init=False, repr=False)
+    _selector = attr.ib(default=None, init=False, repr=False)
+    _switch_topics = attr.ib(default=None, init=False, repr=False)
+    _running = attr.ib(default=False, init=False, repr=False)
+    _thread = attr.ib(default=None, init=False, repr=False)
+    # Connections with commands, served round robin by the worker
+    _ready = attr.ib(default=attr.Factory(deque), init=False, repr=False)
+    _replies = attr.ib(default=attr.Factory(deque), init=False, repr=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), init=False,
+                    repr=False)
+    _wakeup = attr.ib(default=None, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._switch_topics = {
+            device: switch
+            for device, (switch, _) in device_topics(self.topics).items()
+        }
+
+    def connect(self) -> None:
+        """
+        Binds the socket, a stale socket file is replaced.
+        Raises:
+            FileExistsError: if the path exists and is no socket
+        """
+        _remove_socket(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        os.chmod(self.path, self.mode)
+        self._server.listen(16)
+        self._server.setblocking(False)
+        self._wakeup = socket.socketpair()
+        for sock in self._wakeup:
+            sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self.logger.info("Accepting commands on '%s'", self.path)
+
+    def consume(self, on_message_call: Callable, **kwargs) -> None:
+        """Handles commands until `stop` is called."""
+        if self._server is None:
+            self.connect()
+        self._running = True
+        worker = threading.Thread(
+            target=self._work, args=(on_message_call, ),
+            name='local-ingress-worker', daemon=True
+        )
+        worker.start()
+        try:
+            while self._running:
+                for key, events in self._selector.select(timeout=0.5):
+                    if key.fileobj is self._server:
+                        self._accept()
+                    elif key.fileobj is self._wakeup[0]:
+                        self._deliver()
+                    else:
+                        self._serve(key.data, events)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            with self._cond:
+                self._running = False
+                self._cond.notify()
+            worker.join()
+            self.cleanup()
+
+    def start(self, on_message_call: Callable) -> None:
+        """Consumes on a background thread."""
+        self.connect()
+        self._thread = threading.Thread(
+            target=self.consume, args=(on_message_call, ),
+            name='local-ingress', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def cleanup(self) -> None:
+        if self._selector is None:
+            return
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._wakeup[1].close()
+        self._selector.close()
+        self._selector = None
+        self._server = None
+        self._wakeup = None
+        try:
+            _remove_socket(self.path)
+        except FileExistsError:
+            pass
+
+    def _accept(self):
+        sock, _ = self._server.accept()
+        sock.setblocking(False)
+        self._selector.register(
+            sock, selectors.EVENT_READ, data=_Connection(sock)
+        )
+        self.counters['connections'] += 1
+
+    def _close(self, conn):
+        if conn.events:
+            self._selector.unregister(conn.sock)
+        conn.sock.close()
+        conn.closed = True
+
+    def _serve(self, conn, events):
+        if events & selectors.EVENT_WRITE and not self._write(conn):
+            return
+        if not events & selectors.EVENT_READ:
+            return
+        try:
+            data = conn.sock.recv(65536)
+        except ConnectionError:
+            data = b''
+        if not data:
+            # The commands read so far are still handled and answered
+            conn.eof = True
+            self._write(conn)
+            return
+        conn.inbuf.extend(data)
+        lines = conn.inbuf.split(b'\n')
+        conn.inbuf = lines.pop()
+        if len(conn.inbuf) > self.MAX_LINE:
+            self.logger.warning("Closing connection sending overlong lines")
+            self._close(conn)
+            return
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return
+        with self._cond:
+            if not conn.commands:
+                self._ready.append(conn)
+            conn.commands.extend(lines)
+            conn.outstanding += len(lines)
+            self._cond.notify()
+
+    def _work(self, on_message_call):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                conn = self._ready.popleft()
+                line = conn.commands.popleft()
+                if conn.commands:
+                    self._ready.append(conn)
+            reply = self._handle(line, on_message_call)
+            with self._cond:
+                self._replies.append((conn, reply))
+            try:
+                self._wakeup[1].send(b'\0')
+            except BlockingIOError:
+                # The selector has a wake-up pending already
+                pass
+
+    def _deliver(self):
+        try:
+            while self._wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._cond:
+            replies, self._replies = self._replies, deque()
+        touched = {}
+        for conn, reply in replies:
+            conn.outstanding -= 1
+            if not conn.closed:
+                conn.outbuf.extend(reply)
+                touched[id(conn)] = conn
+        for conn in touched.values():
+            self._write(conn)
+
+    def _handle(self, line, on_message_call):
+        parts = line.decode('utf-8', 'replace').split()
+        self.counters['commands'] += 1
+        if len(parts) != 2:
+            return self._reply('ERR', parts[0], 'malformed')
+        device, state = parts
+        topic = device if '/' in device else self._switch_topics.get(device)
+        if topic is None:
+            return self._reply('ERR', device, 'unknown device')
+        try:
+            res = on_message_call(
+                None, None, LocalMessage(topic=topic, payload=state.encode())
+            )
+        except Exception as why:
+            self.logger.exception("Could not handle local command")
+            return self._reply('ERR', device, type(why).__name__)
+        if res is False:
+            return self._reply('ERR', device, 'failed')
+        return self._reply('OK', device, state.lower())
+
+    def _reply(self, status, *args):
+        self.counters[status.lower()] += 1
+        return '{} {}\n'.format(status, ' '.join(args)).encode('utf-8')
+
+    def _write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf) if conn.outbuf else 0
+        except BlockingIOError:
+            sent = 0
+        except ConnectionError:
+            self._close(conn)
+            return False
+        del conn.outbuf[:sent]
+        if conn.eof and not conn.outstanding and not conn.outbuf:
+            self._close(conn)
+            return False
+        # The rest is sent once the client reads again
+        events = 0 if conn.eof else selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events != conn.events:
+            if not conn.events:
+                self._selector.register(conn.sock, events, data=conn)
+            elif not events:
+                self._selector.unregister(conn.sock)
+            else:
+                self._selector.modify(conn.sock, events, data=conn)
+            conn.events = events
+        return True
+
+
+def send_commands(path, commands, timeout=5.):
+    """
+    Sends a batch of commands and waits for the answers.
+    Args:
+        path (str): path of the socket
+        commands: list of (device, state) tuples
+    Returns:
+        Returns the answer lines, in the order of the commands.
+    Example:
+        >>> send_commands('/run/rc433mq.sock', [('gf_lamp', 'on')])
+        ['OK gf_lamp on']
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(''.join(
+            '{} {}\n'.format(device, state) for device, state in commands
+        ).encode('utf-8'))
+        data = b''
+        while data.count(b'\n') < len(commands):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return data.decode('utf-8').splitlines()
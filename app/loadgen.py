@@ -0,0 +1,280 @@
+"""
+Load generator for the gateway. Switch commands are published to the
+`.../switch` topics and correlated with the acknowledgements on the
+`.../state` topics to measure throughput and end-to-end latency.
+"""
+
+import random
+import threading
+import time
+from collections import defaultdict, deque
+
+import attr
+
+from .util import LogMixin, percentile
+
+
+def device_topics(topics):
+    """
+    Maps the device names to their switch and state topics, derived from
+    the `rc433/<floor>/<device>/switch` topics of the consumer config.
+    Example:
+        >>> device_topics(['rc433/groundfloor/gf_lamp/switch'])['gf_lamp']
+        ('rc433/groundfloor/gf_lamp/switch', 'rc433/groundfloor/gf_lamp/state')
+    """
+    res = dict()
+    for topic in topics:
+        parts = topic.split('/')
+        if len(parts) == 4:
+            res[parts[2]] = (topic, '/'.join(parts[:3] + ['state']))
+    return res
+
+
+@attr.s
+class DeviceChooser(object):
+    """
+    Picks the devices to switch.
+        uniform: every device with the same probability
+        hotspot: `hot_share` of the commands go to the first
+            `hot_fraction` of the devices
+        scene: bursts of `scene_size` different devices at once
+    """
+    DISTRIBUTIONS = ('uniform', 'hotspot', 'scene')
+
+    devices = attr.ib(converter=sorted)
+    distribution = attr.ib(
+        default='uniform', validator=attr.validators.in_(DISTRIBUTIONS)
+    )
+    hot_fraction = attr.ib(default=0.2, converter=float)
+    hot_share = attr.ib(default=0.8, converter=float)
+    scene_size = attr.ib(default=4, converter=int)
+    rng = attr.ib(default=attr.Factory(random.Random), repr=False)
+
+    def choose(self):
+        """
+        Returns:
+            Returns the list of devices for the next command (burst).
+        """
+        if self.distribution == 'scene':
+            size = min(self.scene_size, len(self.devices))
+            return self.rng.sample(self.devices, size)
+        if self.distribution == 'hotspot':
+            hot = max(int(len(self.devices) * self.hot_fraction), 1)
+            if self.rng.random() < self.hot_share:
+                return [self.rng.choice(self.devices[:hot])]
+            return [self.rng.choice(self.devices[hot:] or self.devices)]
+        return [self.rng.choice(self.devices)]
+
+
+@attr.s
+class LatencyTracker(object):
+    """
+    Correlates the acknowledgements with the commands. An acknowledgement
+    completes the oldest pending command of the device with the same state;
+    older pending commands of that device are superseded, since the
+    gateway only publishes the latest state.
+    """
+    clock = attr.ib(default=time.monotonic, repr=False)
+    pending = attr.ib(default=attr.Factory(lambda: defaultdict(deque)),
+                      init=False, repr=False)
+    latencies = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    counters = attr.ib(default=attr.Factory(lambda: defaultdict(int)),
+                       init=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), init=False,
+                    repr=False)
+
+    def sent(self, device, state):
+        with self._cond:
+            self.pending[device].append((state, self.clock()))
+            self.counters['sent'] += 1
+
+    def acked(self, device, state):
+        """
+        Returns:
+            Returns the latency of the acknowledged command or None for
+            unexpected acknowledgements.
+        """
+        now = self.clock()
+        with self._cond:
+            queue = self.pending[device]
+            for idx, (pending_state, sent) in enumerate(queue):
+                if pending_state != state:
+                    continue
+                for _ in range(idx + 1):
+                    queue.popleft()
+                self.counters['superseded'] += idx
+                self.counters['acked'] += 1
+                self.latencies.append(now - sent)
+                self._cond.notify_all()
+                return now - sent
+            self.counters['unexpected'] += 1
+            return None
+
+    def wait(self, device, timeout):
+        """
+        Waits until no command for the device is pending.
+        Returns:
+            Returns False if the timeout passed first.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self.pending[device], timeout
+            )
+
+    def expire(self, timeout):
+        """Counts commands older than `timeout` seconds as lost."""
+        deadline = self.clock() - timeout
+        with self._cond:
+            for queue in self.pending.values():
+                while queue and queue[0][1] < deadline:
+                    queue.popleft()
+                    self.counters['lost'] += 1
+            self._cond.notify_all()
+
+    def report(self, duration):
+        """
+        Returns:
+            Returns a dict with the counters, the throughput of acknowledged
+            commands per second and the p50/p95/p99/max latency in seconds.
+        """
+        with self._cond:
+            res = dict(self.counters)
+            latencies = list(self.latencies)
+            res['pending'] = sum(len(q) for q in self.pending.values())
+        res['duration'] = duration
+        res['throughput'] = len(latencies) / duration if duration else 0.
+        for q in (50, 95, 99):
+            res['p{}'.format(q)] = percentile(latencies, q)
+        res['max'] = max(latencies) if latencies else None
+        return res
+
+
+@attr.s
+class LoadGenerator(LogMixin):
+    """
+    Publishes switch commands through a connected paho client and measures
+    them with a `LatencyTracker`.
+        open: commands are sent at `rate` per second, regardless of the
+            acknowledgements (poisson arrivals unless `constant`)
+        closed: `concurrency` workers send a command, wait for its
+            acknowledgement (or `timeout`) and `think` seconds
+    """
+    MODES = ('open', 'closed')
+
+    client = attr.ib()
+    topics = attr.ib(validator=attr.validators.instance_of(dict))
+    chooser = attr.ib(validator=attr.validators.instance_of(DeviceChooser))
+    mode = attr.ib(default='open', validator=attr.validators.in_(MODES))
+    rate = attr.ib(default=0.5, converter=float)
+    constant = attr.ib(default=False)
+    concurrency = attr.ib(default=1, converter=int)
+    think = attr.ib(default=0., converter=float)
+    timeout = attr.ib(default=10., converter=float)
+    qos = attr.ib(default=0, converter=int)
+    tracker = attr.ib(default=attr.Factory(LatencyTracker))
+    _states = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _devices = attr.ib(default=None, init=False, repr=False)
+    _claimed = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+
+    def __attrs_post_init__(self):
+        self._devices = {
+            state: device for device, (_, state) in self.topics.items()
+        }
+
+    def subscribe(self):
+        """Subscribes to the state topics of all devices."""
+        self.client.on_message = self._on_message
+        self.client.subscribe(
+            [(state, self.qos) for _, state in self.topics.values()]
+        )
+
+    def _on_message(self, client, userdata, message):
+        if getattr(message, 'retain', False):
+            # the retained state from before the run
+            return
+        device = self._devices.get(message.topic)
+        if device is not None:
+            self.tracker.acked(
+                device, message.payload.decode('utf-8').lower()
+            )
+
+    def send(self, device):
+        """Switches the device to the opposite of the last sent state."""
+        with self._lock:
+            state = 'off' if self._states.get(device) == 'on' else 'on'
+            self._states[device] = state
+        self.tracker.sent(device, state)
+        self.client.publish(self.topics[device][0], state.upper(), self.qos)
+
+    def run(self, duration):
+        """
+        Generates load for `duration` seconds and waits up to `timeout`
+        for the outstanding acknowledgements.
+        Returns:
+            Returns the report of the tracker.
+        """
+        start = time.monotonic()
+        end = start + duration
+        if self.mode == 'open':
+            self._run_open(end)
+        else:
+            workers = [
+                threading.Thread(target=self._run_closed, args=(end, ),
+                                 daemon=True)
+                for _ in range(self.concurrency)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        elapsed = time.monotonic() - start
+        self._drain()
+        return self.tracker.report(elapsed)
+
+    def _drain(self):
+        deadline = time.monotonic() + self.timeout
+        for device in self.topics:
+            self.tracker.wait(device, max(deadline - time.monotonic(), 0))
+        self.tracker.expire(0)
+
+    def _run_open(self, end):
+        rng = self.chooser.rng
+        next_send = time.monotonic()
+        while next_send < end:
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for device in self.chooser.choose():
+                self.send(device)
+            self.tracker.expire(self.timeout)
+            next_send += 1. / self.rate if self.constant \
+                else rng.expovariate(self.rate)
+
+    def _run_closed(self, end):
+        while time.monotonic() < end:
+            devices = self._claim(self.chooser.choose())
+            if not devices:
+                time.sleep(0.001)
+                continue
+            for device in devices:
+                self.send(device)
+            for device in devices:
+                if not self.tracker.wait(device, self.timeout):
+                    self.tracker.expire(self.timeout)
+            self._release(devices)
+            if self.think:
+                time.sleep(self.think)
+
+    def _claim(self, devices):
+        # Workers never switch the same device concurrently, otherwise
+        # acknowledgements could not be told apart
+        with self._lock:
+            free = [d for d in devices if d not in self._claimed]
+            self._claimed.update(free)
+            return free
+
+    def _release(self, devices):
+        with self._lock:
+            self._claimed.difference_update(devices)
@@ -0,0 +1,203 @@
+"""
+On-demand profiler for the running gateway.
+
+While enabled a background thread samples the stacks of all threads (the
+paho network loop, transmitters, ...) via `sys._current_frames()` and
+counts those which used CPU time since the previous sample, so threads
+blocked in select, sleep or on a lock do not drown the hot spots. The
+result is written in the collapsed-stack format read by flamegraph.pl or
+speedscope. While disabled nothing runs at all.
+
+Profiling is switched on and off by SIGUSR1 / SIGUSR2 or by the payloads
+`start [seconds]` and `stop` on the topic `rc433/$control/profile`.
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+import attr
+
+from .util import LogMixin
+
+CONTROL_TOPIC = 'rc433/$control/profile'
+
+
+def _stack(frame):
+    stack = list()
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}:{}'.format(
+            os.path.basename(code.co_filename), code.co_name,
+            frame.f_lineno
+        ))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def _cpu_time(ident):
+    """CPU time of a thread in seconds, None where it cannot be read."""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+@attr.s
+class SamplingProfiler(LogMixin):
+    """
+    Samples the stacks of all busy threads every `interval` seconds for at
+    most `max_duration` seconds. Samples of threads which used no CPU time
+    since the previous sample are only counted as `idle`.
+    Example:
+        >>> profiler = SamplingProfiler(output_dir='/tmp')
+        >>> profiler.start(duration=10)
+        True
+        >>> # ...
+        >>> profiler.stop()
+        '/tmp/profile-20190101-120000.folded'
+    """
+    interval = attr.ib(default=0.005, converter=float)
+    max_duration = attr.ib(default=60., converter=float)
+    output_dir = attr.ib(default='logs')
+    samples = attr.ib(default=attr.Factory(Counter), init=False, repr=False)
+    idle = attr.ib(default=0, init=False, repr=False)
+    _cpu = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    # Set by the signal handlers, handled by the `profiler-signal` thread
+    _signals = attr.ib(default=attr.Factory(deque), init=False, repr=False)
+    _signalled = attr.ib(default=attr.Factory(threading.Event), init=False,
+                         repr=False)
+    _thread = attr.ib(default=None, init=False, repr=False)
+    _stop = attr.ib(default=attr.Factory(threading.Event), init=False,
+                    repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, duration=None):
+        """
+        Starts sampling for `duration` seconds (capped by `max_duration`).
+        Returns:
+            Returns False if the profiler was running already.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            duration = min(duration or self.max_duration, self.max_duration)
+            self.samples = Counter()
+            self.idle = 0
+            self._cpu = dict()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(duration, ), name='profiler',
+                daemon=True
+            )
+            self._thread.start()
+        self.logger.info("Profiling for at most %.0fs", duration)
+        return True
+
+    def stop(self):
+        """
+        Stops sampling and writes the collapsed stacks.
+        Returns:
+            Returns the path of the written file or None if the profiler was
+            not running.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return None
+        self._stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+        return self.write()
+
+    def write(self):
+        file_name = os.path.join(
+            self.output_dir,
+            'profile-{}.folded'.format(time.strftime('%Y%m%d-%H%M%S'))
+        )
+        with open(file_name, 'w') as fp:
+            for stack, count in self.samples.most_common():
+                fp.write('{} {}\n'.format(stack, count))
+        self.logger.info(
+            "Wrote %d samples to '%s' (%d idle left out)",
+            sum(self.samples.values()), file_name, self.idle
+        )
+        return file_name
+
+    def sample(self):
+        """Takes a single sample of all other threads which are busy."""
+        names = {t.ident: t.name for t in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            cpu, last = _cpu_time(ident), self._cpu.get(ident)
+            self._cpu[ident] = cpu
+            if cpu is not None and (last is None or cpu <= last):
+                self.idle += 1
+                continue
+            thread = names.get(ident, str(ident)).replace(' ', '_')
+            self.samples['{};{}'.format(thread, _stack(frame))] += 1
+
+    def _run(self, duration):
+        end = time.monotonic() + duration
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= end:
+                # The window is over, finish unless stop() is underway
+                threading.Thread(target=self.stop, daemon=True).start()
+                return
+
+    def handle_control(self, client, userdata, message):
+        """
+        Callback for the control topic, the payload is `start [seconds]`
+        or `stop`.
+        """
+        try:
+            command = message.payload.decode('utf-8').split()
+            if not command:
+                return
+            if command[0] == 'start':
+                duration = float(command[1]) if len(command) > 1 else None
+                if duration is not None and not 0 < duration < float('inf'):
+                    raise ValueError("invalid duration {}".format(duration))
+                self.start(duration)
+            elif command[0] == 'stop':
+                self.stop()
+            else:
+                self.logger.warning("Unknown profiler command '%s'",
+                                    command[0])
+        except ValueError as why:
+            self.logger.warning("Invalid profiler command '%s': %s",
+                                message.payload, why)
+
+    def install_signal_handlers(self):
+        """Starts profiling on SIGUSR1 and stops it on SIGUSR2."""
+        threading.Thread(target=self._watch_signals, name='profiler-signal',
+                         daemon=True).start()
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        signal.signal(signal.SIGUSR2, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        # Signal handlers must not take locks the interrupted code may hold,
+        # the watching thread does the work
+        self._signals.append(signum)
+        self._signalled.set()
+
+    def _watch_signals(self):
+        while True:
+            self._signalled.wait()
+            self._signalled.clear()
+            while self._signals:
+                if self._signals.popleft() == signal.SIGUSR1:
+                    self.start()
+                else:
+                    self.stop()
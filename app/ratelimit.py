@@ -0,0 +1,225 @@
+"""
+Airtime budgets for the transmitters.
+
+Every switch command occupies the transmitter for a known airtime (see
+`RC433Service.airtime`). Token buckets hand out airtime, in seconds per
+second, for every transmitter and every device; the bucket size is the
+burst which can be sent at once.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+
+import attr
+from schema import And, Optional, Schema, Use
+
+from .util import LogMixin
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a command exceeds the airtime budget."""
+    pass
+
+
+class CommandExpired(RateLimitExceeded):
+    """Raised when a command would wait past its deadline."""
+    pass
+
+
+@attr.s
+class TokenBucket(object):
+    """
+    Token bucket which is refilled with `rate` tokens per second up to
+    `burst` tokens.
+    Example:
+        >>> bucket = TokenBucket(rate=0.1, burst=1.0, now=0.)
+        >>> bucket.wait_time(0.5, now=0.)
+        0.0
+        >>> bucket.consume(1.0, now=0.)
+        >>> bucket.wait_time(0.5, now=0.)
+        5.0
+    """
+    rate = attr.ib(converter=float)
+    burst = attr.ib(converter=float)
+    now = attr.ib(default=None)
+    tokens = attr.ib(default=None, init=False)
+
+    def __attrs_post_init__(self):
+        self.tokens = self.burst
+        self.now = time.monotonic() if self.now is None else self.now
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.now) * self.rate
+        )
+        self.now = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until `amount` tokens are available. Amounts larger than
+        the burst are available once the bucket is full.
+        """
+        self._refill(now)
+        missing = min(amount, self.burst) - self.tokens
+        return max(missing / self.rate, 0.)
+
+    def consume(self, amount, now):
+        """Takes `amount` tokens, possibly leaving the bucket in debt."""
+        self._refill(now)
+        self.tokens -= amount
+
+
+@attr.s
+class AirtimeLimiter(LogMixin):
+    """
+    Limits the airtime per transmitter and per device.
+    Rates are the sustained share of airtime (0.1 means a duty cycle of
+    10%), bursts the airtime in seconds which can be used at once.
+    If a command exceeds the budget the `policy` decides:
+        reject: fail immediately with `RateLimitExceeded`
+        delay: wait up to `max_delay` seconds for the budget
+    Commands reach the limiter one at a time (see `Gateway`), newer
+    commands replacing waiting ones is up to a `DeadlineQueue`.
+    """
+    POLICIES = ('reject', 'delay')
+
+    SCHEMA = Schema({
+        Optional('transmitter_rate'): And(Use(float), lambda n: 0 < n <= 1),
+        Optional('transmitter_burst'): And(Use(float), lambda n: n > 0),
+        Optional('device_rate'): And(Use(float), lambda n: 0 < n <= 1),
+        Optional('device_burst'): And(Use(float), lambda n: n > 0),
+        Optional('policy'): And(str, lambda s: s in AirtimeLimiter.POLICIES),
+        Optional('max_delay'): And(Use(float), lambda n: n >= 0)
+    })
+
+    # The bursts fit a scene of 8 devices and on, off, on, off of a single
+    # device, even of code devices (2.24s of airtime per command)
+    transmitter_rate = attr.ib(default=0.1, converter=float)
+    transmitter_burst = attr.ib(default=20., converter=float)
+    device_rate = attr.ib(default=0.05, converter=float)
+    device_burst = attr.ib(default=10., converter=float)
+    policy = attr.ib(
+        default='delay', validator=attr.validators.in_(POLICIES)
+    )
+    max_delay = attr.ib(default=5., converter=float)
+    clock = attr.ib(default=time.monotonic, repr=False)
+
+    transmitters = attr.ib(default=None, init=False, repr=False)
+    devices = attr.ib(default=None, init=False, repr=False)
+    counters = attr.ib(
+        default=attr.Factory(lambda: defaultdict(int)),
+        init=False, repr=False
+    )
+    _waiting = attr.ib(default=0, init=False, repr=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), init=False,
+                    repr=False)
+
+    def __attrs_post_init__(self):
+        self.transmitters = dict()
+        self.devices = dict()
+
+    @classmethod
+    def from_config(cls, file_name):
+        """
+        Loads the limits from a json config file.
+        Args:
+            file_name (str): Path of the file to load the limits from.
+        Returns:
+            Returns an `AirtimeLimiter` initialized from the given json.
+        """
+        with open(file_name, 'r') as fp:
+            jsonf = json.load(fp)
+
+        return cls(**cls.SCHEMA.validate(jsonf))
+
+    def _bucket(self, buckets, key, rate, burst, now):
+        if key not in buckets:
+            buckets[key] = TokenBucket(rate=rate, burst=burst, now=now)
+        return buckets[key]
+
+    def _wait_time(self, transmitter, device, airtime, now):
+        tx = self._bucket(self.transmitters, transmitter,
+                          self.transmitter_rate, self.transmitter_burst, now)
+        dev = self._bucket(self.devices, device,
+                           self.device_rate, self.device_burst, now)
+        return max(tx.wait_time(airtime, now), dev.wait_time(airtime, now))
+
+    def acquire(self, transmitter, device, airtime, deadline=None):
+        """
+        Takes the airtime of a command from the budgets of the transmitter
+        and the device, waiting according to the policy.
+        Args:
+            transmitter: key of the transmitter, e.g. its pin
+            device (str): name of the device
+            airtime (float): airtime of the command in seconds
+            deadline (float): `clock()` the command has to be sent by
+        Returns:
+            Returns the seconds the command was delayed.
+        Raises:
+            `RateLimitExceeded` if the command is not allowed or
+            `CommandExpired` if it cannot be sent by its deadline.
+        """
+        start = self.clock()
+        with self._cond:
+            self._waiting += 1
+            try:
+                return self._acquire(transmitter, device, airtime, start,
+                                     deadline)
+            finally:
+                self._waiting -= 1
+
+    def _acquire(self, transmitter, device, airtime, start, deadline):
+        waited = False
+        while True:
+            now = self.clock()
+            wait = self._wait_time(transmitter, device, airtime, now)
+            if deadline is not None and now + max(wait, 0.) > deadline:
+                self._throttled('expired', device)
+                raise CommandExpired(
+                    "Command for '{}' would be sent {:.2f}s after its "
+                    "deadline".format(device, now + max(wait, 0.) - deadline)
+                )
+            if wait <= 0:
+                self.transmitters[transmitter].consume(airtime, now)
+                self.devices[device].consume(airtime, now)
+                self.counters['allowed'] += 1
+                self.counters['airtime'] += airtime
+                if waited:
+                    self.counters['delayed'] += 1
+                    self.counters['delay_seconds'] += now - start
+                return now - start if waited else 0.
+            remaining = start + self.max_delay - now
+            if self.policy == 'reject' or wait > remaining:
+                self._throttled('rejected', device)
+                raise RateLimitExceeded(
+                    "Airtime budget for '{}' exceeded, next command possible "
+                    "in {:.2f}s".format(device, wait)
+                )
+            self._cond.wait(wait)
+            waited = True
+
+    def _throttled(self, reason, device):
+        self.counters[reason] += 1
+        self.logger.warning(
+            "Command for device '{}' {} by airtime limit".format(
+                device, reason)
+        )
+
+    def stats(self):
+        """
+        Snapshot of the limiter metrics.
+        Returns:
+            Returns a dict with the number of allowed, delayed, rejected and
+            expired commands, the overall delay and the used airtime (both
+            in seconds) and the number of waiting commands.
+        """
+        with self._cond:
+            res = {k: 0 for k in ('allowed', 'delayed', 'rejected',
+                                  'expired', 'delay_seconds', 'airtime')}
+            res.update(self.counters)
+            res['throttled'] = res['rejected'] + res['expired'] + \
+                res['delayed']
+            res['pending'] = self._waiting
+        return res
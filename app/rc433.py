@@ -1,10 +1,12 @@
-import time
 from abc import abstractmethod
 
 import attr
 
 from . import GPIO, RFDevice
+from .backend import backend_from_env
 from .device import CodeDevice, StatefulDevice, SystemDevice
+from .realtime import burst
+from .tracing import span
 from .util import LogMixin
 
 
@@ -21,6 +23,17 @@ class RC433Service(LogMixin):
         converter=int,
         validator=attr.validators.instance_of(int)
     )
+    # Optional `AirtimeLimiter` shared by all services
+    limiter = attr.ib(default=None, repr=False)
+
+    @abstractmethod
+    def airtime(self, device):
+        """
+        Airtime of a single switch command for the given device.
+        Returns:
+            Returns the time in seconds the transmitter is busy.
+        """
+        pass
 
     @abstractmethod
     def applicable(self, device):
@@ -32,22 +45,36 @@ class RC433Service(LogMixin):
         return res
 
     @abstractmethod
-    def switch(self, device, state):
+    def switch(self, device, state, deadline=None):
+        """
+        Args:
+            deadline (float): `time.monotonic()` the command has to be sent
+                by, only checked while waiting for the airtime limiter
+        """
         if isinstance(device, StatefulDevice):
             # Unpack the actual device from the Stateful device wrapper
             device = device.device
         self.logger.debug(
-            "Device switch for '{device}' to '{state}' requested".format(
-                **locals()
-            )
+            "Device switch for '%s' to '%s' requested", device, state
         )
         assert state.lower() in ['on', 'off']
         assert self.applicable(device)
+        if self.limiter is not None:
+            with span('airtime_limit'):
+                self.limiter.acquire(
+                    self.pin, device.device_name, self.airtime(device),
+                    deadline=deadline
+                )
         return self._switch(device, state)
 
 
 @attr.s
 class RC433Switch(RC433Service):
+    """
+    Switches `SystemDevice`s. The frames are built as a list of pulses and
+    sent by a `TransmitBackend` (see `app.backend`), which is chosen by the
+    environment variable `RC433_BACKEND` unless passed in explicitly.
+    """
     # Number of transmissions
     REPEAT = 10
     # microseconds
@@ -55,12 +82,19 @@ class RC433Switch(RC433Service):
     GPIOMode = GPIO.BCM
     DEVICE_LETTER = {"A": 1, "B": 2, "C": 4, "D": 8, "E": 16, "F": 32, "G": 64}
 
+    backend = attr.ib(default=attr.Factory(backend_from_env), repr=False)
+
     def _initialize(self):
-        GPIO.setmode(RC433Switch.GPIOMode)
-        GPIO.setup(self.pin, GPIO.OUT)
+        self.backend.setup(self.pin)
+
+    def airtime(self, device):
+        # 16 bytes of 8 bangs per frame
+        return RC433Switch.REPEAT * 16 * 8 * RC433Switch.PULSE_LENGTH / 1e6
 
     def __del__(self):
-        GPIO.cleanup()
+        backend = getattr(self, 'backend', None)
+        if backend is not None:
+            backend.cleanup()
 
     def _applicable(self, device):
         return isinstance(device, SystemDevice)
@@ -74,10 +108,11 @@ class RC433Switch(RC433Service):
             int(device.system_code[4])
         ]
         device_letter = RC433Switch.DEVICE_LETTER[device.device_code]
-        self._initialize()
+        with span('gpio_setup'):
+            self._initialize()
         self.logger.debug(
-            "Toggle device (bit:{}, name:{}, state: {})"
-            .format(device_letter, device.device_name, state)
+            "Toggle device (bit:%s, name:%s, state: %s)",
+            device_letter, device.device_name, state
         )
         return self._toggle(
             GPIO.HIGH if state.lower() == 'on' else GPIO.LOW,
@@ -112,13 +147,22 @@ class RC433Switch(RC433Service):
                 bangs.append(b)
                 x = x >> 1
 
-        GPIO.output(self.pin, GPIO.LOW)
-        for z in range(RC433Switch.REPEAT):
-            for b in bangs:
-                GPIO.output(self.pin, b)
-                time.sleep(RC433Switch.PULSE_LENGTH / 1000000.)
+        pulses = self._pulses(bangs)
+        with span('transmit', pulses=len(pulses)):
+            return self.backend.transmit(pulses)
 
-        return True
+    def _pulses(self, bangs):
+        """
+        Converts the bangs of a frame into the pulses of all repetitions.
+        Consecutive bangs with the same level are merged into one pulse.
+        """
+        pulses = [[self.pin, GPIO.LOW, 0]]
+        for b in bangs * RC433Switch.REPEAT:
+            if pulses[-1][1] == b:
+                pulses[-1][2] += RC433Switch.PULSE_LENGTH
+            else:
+                pulses.append([self.pin, b, RC433Switch.PULSE_LENGTH])
+        return [tuple(p) for p in pulses]
 
 
 @attr.s
@@ -126,28 +170,50 @@ class RC433Code(RC433Service):
     """
     Remote control 433mhz devices.
     """
+    # Number of `tx_code` calls per code
+    REPEAT = 5
+    # Defaults of rpi_rf for protocol 1: frames per `tx_code` call,
+    # pulse length in microseconds and code length in bits
+    TX_REPEAT = 10
+    PULSE_LENGTH = 350
+    CODE_LENGTH = 24
+    # Pulse lengths per bit and of the sync
+    BIT_PULSES = 4
+    SYNC_PULSES = 32
+
+    # Creates the RFDevice for a pin, e.g. `Simulator.rf_device` in tests
+    rf_factory = attr.ib(default=RFDevice, repr=False)
     rf_device = attr.ib(default=None, init=False)
 
     def _initialize(self):
         """Sets the RFDevice to transmit state if necessary"""
         if self.rf_device is None:
-            self.rf_device = RFDevice(self.pin)
+            self.rf_device = self.rf_factory(self.pin)
             self.rf_device.enable_tx()
 
     def __del__(self):
         """Stops transmitting."""
         if self.rf_device is not None:
-            self.rf_device.cleanup()
+            # `cleanup` of rpi_rf resets all pins of the process
+            self.rf_device.disable_tx()
             self.rf_device = None
 
     def _applicable(self, device):
         return isinstance(device, CodeDevice)
 
+    def airtime(self, device):
+        pulses = RC433Code.CODE_LENGTH * RC433Code.BIT_PULSES + \
+            RC433Code.SYNC_PULSES
+        return RC433Code.REPEAT * RC433Code.TX_REPEAT * pulses * \
+            RC433Code.PULSE_LENGTH / 1e6
+
     def _switch(self, device, state):
         if isinstance(device, StatefulDevice):
             # Unpack the actual device from the Stateful device wrapper
             device = device.device
-        return self._send_code(device.code_on if state else device.code_off)
+        return self._send_code(
+            device.code_on if state.lower() == 'on' else device.code_off
+        )
 
     def _send_code(self, code):
         """
@@ -165,9 +231,13 @@ class RC433Code(RC433Service):
                 "Argument code is expected to be an int, but given is '{}'".
                 format(type(code)))
 
-        self._initialize()
-        self.logger.debug("Sending code '{}'".format(code))
-        return any([self.rf_device.tx_code(code) for _ in range(5)])
+        with span('gpio_setup'):
+            self._initialize()
+        self.logger.debug("Sending code '%s'", code)
+        with span('transmit', code=code), burst(self.airtime(None)):
+            return any([
+                self.rf_device.tx_code(code) for _ in range(RC433Code.REPEAT)
+            ])
 
 
 class RC433Factory:
@@ -0,0 +1,288 @@
+"""
+Opt-in real-time mode for the transmit path.
+
+Bit-banging from Python suffers whenever the garbage collector, another
+thread or another process takes the CPU in the middle of a frame. During a
+transmit burst the real-time mode
+  * pins the transmitting thread to a dedicated core (`sched_setaffinity`),
+  * runs it with `SCHED_FIFO` priority,
+  * freezes and disables the cyclic garbage collector,
+and optionally locks the memory of the process once (`mlockall`), so no page
+faults happen in a burst. Afterwards the thread gets its previous affinity
+and scheduling back. Whatever is not permitted (e.g. `SCHED_FIFO` without
+`CAP_SYS_NICE`) is logged once and skipped.
+
+The transmit code wraps its bursts in `burst()`, which does nothing unless a
+`RealtimeGuard` is installed, similar to `app.tracing.span`.
+"""
+
+import ctypes
+import ctypes.util
+import gc
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import attr
+from schema import And, Optional, Schema, Use
+
+from .util import LogMixin, percentile
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+_guard = None
+
+
+def install(guard):
+    """Makes the guard the one used by `burst()`, None uninstalls it."""
+    global _guard
+    _guard = guard
+    if guard is not None:
+        guard.enable()
+
+
+def current():
+    """The installed `RealtimeGuard` or None."""
+    return _guard
+
+
+@contextmanager
+def burst(airtime=None):
+    """
+    Runs the enclosed transmission in real-time mode if a guard is
+    installed.
+    Args:
+        airtime (float): nominal duration of the burst in seconds
+    """
+    guard = _guard
+    if guard is None:
+        yield
+        return
+    with guard.burst(airtime):
+        yield
+
+
+@attr.s
+class RealtimeGuard(LogMixin):
+    """
+    Applies the real-time settings to the thread of a transmit burst and
+    measures the overrun of the bursts over their nominal airtime.
+    Example:
+        >>> guard = RealtimeGuard(cpu=3, priority=50)
+        >>> install(guard)
+        >>> with burst(0.384):
+        ...     backend.transmit(pulses)
+    """
+    SCHEMA = Schema({
+        Optional('cpu'): And(Use(int), lambda n: n >= 0),
+        Optional('priority'): And(Use(int), lambda n: 1 <= n <= 99),
+        Optional('freeze_gc'): bool,
+        Optional('lock_memory'): bool
+    })
+
+    cpu = attr.ib(default=None)
+    priority = attr.ib(default=None)
+    freeze_gc = attr.ib(default=True)
+    lock_memory = attr.ib(default=False)
+    # Whether each setting could be applied, None until tried
+    capabilities = attr.ib(default=attr.Factory(lambda: dict(
+        affinity=None, fifo=None, mlock=None
+    )), init=False)
+    overruns = attr.ib(default=attr.Factory(lambda: deque(maxlen=1000)),
+                       init=False, repr=False)
+    counters = attr.ib(default=attr.Factory(lambda: dict(
+        bursts=0, gc_deferred=0
+    )), init=False)
+    _depth = attr.ib(default=0, init=False, repr=False)
+    _gc_enabled = attr.ib(default=False, init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+
+    @classmethod
+    def from_config(cls, file_name):
+        """
+        Loads the real-time settings from a json config file.
+        Args:
+            file_name (str): Path of the file to load the settings from.
+        Returns:
+            Returns a `RealtimeGuard` initialized from the given json.
+        """
+        with open(file_name, 'r') as fp:
+            jsonf = json.load(fp)
+
+        return cls(**cls.SCHEMA.validate(jsonf))
+
+    def enable(self):
+        """Locks the memory if configured, done once for the process."""
+        if not self.lock_memory or self.capabilities['mlock'] is not None:
+            return
+        flags = MCL_CURRENT
+        try:
+            import resource
+            soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+            if soft == resource.RLIM_INFINITY:
+                # Otherwise later allocations would fail beyond the limit
+                flags |= MCL_FUTURE
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if libc.mlockall(flags) != 0:
+                raise OSError(ctypes.get_errno(),
+                              os.strerror(ctypes.get_errno()))
+            self.capabilities['mlock'] = True
+        except (ImportError, AttributeError, OSError) as why:
+            self._unavailable('mlock', why)
+
+    def _unavailable(self, capability, why):
+        self.capabilities[capability] = False
+        self.logger.warning("Real-time %s not available: %s", capability, why)
+
+    def _enter(self):
+        saved = dict()
+        if self.cpu is not None and \
+                self.capabilities['affinity'] is not False:
+            try:
+                saved['affinity'] = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, {self.cpu})
+                self.capabilities['affinity'] = True
+            except (AttributeError, OSError) as why:
+                saved.pop('affinity', None)
+                self._unavailable('affinity', why)
+        if self.priority is not None and \
+                self.capabilities['fifo'] is not False:
+            try:
+                saved['scheduler'] = (
+                    os.sched_getscheduler(0), os.sched_getparam(0)
+                )
+                os.sched_setscheduler(
+                    0, os.SCHED_FIFO, os.sched_param(self.priority)
+                )
+                self.capabilities['fifo'] = True
+            except (AttributeError, OSError) as why:
+                saved.pop('scheduler', None)
+                self._unavailable('fifo', why)
+        if self.freeze_gc:
+            with self._lock:
+                if self._depth == 0:
+                    self._gc_enabled = gc.isenabled()
+                    gc.disable()
+                    gc.freeze()
+                self._depth += 1
+        return saved
+
+    def _exit(self, saved):
+        if self.freeze_gc:
+            with self._lock:
+                self._depth -= 1
+                if self._depth == 0:
+                    gc.unfreeze()
+                    if gc.get_count()[0] > gc.get_threshold()[0]:
+                        self.counters['gc_deferred'] += 1
+                    if self._gc_enabled:
+                        gc.enable()
+        if 'scheduler' in saved:
+            policy, param = saved['scheduler']
+            os.sched_setscheduler(0, policy, param)
+        if 'affinity' in saved:
+            os.sched_setaffinity(0, saved['affinity'])
+
+    @contextmanager
+    def burst(self, airtime=None):
+        saved = self._enter()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._exit(saved)
+            self.counters['bursts'] += 1
+            if airtime is not None:
+                self.overruns.append(elapsed - airtime)
+
+    def stats(self):
+        """
+        Snapshot of the real-time metrics.
+        Returns:
+            Returns a dict with the number of bursts, those the garbage
+            collector was due in, the available capabilities and the mean,
+            p99 and max overrun of the bursts in seconds.
+        """
+        overruns = list(self.overruns)
+        res = dict(self.counters)
+        res.update({
+            k: v for k, v in self.capabilities.items() if v is not None
+        })
+        res['overrun_mean'] = sum(overruns) / len(overruns) \
+            if overruns else None
+        res['overrun_p99'] = percentile(overruns, 99)
+        res['overrun_max'] = max(overruns) if overruns else None
+        return res
+
+
+def compare(guard, device, rounds=5):
+    """
+    Measures the timing of bit-banging a device with and without the
+    real-time mode on the simulator.
+    Returns:
+        Returns a dict with the mean overrun (seconds) and the mean and max
+        pulse deviation (microseconds) for `baseline` and `realtime`.
+    """
+    # The module itself, also if run as `__main__`
+    from . import realtime
+    from .simulator import Simulator
+
+    res = dict()
+    previous = realtime.current()
+    try:
+        for name, active in (('baseline', None), ('realtime', guard)):
+            realtime.install(active)
+            sim = Simulator(realtime=True)
+            reports = [sim.switch(device, 'on') for _ in range(rounds)]
+            deviations = [r['deviation_max'] or 0. for r in reports]
+            res[name] = dict(
+                frames=sum(r['frames'] for r in reports),
+                overrun=sum(r['overrun'] for r in reports) / rounds,
+                deviation_mean=sum(
+                    r['deviation_mean'] or 0. for r in reports
+                ) / rounds,
+                deviation_max=max(deviations)
+            )
+    finally:
+        realtime.install(previous)
+    return res
+
+
+def main(argv=None):
+    """
+    Compares bit-banging with and without the real-time mode on this
+    machine, e.g. `python -m app.realtime --cpu 3 --priority 50`.
+    """
+    import argparse
+
+    from .device import SystemDevice
+    from .realtime import RealtimeGuard
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--cpu', type=int, default=None)
+    parser.add_argument('--priority', type=int, default=None)
+    parser.add_argument('--no-freeze-gc', action='store_true')
+    parser.add_argument('--lock-memory', action='store_true')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    guard = RealtimeGuard(
+        cpu=args.cpu, priority=args.priority,
+        freeze_gc=not args.no_freeze_gc, lock_memory=args.lock_memory
+    )
+    device = SystemDevice(
+        device_name='benchmark', system_code='10101', device_code='A'
+    )
+    res = compare(guard, device, rounds=args.rounds)
+    res['capabilities'] = guard.capabilities
+    print(json.dumps(res, indent=4))
+
+
+if __name__ == '__main__':
+    main()
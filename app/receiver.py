@@ -0,0 +1,349 @@
+"""
+Receive and learn mode for 433mhz remotes.
+
+Both encodings used for transmitting (`RC433Code` via rpi_rf protocol 1 and
+`RC433Switch._toggle`) share the same frame layout: 24 data bits, each one a
+high/low pulse pair of 1:3 (zero) or 3:1 (one) pulse lengths, followed by a
+1:31 sync pulse pair. Edges are therefore decoded in bulk into 24 bit words,
+which are matched against the configured `CodeDevice` codes or interpreted as
+the tri-state symbols of a `SystemDevice`.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import attr
+import numpy as np
+
+from . import GPIO
+from .device import CodeDevice, SystemDevice
+from .rc433 import RC433Switch
+from .util import LogMixin
+
+BITS = 24
+# data pulses plus the high and the low pulse of the sync
+FRAME_PULSES = 2 * BITS + 2
+SYNC_UNITS = 31
+WEIGHTS = np.left_shift(1, np.arange(BITS - 1, -1, -1), dtype=np.int64)
+
+
+def decode_pulses(timestamps, levels, tolerance=0.3):
+    """
+    Decodes recorded edges into 24 bit words.
+    Args:
+        timestamps: edge timestamps in microseconds
+        levels: level of the signal after each edge (1 high, 0 low)
+        tolerance (float): allowed relative deviation of a pulse pair from
+            four pulse lengths
+    Returns:
+        Returns the decoded words, the timestamps the frames started at,
+        the estimated pulse length of every frame and the index of the first
+        edge which could not be decoded yet (a frame in progress).
+    Example:
+        >>> ts, lv = encode_word(0b101, pulse_length=350)
+        >>> words, starts, pulse_lengths, rest = decode_pulses(ts, lv)
+        >>> words.tolist(), pulse_lengths.round().tolist()
+        ([5], [350.0])
+    """
+    ts = np.asarray(timestamps, dtype=np.float64)
+    lv = np.asarray(levels, dtype=np.int8)
+    empty = (np.empty(0, np.int64), np.empty(0), np.empty(0))
+    if len(ts) < FRAME_PULSES + 1:
+        return empty + (0, )
+
+    durations = np.diff(ts)
+    low = lv[:-1] == 0
+    syncs = np.flatnonzero(low & (durations > 10 * np.median(durations)))
+    if not len(syncs):
+        return empty + (0, )
+
+    # A frame starts right after the previous sync or at the first high
+    first = int(np.argmax(lv == 1))
+    starts = np.concatenate(([first], syncs[:-1] + 1))
+    candidates = (syncs - starts) == FRAME_PULSES - 1
+    starts, syncs = starts[candidates], syncs[candidates]
+    rest = int(syncs[-1] + 1) if len(syncs) else 0
+    if not len(syncs):
+        return empty + (rest, )
+
+    frames = durations[starts[:, None] + np.arange(FRAME_PULSES - 2)]
+    highs, lows = frames[:, 0::2], frames[:, 1::2]
+    unit = durations[syncs] / SYNC_UNITS
+    pair = (highs + lows) / (4 * unit[:, None])
+    valid = np.all(np.abs(pair - 1) <= tolerance, axis=1)
+    valid &= np.abs(durations[syncs - 1] / unit - 1) <= 2 * tolerance + .2
+    valid &= lv[starts] == 1
+    words = (highs > lows)[valid].astype(np.int64) @ WEIGHTS
+    return words, ts[starts][valid], unit[valid], rest
+
+
+def encode_word(word, pulse_length=RC433Switch.PULSE_LENGTH, start=0.):
+    """
+    Builds the edges of a single frame for the given 24 bit word, which is
+    the inverse of `decode_pulses`.
+    Returns:
+        Returns the edge timestamps (microseconds) and levels.
+    """
+    bits = (np.asarray(word, dtype=np.int64) & WEIGHTS) > 0
+    units = np.empty(FRAME_PULSES)
+    units[0:-2:2] = np.where(bits, 3, 1)
+    units[1:-2:2] = np.where(bits, 1, 3)
+    units[-2:] = (1, SYNC_UNITS)
+    ts = start + np.concatenate(([0.], np.cumsum(units * pulse_length)))
+    levels = np.empty(FRAME_PULSES + 1, dtype=np.int8)
+    levels[0::2], levels[1::2] = 1, 0
+    return ts, levels
+
+
+def system_word(system_code, device_code, state):
+    """
+    Encodes a `SystemDevice` command the way `RC433Switch._toggle` radiates
+    it into a 24 bit word.
+    """
+    letter = RC433Switch.DEVICE_LETTER[device_code]
+    symbols = [0 if c == '1' else 1 for c in system_code]
+    symbols += [0 if letter & (1 << i) else 1 for i in range(5)]
+    symbols += [0, 1] if state == 'on' else [1, 0]
+    return sum(s << (22 - 2 * i) for i, s in enumerate(symbols))
+
+
+def system_command(word):
+    """
+    Interprets a 24 bit word as tri-state `SystemDevice` command.
+    Returns:
+        Returns a tuple (system_code, device_code, state) or None if the
+        word is no valid command.
+    Example:
+        >>> system_command(system_word('10100', 'A', 'on'))
+        ('10100', 'A', 'on')
+    """
+    symbols = [(int(word) >> (22 - 2 * i)) & 3 for i in range(12)]
+    if any(s > 1 for s in symbols):
+        return None
+    system_code = ''.join('1' if s == 0 else '0' for s in symbols[:5])
+    letter = sum(1 << i for i, s in enumerate(symbols[5:10]) if s == 0)
+    device_codes = [
+        k for k, v in RC433Switch.DEVICE_LETTER.items() if v == letter
+    ]
+    state = {(0, 1): 'on', (1, 0): 'off'}.get(tuple(symbols[10:]))
+    if not device_codes or state is None:
+        return None
+    return system_code, device_codes[0], state
+
+
+def load_capture(file_name):
+    """
+    Loads a capture file of edges, either a `.npy` array or a text file
+    with one `<timestamp in microseconds> <level>` pair per line.
+    Returns:
+        Returns the timestamps and levels as numpy arrays.
+    """
+    if file_name.endswith('.npy'):
+        data = np.load(file_name)
+    else:
+        data = np.loadtxt(file_name, ndmin=2)
+    return data[:, 0], data[:, 1].astype(np.int8)
+
+
+def save_capture(file_name, timestamps, levels):
+    """Writes edges in the format read by `load_capture`."""
+    data = np.column_stack((timestamps, levels))
+    if file_name.endswith('.npy'):
+        np.save(file_name, data)
+    else:
+        np.savetxt(file_name, data, fmt=['%.1f', '%d'])
+
+
+@attr.s
+class DeviceLearner(LogMixin):
+    """
+    Appends unknown remote codes as new devices to a devices json file.
+    `SystemDevice` commands are learned from a single frame. Plain codes are
+    learned in pairs, the first unknown code is taken as `code_on` and the
+    next different one as `code_off`.
+    """
+    file_name = attr.ib(converter=str)
+    pending_code = attr.ib(default=None, init=False)
+
+    def learn(self, word):
+        """
+        Learns the given word.
+        Returns:
+            Returns a tuple (device_name, props) if a new device was learned;
+            otherwise None.
+        """
+        command = system_command(word)
+        if command is not None:
+            system_code, device_code, _ = command
+            name = 'learned_{}_{}'.format(system_code, device_code)
+            props = dict(system_code=system_code, device_code=device_code)
+        elif self.pending_code is None or self.pending_code == word:
+            self.pending_code = word
+            return None
+        else:
+            name = 'learned_{}'.format(self.pending_code)
+            props = dict(code_on=self.pending_code, code_off=int(word))
+            self.pending_code = None
+        return self._append(name, props)
+
+    def _append(self, name, props):
+        with open(self.file_name, 'r') as fp:
+            devices = json.load(fp)
+        if name in devices:
+            return None
+        devices[name] = props
+        tmp_name = self.file_name + '.tmp'
+        with open(tmp_name, 'w') as fp:
+            json.dump(devices, fp, indent=4)
+        os.replace(tmp_name, self.file_name)
+        self.logger.info("Learned device '{}': {}".format(name, props))
+        return name, props
+
+
+@attr.s
+class RC433Receiver(LogMixin):
+    """
+    Decodes received frames and maps them to the devices of a
+    `DeviceRegistry`. The state of known devices is updated and `on_state`
+    is called with the device and its new state ('on' or 'off'); unknown
+    codes are passed to the optional `learner`.
+    Example:
+        >>> rx = RC433Receiver(registry, on_state=print)
+        >>> rx.feed(*load_capture('capture.txt'))
+    """
+    # Repeated frames within this interval (microseconds) are one press
+    REPEAT_INTERVAL = 250000
+
+    registry = attr.ib()
+    on_state = attr.ib(default=None)
+    learner = attr.ib(default=None)
+    _codes = attr.ib(default=None, init=False, repr=False)
+    _systems = attr.ib(default=None, init=False, repr=False)
+    _last = attr.ib(default=(None, float('-inf')), init=False, repr=False)
+    _ts = attr.ib(default=attr.Factory(lambda: np.empty(0)), init=False,
+                  repr=False)
+    _levels = attr.ib(default=attr.Factory(lambda: np.empty(0, np.int8)),
+                      init=False, repr=False)
+
+    def _init_lookup(self):
+        self._codes, self._systems = dict(), dict()
+        for stateful in self.registry.list():
+            device = stateful.device
+            if isinstance(device, CodeDevice):
+                self._codes[device.code_on] = (device, 'on')
+                self._codes[device.code_off] = (device, 'off')
+            elif isinstance(device, SystemDevice):
+                key = (device.system_code, device.device_code)
+                self._systems[key] = device
+
+    def lookup(self, word):
+        """
+        Maps a decoded word to a device command.
+        Returns:
+            Returns a tuple (device, state) or None for unknown words.
+        """
+        if self._codes is None:
+            self._init_lookup()
+        if int(word) in self._codes:
+            return self._codes[int(word)]
+        command = system_command(word)
+        if command is not None:
+            device = self._systems.get(command[:2])
+            if device is not None:
+                return device, command[2]
+        return None
+
+    def feed(self, timestamps, levels):
+        """
+        Decodes a chunk of edges. Edges of a frame which is still in
+        progress are kept and decoded together with the next chunk.
+        Returns:
+            Returns a list of (device or None, state or word) tuples, one
+            for every recognized button press.
+        """
+        ts = np.concatenate((self._ts, np.asarray(timestamps, np.float64)))
+        lv = np.concatenate((self._levels, np.asarray(levels, np.int8)))
+        words, starts, _, rest = decode_pulses(ts, lv)
+        if rest == 0 and len(ts) > 4 * FRAME_PULSES:
+            # Noise only, just keep enough edges for a single frame
+            rest = len(ts) - FRAME_PULSES
+        self._ts, self._levels = ts[rest:], lv[rest:]
+
+        pressed = list()
+        for word, start in zip(words.tolist(), starts.tolist()):
+            last_word, last_start = self._last
+            self._last = (word, start)
+            if word == last_word and \
+                    start - last_start < RC433Receiver.REPEAT_INTERVAL:
+                continue
+            pressed.append(self._handle(word))
+        return pressed
+
+    def _handle(self, word):
+        match = self.lookup(word)
+        if match is None:
+            self.logger.info("Received unknown code {}".format(word))
+            if self.learner is not None and self.learner.learn(word):
+                self._reload()
+            return None, word
+
+        device, state = match
+        self.logger.info(
+            "Received '{}' for device '{}'".format(state, device.device_name)
+        )
+        self.registry.switch(device.device_name, state == 'on')
+        if self.on_state is not None:
+            self.on_state(device, state)
+        return device, state
+
+    def _reload(self):
+        store = self.registry.device_store
+        if hasattr(store, 'device_dict') and self.learner is not None:
+            with open(self.learner.file_name, 'r') as fp:
+                store.device_dict = json.load(fp)
+            store.devices = None
+        self._codes = None
+
+
+@attr.s
+class GPIOEdgeSource(LogMixin):
+    """
+    Records the edges on a GPIO pin connected to a 433mhz receiver and
+    passes them in chunks to `RC433Receiver.feed` from a background thread.
+    """
+    receiver = attr.ib(validator=attr.validators.instance_of(RC433Receiver))
+    pin = attr.ib(default=27, converter=int)
+    interval = attr.ib(default=0.1, converter=float)
+    _edges = attr.ib(default=attr.Factory(deque), init=False, repr=False)
+    _running = attr.ib(default=False, init=False, repr=False)
+    _thread = attr.ib(default=None, init=False, repr=False)
+
+    def _edge(self, channel):
+        self._edges.append((time.perf_counter() * 1e6, GPIO.input(channel)))
+
+    def start(self):
+        GPIO.setmode(RC433Switch.GPIOMode)
+        GPIO.setup(self.pin, GPIO.IN)
+        GPIO.add_event_detect(self.pin, GPIO.BOTH, callback=self._edge)
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name=self.__class__.__name__, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        GPIO.remove_event_detect(self.pin)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+            edges = [self._edges.popleft() for _ in range(len(self._edges))]
+            if edges:
+                data = np.asarray(edges)
+                self.receiver.feed(data[:, 0], data[:, 1])
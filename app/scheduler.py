@@ -0,0 +1,405 @@
+"""
+Delayed and recurring switch commands.
+
+Jobs are set on the topic `rc433/$schedule/set` with a json payload, one job
+per message:
+
+    {"id": "bed-off", "device": "sf_bedroom_bed", "state": "off", "delay": 1800}
+    {"id": "evening", "device": "ff_floor_tree", "state": "on", "daily": "18:00"}
+    {"id": "pump", "device": "gf_pump", "state": "on", "every": 3600, "at": 0}
+    {"cancel": "bed-off"}
+
+A job is due after `delay` seconds or `at` a unix time, then again `every`
+seconds or `daily` at a local time. Instead of a `device` the `topic` of its
+switch can be given. Setting a job with an existing id replaces the job.
+
+The pending jobs are kept in a heap ordered by their due time, so adding a
+job is O(log n). Cancelled and replaced jobs stay in the heap until they
+come up and are skipped, the heap is rebuilt once most entries are stale.
+Due jobs are passed to `Gateway.dispatch` like any other command. The jobs
+are saved to a json file when they are added, cancelled or done (at most
+once per `save_interval` seconds) and loaded on start; firing a recurring
+job does not rewrite the file, its next due time is worked out on load.
+One-shot jobs missed by more than `grace` seconds while the gateway was
+down are dropped, recurring ones continue with their next due time.
+
+In a cluster every node keeps all jobs, but only the owner of a device fires
+its jobs, so they continue on another node when the owner fails.
+"""
+
+import datetime
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+import attr
+from schema import And, Optional, Or, Regex, Schema, SchemaError, Use
+
+from .cluster import device_of
+from .gateway import STATE_SCHEMA
+from .loadgen import device_topics
+from .util import LogMixin, percentile
+
+SCHEDULE_TOPIC = 'rc433/$schedule/set'
+
+JOB_SCHEMA = Schema(Or(
+    {'cancel': str},
+    {
+        Optional('id'): str,
+        Optional('device'): str,
+        Optional('topic'): str,
+        'state': STATE_SCHEMA,
+        Optional('delay'): And(Use(float), math.isfinite, lambda n: n >= 0),
+        Optional('at'): And(Use(float), math.isfinite),
+        Optional('every'): And(Use(float), math.isfinite, lambda n: n > 0),
+        Optional('daily'): Regex(r'^([01]\d|2[0-3]):[0-5]\d$')
+    }
+))
+
+
+def next_daily(daily, now):
+    """The next unix time after `now` of a local time of day 'HH:MM'."""
+    hour, minute = (int(part) for part in daily.split(':'))
+    today = datetime.datetime.fromtimestamp(now)
+    due = today.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due.timestamp() <= now:
+        due += datetime.timedelta(days=1)
+    return due.timestamp()
+
+
+@attr.s
+class Job(object):
+    """A switch command due at a unix time, optionally recurring."""
+    id = attr.ib()
+    topic = attr.ib()
+    state = attr.ib()
+    due = attr.ib(converter=float)
+    every = attr.ib(default=None)
+    daily = attr.ib(default=None)
+    fired = attr.ib(default=0)
+
+    @property
+    def recurring(self):
+        return self.every is not None or self.daily is not None
+
+    def advance(self, now):
+        """Moves the due time of a recurring job past `now`."""
+        if self.daily is not None:
+            self.due = next_daily(self.daily, now)
+        elif self.due <= now:
+            # Occurrences missed in the meantime are skipped
+            self.due += (int((now - self.due) // self.every) + 1) * self.every
+
+
+@attr.s
+class Scheduler(LogMixin):
+    """
+    Fires delayed and recurring switch commands into the `dispatch`
+    callable, e.g. `Gateway.dispatch`.
+    Example:
+        >>> scheduler = Scheduler(gateway.dispatch, topics, path='jobs.json')
+        >>> scheduler.start()
+        >>> mqs.add_callback(SCHEDULE_TOPIC, scheduler.handle_control, qos=1)
+        >>> scheduler.add('sf_bedroom_bed', 'off', delay=1800)
+        >>> # in a cluster
+        >>> Scheduler(gateway.dispatch, topics, owns=mqs.membership.owns)
+    """
+    SCHEMA = Schema({
+        Optional('path'): str,
+        Optional('grace'): And(Use(float), lambda n: n >= 0),
+        Optional('save_interval'): And(Use(float), lambda n: n >= 0),
+        Optional('max_jobs'): And(Use(int), lambda n: n > 0)
+    })
+
+    dispatch = attr.ib(repr=False)
+    # Switch topics of the consumer config, to look up device names
+    topics = attr.ib(default=(), converter=list, repr=False)
+    path = attr.ib(default=None)
+    grace = attr.ib(default=60., converter=float)
+    save_interval = attr.ib(default=1., converter=float)
+    max_jobs = attr.ib(default=100000, converter=int)
+    clock = attr.ib(default=time.time, repr=False)
+    # Whether this node switches a device, by its name; all if not given
+    owns = attr.ib(default=None, repr=False)
+    jobs = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    counters = attr.ib(default=attr.Factory(lambda: defaultdict(int)),
+                       init=False)
+    lateness = attr.ib(default=attr.Factory(lambda: deque(maxlen=1000)),
+                       init=False, repr=False)
+    _heap = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    _seq = attr.ib(default=attr.Factory(itertools.count), init=False,
+                   repr=False)
+    _switch_topics = attr.ib(default=None, init=False, repr=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), init=False,
+                    repr=False)
+    _dirty = attr.ib(default=False, init=False, repr=False)
+    _saved = attr.ib(default=0., init=False, repr=False)
+    _worker = attr.ib(default=None, init=False, repr=False)
+    _running = attr.ib(default=False, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._switch_topics = {
+            device: switch
+            for device, (switch, _) in device_topics(self.topics).items()
+        }
+
+    @classmethod
+    def from_json(cls, dispatch, topics, config, owns=None):
+        """
+        Creates the scheduler from the `scheduler` section of a client
+        config.
+        """
+        return cls(dispatch, topics, owns=owns, **cls.SCHEMA.validate(config))
+
+    def add(self, target, state, delay=None, at=None, every=None, daily=None,
+            job_id=None):
+        """
+        Schedules a command, replacing a job with the same id.
+        Args:
+            target (str): name of the device or its switch topic
+            state (str): 'on' or 'off'
+            delay (float): due in so many seconds
+            at (float): due at this unix time
+            every (float): repeats every so many seconds
+            daily (str): repeats every day at this local time, 'HH:MM'
+            job_id (str): id to cancel the job, generated if not given
+        Returns:
+            Returns the `Job`.
+        Raises:
+            ValueError: if the device is unknown or the time is missing or
+                not finite
+        """
+        topic = target if '/' in target else self._switch_topics.get(target)
+        if topic is None:
+            raise ValueError("Unknown device '{}'".format(target))
+        now = self.clock()
+        if at is None and delay is None and every is None and daily is None:
+            raise ValueError("A job needs `delay`, `at`, `every` or `daily`")
+        if not all(math.isfinite(n) for n in (at, delay, every)
+                   if n is not None):
+            raise ValueError("The times of a job must be finite")
+        if at is not None:
+            due = at
+        elif delay is not None:
+            due = now + delay
+        elif every is not None:
+            due = now + every
+        else:
+            due = next_daily(daily, now)
+        job = Job(
+            id=job_id or uuid.uuid4().hex, topic=topic,
+            state=STATE_SCHEMA.validate(state), due=due, every=every,
+            daily=daily
+        )
+        if job.recurring:
+            job.advance(now)
+        with self._cond:
+            if job.id not in self.jobs and len(self.jobs) >= self.max_jobs:
+                raise ValueError("Too many jobs ({})".format(self.max_jobs))
+            self.jobs[job.id] = job
+            self._push(job)
+            self.counters['added'] += 1
+            self._dirty = True
+            self._compact()
+            self._cond.notify()
+        return job
+
+    def cancel(self, job_id):
+        """Cancels a job, returns False if there is none with the id."""
+        with self._cond:
+            job = self.jobs.pop(job_id, None)
+            if job is None:
+                return False
+            self.counters['cancelled'] += 1
+            self._dirty = True
+            self._compact()
+            self._cond.notify()
+        return True
+
+    def pending(self):
+        """The jobs ordered by their due time."""
+        with self._cond:
+            return sorted(self.jobs.values(), key=lambda job: job.due)
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.due, next(self._seq), job))
+
+    def _compact(self):
+        # Entries of cancelled or replaced jobs are dropped lazily
+        if len(self._heap) > 2 * len(self.jobs) + 64:
+            self._heap = [
+                entry for entry in self._heap if self._valid(entry)
+            ]
+            heapq.heapify(self._heap)
+
+    def _valid(self, entry):
+        due, _, job = entry
+        return self.jobs.get(job.id) is job and job.due == due
+
+    def _pop_due(self, now):
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if not self._valid(entry):
+                    continue
+                job = entry[2]
+                due.append((job, entry[0]))
+                job.fired += 1
+                if job.recurring:
+                    # Not saved, `load` advances it again
+                    job.advance(now)
+                    self._push(job)
+                else:
+                    del self.jobs[job.id]
+                    self._dirty = True
+        return due
+
+    def run_pending(self, now=None):
+        """
+        Fires the jobs which are due, skipping those of devices owned by
+        another node.
+        Returns:
+            Returns the number of jobs due.
+        """
+        now = self.clock() if now is None else now
+        due = self._pop_due(now)
+        for job, at in due:
+            if self.owns is not None and not self.owns(device_of(job.topic)):
+                self.counters['not_owned'] += 1
+                continue
+            self.lateness.append(self.clock() - at)
+            self.logger.info("Job '%s' switches %s %s", job.id, job.topic,
+                             job.state)
+            if self.dispatch(job.topic, job.state):
+                self.counters['fired'] += 1
+            else:
+                self.counters['failed'] += 1
+        return len(due)
+
+    def handle_control(self, client, userdata, message):
+        """Callback for the schedule topic, see the module for the payload."""
+        try:
+            command = JOB_SCHEMA.validate(json.loads(message.payload))
+            if 'cancel' in command:
+                if not self.cancel(command['cancel']):
+                    self.logger.warning("No job '%s' to cancel",
+                                        command['cancel'])
+                return
+            target = command.get('topic', command.get('device'))
+            if target is None:
+                raise ValueError("A job needs a `device` or `topic`")
+            self.add(
+                target, command['state'], delay=command.get('delay'),
+                at=command.get('at'), every=command.get('every'),
+                daily=command.get('daily'), job_id=command.get('id')
+            )
+        except (ValueError, SchemaError) as why:
+            self.counters['invalid'] += 1
+            self.logger.warning("Invalid job '%s': %s", message.payload, why)
+
+    def save(self):
+        """Writes the jobs to `path` atomically."""
+        if self.path is None:
+            return
+        with self._cond:
+            jobs = [attr.asdict(job) for job in self.jobs.values()]
+            self._dirty = False
+            self._saved = time.monotonic()
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as fp:
+            json.dump(jobs, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """
+        Restores the jobs saved to `path`.
+        Returns:
+            Returns the number of jobs restored.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'r') as fp:
+            jobs = [Job(**job) for job in json.load(fp)]
+        now = self.clock()
+        with self._cond:
+            for job in jobs:
+                if job.recurring:
+                    job.advance(now)
+                elif job.due < now - self.grace:
+                    self.counters['missed'] += 1
+                    self.logger.warning("Dropped job '%s' due at %s", job.id,
+                                        time.ctime(job.due))
+                    continue
+                self.jobs[job.id] = job
+                self._push(job)
+            self._cond.notify()
+        return len(self.jobs)
+
+    def start(self):
+        if self._running:
+            return
+        self.load()
+        self._running = True
+        self._worker = threading.Thread(
+            target=self._run, name='scheduler', daemon=True
+        )
+        self._worker.start()
+
+    def stop(self, timeout=5.):
+        """Stops the worker and saves the jobs."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+        self.save()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                # Wakes up at least once a minute to follow clock changes
+                timeout = 60.
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - self.clock())
+                if self._dirty:
+                    timeout = min(
+                        timeout,
+                        self._saved + self.save_interval - time.monotonic()
+                    )
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+            self.run_pending()
+            if self._dirty and \
+                    time.monotonic() - self._saved >= self.save_interval:
+                try:
+                    self.save()
+                except OSError:
+                    self._dirty = True
+                    self.logger.exception("Could not save the jobs")
+
+    def stats(self):
+        """
+        Returns:
+            Returns the counters, the number of pending jobs and the p99 and
+            max lateness of the fired jobs in seconds.
+        """
+        lateness = list(self.lateness)
+        res = dict(self.counters)
+        res['pending'] = len(self.jobs)
+        res['late_p99'] = percentile(lateness, 99)
+        res['late_max'] = max(lateness) if lateness else None
+        return res
@@ -0,0 +1,372 @@
+"""
+Recording GPIO/RF simulator for tests and benchmarks.
+
+The simulator stands in for `RPi.GPIO` and `rpi_rf.RFDevice`: every
+`GPIO.output` edge and every `tx_code` call is recorded with a nanosecond
+timestamp. Afterwards the edges of each command are decoded into frames
+(see `app.receiver.decode_pulses`) and compared with the nominal timing,
+which shows what would have been radiated and how long it took.
+
+With the default virtual clock `sleep` only advances the clock, so the
+timing is exact and a command takes no real time (for verifying encoders).
+With `realtime=True` the real clock and `time.sleep` are used, the report
+then shows the timing deviations of bit-banging from Python on this box.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import attr
+import numpy as np
+
+from .backend import GPIOBackend
+from .device import StatefulDevice
+from .rc433 import RC433Code, RC433Factory, RC433Switch
+from .receiver import BITS, FRAME_PULSES, SYNC_UNITS, decode_pulses, \
+    encode_word
+from .util import LogMixin
+
+# Pulse lengths of a whole frame: the data bits and the sync
+FRAME_UNITS = 4 * BITS + 1 + SYNC_UNITS
+
+
+@attr.s
+class VirtualClock(object):
+    """Clock which is advanced by `sleep` only."""
+    now = attr.ib(default=0, converter=int)
+
+    def time_ns(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += int(round(seconds * 1e9))
+
+
+@attr.s
+class RealClock(object):
+    """The monotonic high-resolution clock and `time.sleep`."""
+
+    def time_ns(self):
+        return time.perf_counter_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+@attr.s
+class Command(object):
+    """Edges and `tx_code` calls recorded for a single command."""
+    name = attr.ib()
+    pulse_length = attr.ib(default=None)
+    # nominal time on air in seconds
+    nominal = attr.ib(default=None)
+    start = attr.ib(default=None)
+    end = attr.ib(default=None)
+    edges = attr.ib(default=attr.Factory(list), repr=False)
+    tx_calls = attr.ib(default=attr.Factory(list), repr=False)
+
+
+class SimulatedGPIO(object):
+    """
+    Drop-in for the `RPi.GPIO` module which records the output edges.
+    """
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+    BOTH = 33
+    PUD_DOWN = 21
+
+    def __init__(self, simulator):
+        self._simulator = simulator
+        self.mode = None
+        self.outputs = set()
+        self.levels = dict()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, **kwargs):
+        if direction == self.OUT:
+            self.outputs.add(pin)
+
+    def output(self, pin, level):
+        if pin not in self.outputs:
+            raise RuntimeError(
+                "The GPIO channel {} has not been set up as an OUTPUT".format(
+                    pin)
+            )
+        level = int(bool(level))
+        if self.levels.get(pin, self.LOW) != level:
+            self._simulator.record_edge(pin, level)
+        self.levels[pin] = level
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, **kwargs):
+        pass
+
+    def remove_event_detect(self, pin):
+        pass
+
+    def cleanup(self, channel=None):
+        """Resets the channel, all channels if none is given."""
+        if channel is None:
+            self.outputs.clear()
+            self.levels.clear()
+        else:
+            self.outputs.discard(channel)
+            self.levels.pop(channel, None)
+
+
+@attr.s
+class SimulatedRFDevice(LogMixin):
+    """
+    Drop-in for `rpi_rf.RFDevice` which radiates protocol 1 frames through
+    the simulated GPIO, with the same defaults as rpi_rf.
+    """
+    # (pulse length, sync, zero, one) in pulse lengths, as in rpi_rf
+    PROTOCOLS = {1: (350, (1, 31), (1, 3), (3, 1))}
+
+    simulator = attr.ib(repr=False)
+    gpio = attr.ib(default=17, converter=int)
+    tx_proto = attr.ib(default=1, converter=int)
+    tx_pulselength = attr.ib(default=None)
+    tx_repeat = attr.ib(default=10, converter=int)
+    tx_length = attr.ib(default=24, converter=int)
+    tx_enabled = attr.ib(default=False, init=False)
+
+    def enable_tx(self):
+        self.simulator.gpio.setup(self.gpio, self.simulator.gpio.OUT)
+        self.tx_enabled = True
+        return True
+
+    def disable_tx(self):
+        if self.tx_enabled:
+            self.simulator.gpio.cleanup(self.gpio)
+        self.tx_enabled = False
+        return True
+
+    def cleanup(self):
+        self.disable_tx()
+        self.simulator.gpio.cleanup()
+
+    def tx_code(self, code, tx_proto=None, tx_pulselength=None,
+                tx_length=None):
+        """Sends the code `tx_repeat` times, records the call."""
+        proto = tx_proto or self.tx_proto
+        if not self.tx_enabled or proto not in self.PROTOCOLS:
+            self.logger.error("Cannot send code %s (protocol %s)", code, proto)
+            return False
+        default_length, sync, zero, one = self.PROTOCOLS[proto]
+        pulse_length = tx_pulselength or self.tx_pulselength or \
+            default_length
+        length = tx_length or self.tx_length
+        self.simulator.record_tx(self.gpio, code, pulse_length, length)
+
+        units = []
+        for i in range(length - 1, -1, -1):
+            units.extend(one if code >> i & 1 else zero)
+        units.extend(sync)
+        pulses = [
+            (self.gpio, (i + 1) % 2, n * pulse_length)
+            for i, n in enumerate(units)
+        ]
+        return self.simulator.play(pulses * self.tx_repeat)
+
+
+@attr.s
+class Simulator(LogMixin):
+    """
+    Records what the services would radiate and reports it per command.
+    Example:
+        >>> sim = Simulator()
+        >>> report = sim.switch(device, 'on')
+        >>> report['frames'], report['on_air']
+        (10, 0.384)
+    """
+    realtime = attr.ib(default=False)
+    clock = attr.ib(default=None, repr=False)
+    commands = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    gpio = attr.ib(default=None, init=False, repr=False)
+    _current = attr.ib(default=None, init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+
+    def __attrs_post_init__(self):
+        if self.clock is None:
+            self.clock = RealClock() if self.realtime else VirtualClock()
+        self.gpio = SimulatedGPIO(self)
+
+    def record_edge(self, pin, level):
+        now = self.clock.time_ns()
+        with self._lock:
+            self._command().edges.append((now, pin, level))
+
+    def record_tx(self, pin, code, pulse_length, length):
+        now = self.clock.time_ns()
+        with self._lock:
+            command = self._command()
+            command.tx_calls.append((now, pin, code, pulse_length, length))
+            if command.pulse_length is None:
+                command.pulse_length = pulse_length
+
+    def _command(self):
+        # Edges outside of `command` get a command of their own
+        if self._current is None:
+            self.commands.append(Command(name=None, start=self.clock.time_ns()))
+            self._current = self.commands[-1]
+        return self._current
+
+    def play(self, pulses):
+        """Outputs pulses `(pin, level, duration in microseconds)`."""
+        for pin, level, duration in pulses:
+            self.gpio.output(pin, level)
+            if duration:
+                self.clock.sleep(duration / 1000000.)
+        return True
+
+    def backend(self):
+        """A `GPIOBackend` driving the simulated GPIO."""
+        return GPIOBackend(gpio=self.gpio, sleep=self.clock.sleep)
+
+    def rf_device(self, pin, **kwargs):
+        """Factory for `RC433Code.rf_factory`."""
+        return SimulatedRFDevice(self, pin, **kwargs)
+
+    def service(self, device, pin=17):
+        """Creates the `RC433Service` of the device wired to the simulator."""
+        svc = RC433Factory.service(device)
+        if svc is RC433Code:
+            return RC433Code(pin=pin, rf_factory=self.rf_device)
+        return svc(pin=pin, backend=self.backend())
+
+    @contextmanager
+    def command(self, name, pulse_length=None, nominal=None):
+        """Groups the edges recorded within the block as one command."""
+        command = Command(
+            name=name, pulse_length=pulse_length, nominal=nominal,
+            start=self.clock.time_ns()
+        )
+        with self._lock:
+            self.commands.append(command)
+            self._current = command
+        try:
+            yield command
+        finally:
+            with self._lock:
+                command.end = self.clock.time_ns()
+                self._current = None
+
+    def switch(self, device, state, pin=17):
+        """
+        Switches the device through its service and the simulator.
+        Returns:
+            Returns the report of the command.
+        """
+        svc = self.service(device, pin=pin)
+        name = device.device_name
+        if isinstance(device, StatefulDevice):
+            name = device.device.device_name
+        pulse_length = None
+        if isinstance(svc, RC433Switch):
+            pulse_length = RC433Switch.PULSE_LENGTH
+        with self.command('{} {}'.format(name, state), pulse_length,
+                          svc.airtime(device)) as cmd:
+            svc.switch(device=device, state=state)
+        return self.analyze(cmd)
+
+    def analyze(self, command):
+        """
+        Decodes the frames of a command and compares them with the nominal
+        timing.
+        Returns:
+            Returns a dict with the number of edges, `tx_code` calls and
+            frames, the decoded words, the time on air and the nominal time
+            on air (of the service or the decoded frames) in seconds, the
+            overrun of the former and the mean and maximum deviation of the
+            pulses from their nominal length in microseconds.
+        """
+        res = dict(
+            name=command.name, edges=len(command.edges),
+            tx_calls=len(command.tx_calls), frames=0, words=[],
+            on_air=0., nominal=0., overrun=0.,
+            deviation_mean=None, deviation_max=None
+        )
+        if not command.edges:
+            return res
+        end = command.end if command.end is not None else \
+            self.clock.time_ns()
+        ts = np.array([t for t, _, _ in command.edges] + [end]) / 1000.
+        levels = np.array([lv for _, _, lv in command.edges] + [1])
+        words, starts, units, _ = decode_pulses(ts, levels)
+        pulse_length = command.pulse_length or (
+            float(np.median(units)) if len(units) else None
+        )
+        res['frames'] = len(words)
+        res['words'] = words.tolist()
+        res['on_air'] = (ts[-1] - ts[0]) / 1e6
+        if pulse_length is None:
+            return res
+        res['nominal'] = command.nominal
+        if res['nominal'] is None:
+            res['nominal'] = len(words) * FRAME_UNITS * pulse_length / 1e6
+        res['overrun'] = res['on_air'] - res['nominal']
+
+        durations = np.diff(ts)
+        deviations = []
+        for word, start in zip(words, starts):
+            idx = int(np.searchsorted(ts, start))
+            expected = np.diff(encode_word(word, pulse_length)[0])
+            actual = durations[idx:idx + FRAME_PULSES]
+            deviations.append(np.abs(actual - expected))
+        if deviations:
+            deviations = np.concatenate(deviations)
+            res['deviation_mean'] = float(deviations.mean())
+            res['deviation_max'] = float(deviations.max())
+        return res
+
+    def report(self):
+        """The analysis of all recorded commands."""
+        return [self.analyze(command) for command in self.commands]
+
+    def reset(self):
+        with self._lock:
+            self.commands = list()
+            self._current = None
+
+
+def main(argv=None):
+    """
+    Switches every configured device on and off through the simulator and
+    prints the reports, e.g. `python -m app.simulator --realtime`.
+    """
+    import argparse
+    import json
+
+    from .device import DeviceDict
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--devices', default='conf/devices.json')
+    parser.add_argument('--realtime', action='store_true',
+                        help='sleep for real and measure the deviations')
+    args = parser.parse_args(argv)
+
+    sim = Simulator(realtime=args.realtime)
+    store = DeviceDict.from_json(args.devices)
+    for device in store.list():
+        for state in ('on', 'off'):
+            report = sim.switch(device, state)
+            report.pop('words')
+            print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
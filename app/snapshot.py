@@ -0,0 +1,203 @@
+"""
+Aggregated device states for dashboards.
+
+Besides the retained `.../state` topic per device the gateway maintains
+  * `rc433/$state/snapshot`: a single retained message with the states of
+    all devices
+  * `rc433/$state/delta`: the changes, coalesced over a short window
+
+Both carry a sequence number and the epoch (start time) of the gateway:
+
+    {"epoch":1546340400,"seq":42,"states":{"gf_lamp":"on","ff_tree":"off"}}
+
+A client reads the snapshot and applies the deltas with a higher sequence
+number. A gap in the sequence or a new epoch means it has to resynchronise
+with the snapshot.
+
+After a restart the aggregator only knows the devices switched since then.
+With `seed` it takes the other states from the retained snapshot of the
+previous run and holds its own snapshot back until that arrived (or
+`seed_timeout` passed), so the retained snapshot never loses devices.
+"""
+
+import json
+import threading
+import time
+
+import attr
+from schema import And, Optional, Schema, Use
+
+from .util import LogMixin
+
+SNAPSHOT_TOPIC = 'rc433/$state/snapshot'
+DELTA_TOPIC = 'rc433/$state/delta'
+
+
+@attr.s
+class StateAggregator(LogMixin):
+    """
+    Collects the state changes of the devices and publishes them as delta
+    every `window` seconds at most, followed by the updated snapshot.
+    Example:
+        >>> aggregator = StateAggregator(publisher)
+        >>> aggregator.start()
+        >>> aggregator.update('gf_lamp', 'on')
+    """
+    SCHEMA = Schema({
+        Optional('topic'): str,
+        Optional('delta_topic'): str,
+        Optional('window'): And(Use(float), lambda n: n >= 0),
+        Optional('seed_timeout'): And(Use(float), lambda n: n >= 0)
+    })
+
+    publisher = attr.ib(repr=False)
+    topic = attr.ib(default=SNAPSHOT_TOPIC)
+    delta_topic = attr.ib(default=DELTA_TOPIC)
+    window = attr.ib(default=0.1, converter=float)
+    # seconds to wait for the retained snapshot when seeding
+    seed_timeout = attr.ib(default=5., converter=float)
+    epoch = attr.ib(default=attr.Factory(lambda: int(time.time())))
+    states = attr.ib(default=attr.Factory(dict), init=False)
+    seq = attr.ib(default=0, init=False)
+    pending = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    counters = attr.ib(default=attr.Factory(lambda: dict(
+        updates=0, unchanged=0, coalesced=0, deltas=0
+    )), init=False)
+    _due = attr.ib(default=None, init=False, repr=False)
+    # `time.monotonic()` until the snapshot is held back for the seed
+    _seeding = attr.ib(default=None, init=False, repr=False)
+    _held = attr.ib(default=False, init=False, repr=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), init=False,
+                    repr=False)
+    _worker = attr.ib(default=None, init=False, repr=False)
+    _running = attr.ib(default=False, init=False, repr=False)
+
+    @classmethod
+    def from_json(cls, publisher, config):
+        """
+        Creates the aggregator from the `snapshot` section of a client
+        config.
+        """
+        return cls(publisher, **cls.SCHEMA.validate(config))
+
+    def seed(self, subscriber):
+        """
+        Seeds the states from the retained snapshot, received through the
+        subscriber.
+        """
+        with self._cond:
+            self._seeding = time.monotonic() + self.seed_timeout
+        subscriber.add_callback(self.topic, self.handle_snapshot)
+
+    def handle_snapshot(self, client, userdata, message):
+        """Callback for the retained snapshot of the previous run."""
+        with self._cond:
+            if self._seeding is None:
+                # Our own snapshots
+                return
+            try:
+                states = json.loads(message.payload)['states']
+                for device, state in states.items():
+                    # Changes since the restart are newer
+                    self.states.setdefault(device, str(state).lower())
+                self.counters['seeded'] = len(states)
+            except (ValueError, KeyError, TypeError, AttributeError) as why:
+                self.logger.warning("Invalid retained snapshot: %s", why)
+            self._seeding = None
+        self.flush()
+
+    def _ready(self):
+        if self._seeding is not None and time.monotonic() >= self._seeding:
+            self.logger.warning("No retained snapshot to seed the states")
+            self._seeding = None
+        return self._seeding is None
+
+    def update(self, device, state):
+        """Records the state of a device, published with the next delta."""
+        state = state.lower()
+        with self._cond:
+            self.counters['updates'] += 1
+            if device in self.pending:
+                self.counters['coalesced'] += 1
+            elif self.states.get(device) == state:
+                self.counters['unchanged'] += 1
+                return
+            if not self.pending:
+                self._due = time.monotonic() + self.window
+            self.pending[device] = state
+            self._cond.notify()
+
+    def flush(self):
+        """
+        Publishes the pending changes as delta and the new snapshot.
+        Returns:
+            Returns the sequence number or None if nothing changed.
+        """
+        with self._cond:
+            changes = {
+                device: state for device, state in self.pending.items()
+                if self.states.get(device) != state
+            }
+            self.pending = dict()
+            delta = None
+            if changes:
+                self.states.update(changes)
+                self.seq += 1
+                self.counters['deltas'] += 1
+                delta = self._payload(changes)
+                self._held = True
+            snapshot = None
+            if self._held and self._ready():
+                snapshot = self._payload(self.states)
+                self._held = False
+            seq = self.seq
+        # Deltas are for clients which are up to date, never retained
+        if delta is not None:
+            self.publisher.publish(topic=self.delta_topic, payload=delta)
+        if snapshot is not None:
+            self.publisher.publish(topic=self.topic, payload=snapshot,
+                                   retain=True)
+        return seq if delta is not None else None
+
+    def _payload(self, states):
+        return json.dumps(
+            {'epoch': self.epoch, 'seq': self.seq, 'states': states},
+            separators=(',', ':'), sort_keys=True
+        )
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._worker = threading.Thread(
+            target=self._run, name='snapshot', daemon=True
+        )
+        self._worker.start()
+
+    def stop(self, timeout=5.):
+        """Stops the worker after publishing the pending changes."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # A held back snapshot is published after the seed timeout
+                self._cond.wait_for(
+                    lambda: self.pending or not self._running,
+                    timeout=0.5 if self._held else None
+                )
+                if not self._running:
+                    return
+                # Coalesce until the window of the first change is over
+                while self._running and self.pending:
+                    remaining = self._due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
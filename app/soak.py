@@ -0,0 +1,284 @@
+"""
+Soak test of the consumer pipeline.
+
+A synthetic stream of switch commands is replayed through the whole
+pipeline (paho message, `Gateway`, device registry, airtime limiter, a new
+`RC433Service` per command on the `Simulator`, `QueuedMQTTPublisher`) on a
+virtual clock, so hours of traffic take minutes. After a warmup `tracemalloc`
+snapshots, object counts and the number of open file descriptors are sampled
+periodically; the run fails if the memory retained after a full garbage
+collection or the file descriptors grow beyond a threshold.
+"""
+
+import gc
+import os
+import random
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+import attr
+import paho.mqtt.client as mqtt
+
+from .gateway import Gateway
+from .loadgen import DeviceChooser, device_topics
+from .simulator import Simulator
+from .util import LogMixin
+
+# Allocations of the measurement itself are not counted
+FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__)
+]
+
+
+def open_fds():
+    """Number of open file descriptors of the process, None if unknown."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+@attr.s
+class LoopbackInfo(object):
+    mid = attr.ib()
+    rc = attr.ib(default=mqtt.MQTT_ERR_SUCCESS)
+
+
+class LoopbackClient(object):
+    """
+    Stands in for the paho client of the publisher without a broker: every
+    message is acknowledged right away, the message ids wrap like paho's.
+    """
+
+    def __init__(self):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.published = 0
+        self._mid = 0
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._mid = self._mid % 65535 + 1
+        self.published += 1
+        if self.on_publish is not None:
+            self.on_publish(self, None, self._mid)
+        return LoopbackInfo(mid=self._mid)
+
+
+@attr.s
+class Sample(object):
+    messages = attr.ib()
+    # simulated seconds since the start
+    elapsed = attr.ib()
+    # bytes allocated (and still alive) after a full collection
+    memory = attr.ib()
+    objects = attr.ib()
+    fds = attr.ib()
+
+
+@attr.s
+class MemoryMonitor(LogMixin):
+    """
+    Samples the retained memory, the objects tracked by the garbage
+    collector and the open file descriptors. The first sample is the
+    baseline the growth is measured against, allocations are traced from
+    then on.
+    """
+    max_memory_growth = attr.ib(default=1048576, converter=int)
+    max_fd_growth = attr.ib(default=0, converter=int)
+    # frames per traceback, more are a lot slower
+    frames = attr.ib(default=1, converter=int)
+    top = attr.ib(default=10, converter=int)
+    samples = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    _baseline = attr.ib(default=None, init=False, repr=False)
+    _latest = attr.ib(default=None, init=False, repr=False)
+    _tracing = attr.ib(default=False, init=False, repr=False)
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._tracing = True
+
+    def stop(self):
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def sample(self, messages=0, elapsed=0.):
+        self.start()
+        self._latest = None
+        gc.collect()
+        objects = Counter(
+            type(o).__name__ for o in gc.get_objects()
+            if not isinstance(o, Sample)
+        )
+        snapshot = tracemalloc.take_snapshot().filter_traces(FILTERS)
+        sample = Sample(
+            messages=messages, elapsed=elapsed,
+            memory=sum(trace.size for trace in snapshot.traces),
+            objects=sum(objects.values()), fds=open_fds()
+        )
+        self.samples.append(sample)
+        if self._baseline is None:
+            self._baseline = (sample, snapshot, objects)
+        self._latest = (sample, snapshot, objects)
+        return sample
+
+    def verdict(self):
+        """
+        Compares the latest sample with the baseline.
+        Returns:
+            Returns a dict whether the run `passed`, the growth of memory
+            (bytes) and file descriptors, the types with the most new
+            objects and the source lines with the most new allocations.
+        """
+        base, base_snapshot, base_objects = self._baseline
+        last, snapshot, objects = self._latest
+        fd_growth = 0
+        if base.fds is not None and last.fds is not None:
+            fd_growth = last.fds - base.fds
+        memory_growth = last.memory - base.memory
+        passed = memory_growth <= self.max_memory_growth
+        passed &= fd_growth <= self.max_fd_growth
+        objects.subtract(base_objects)
+        return dict(
+            passed=passed,
+            samples=len(self.samples),
+            memory=last.memory,
+            memory_growth=memory_growth,
+            fd_growth=fd_growth,
+            object_growth=dict(objects.most_common(self.top)),
+            top_allocations=[
+                str(stat) for stat in
+                snapshot.compare_to(base_snapshot, 'lineno')[:self.top]
+                if stat.size_diff > 0
+            ]
+        )
+
+
+@attr.s
+class SoakRunner(LogMixin):
+    """
+    Replays random switch commands for the devices of the `topics` every
+    `interval` (exponentially distributed, simulated) seconds, `invalid` is
+    the share of commands with an invalid state. The limiter, if any, is
+    switched to the simulated clock.
+    Example:
+        >>> runner = SoakRunner(registry, topics, publisher)
+        >>> runner.run(duration=24 * 3600)['passed']
+        True
+    """
+    registry = attr.ib()
+    topics = attr.ib()
+    publisher = attr.ib()
+    limiter = attr.ib(default=None)
+    tracer = attr.ib(default=None)
+    monitor = attr.ib(default=attr.Factory(MemoryMonitor))
+    simulator = attr.ib(default=attr.Factory(Simulator))
+    interval = attr.ib(default=5., converter=float)
+    invalid = attr.ib(default=0., converter=float)
+    rng = attr.ib(default=attr.Factory(random.Random), repr=False)
+    counters = attr.ib(default=attr.Factory(lambda: defaultdict(int)),
+                       init=False)
+    gateway = attr.ib(default=None, init=False, repr=False)
+    _topics = attr.ib(default=None, init=False, repr=False)
+    _chooser = attr.ib(default=None, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        if self.limiter is not None:
+            self.limiter.clock = self.now
+        self.gateway = Gateway(
+            self.registry, self.publisher, limiter=self.limiter,
+            tracer=self.tracer, service_factory=self.simulator.service
+        )
+        self._topics = device_topics(self.topics)
+        self._chooser = DeviceChooser(list(self._topics), rng=self.rng)
+
+    def now(self):
+        """The simulated time in seconds."""
+        return self.simulator.clock.time_ns() / 1e9
+
+    def message(self):
+        device = self._chooser.choose()[0]
+        state = self.rng.choice(('ON', 'OFF'))
+        if self.rng.random() < self.invalid:
+            state = 'DIM'
+        message = mqtt.MQTTMessage(
+            topic=self._topics[device][0].encode('utf-8')
+        )
+        message.payload = state.encode('utf-8')
+        return message
+
+    def step(self):
+        """Waits for and handles the next command."""
+        self.simulator.clock.sleep(self.rng.expovariate(1. / self.interval))
+        message = self.message()
+        with self.simulator.command(message.topic) as command:
+            switched = self.gateway.dispatch(message.topic, message.payload,
+                                             received=message.timestamp)
+        report = self.simulator.analyze(command)
+        self.simulator.reset()
+        self.counters['messages'] += 1
+        self.counters['switched'] += int(switched)
+        self.counters['frames'] += report['frames']
+        self.counters['on_air'] += report['on_air']
+
+    def run(self, duration, sample_interval=600., warmup=600.,
+            max_runtime=None):
+        """
+        Replays commands for `duration` simulated seconds. The baseline is
+        sampled after `warmup`, then every `sample_interval` seconds (both
+        simulated) and once at the end.
+        Args:
+            max_runtime (float): ends the run early after so many real
+                seconds
+        Returns:
+            Returns the verdict of the monitor with the counters, the
+            simulated and the real duration of the run.
+        """
+        start, started = self.now(), time.monotonic()
+        next_sample = start + warmup
+        try:
+            while self.now() - start < duration:
+                if max_runtime and time.monotonic() - started > max_runtime:
+                    self.logger.warning("Soak test ended after %.0fs",
+                                        max_runtime)
+                    break
+                self.step()
+                if self.now() >= next_sample:
+                    self._measure(start)
+                    next_sample += sample_interval
+            self._measure(start)
+            res = self.monitor.verdict()
+        finally:
+            self.monitor.stop()
+        res.update(self.counters)
+        res['simulated'] = self.now() - start
+        res['runtime'] = time.monotonic() - started
+        return res
+
+    def _measure(self, start):
+        # Let the publisher catch up, its backlog is no leak
+        deadline = time.monotonic() + 5.
+        while self.publisher.backlog or self.publisher.inflight:
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.001)
+        sample = self.monitor.sample(self.counters['messages'],
+                                     self.now() - start)
+        self.logger.info(
+            "%d messages after %.0fs: %d bytes, %d objects, %s fds",
+            sample.messages, sample.elapsed, sample.memory, sample.objects,
+            sample.fds
+        )
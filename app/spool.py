@@ -0,0 +1,164 @@
+"""
+Durable spool for outgoing messages while the broker is unavailable.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import attr
+
+from .util import LogMixin
+
+
+@attr.s
+class OutboundSpool(LogMixin):
+    """
+    Append-only file of messages (one json object per line). Appends are
+    flushed to the OS immediately and fsync'ed in batches: after
+    `fsync_batch` messages or `fsync_interval` seconds, whichever comes
+    first; the owner calls `sync_due` and `flush` for the latter when no
+    further message arrives. Draining collapses the messages to the latest
+    one per topic and moves them to a replay file, which is only removed by
+    `replayed` once they were republished. Messages survive restarts and
+    crashes during a replay, a spool left over from a previous run is
+    drained on the next connect.
+    Example:
+        >>> spool = OutboundSpool('/tmp/outbound.spool')
+        >>> spool.append('rc433/a/state', 'on')
+        >>> spool.append('rc433/a/state', 'off')
+        >>> spool.drain()
+        [('rc433/a/state', 'off', 0, False)]
+        >>> spool.replayed()
+    """
+    file_name = attr.ib(converter=str)
+    fsync_batch = attr.ib(default=64, converter=int)
+    fsync_interval = attr.ib(default=1., converter=float)
+    _fp = attr.ib(default=None, init=False, repr=False)
+    _unsynced = attr.ib(default=0, init=False, repr=False)
+    _synced_at = attr.ib(default=0., init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+
+    def __len__(self):
+        """Number of spooled messages (before collapsing)"""
+        with self._lock:
+            return len(self._read(self.file_name))
+
+    @property
+    def replay_file_name(self):
+        return '{}.replay'.format(self.file_name)
+
+    def _open(self):
+        if self._fp is None:
+            self._fp = open(self.file_name, 'a', encoding='utf8')
+            self._synced_at = time.monotonic()
+        return self._fp
+
+    def _sync(self):
+        if self._fp is not None and self._unsynced:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._unsynced = 0
+            self._synced_at = time.monotonic()
+
+    def append(self, topic, payload=None, qos=0, retain=False):
+        """Appends a message, fsync'ed with the current batch."""
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        line = json.dumps(
+            [topic, payload, qos, retain], separators=(',', ':')
+        )
+        with self._lock:
+            fp = self._open()
+            fp.write(line + '\n')
+            fp.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_batch or \
+                    time.monotonic() - self._synced_at >= self.fsync_interval:
+                self._sync()
+
+    def sync_due(self):
+        """
+        Returns:
+            Returns the seconds until the pending batch is due to be
+            fsync'ed, None if there is none.
+        """
+        with self._lock:
+            if not self._unsynced:
+                return None
+            return self._synced_at + self.fsync_interval - time.monotonic()
+
+    def flush(self):
+        """Syncs the pending batch once `fsync_interval` has passed."""
+        with self._lock:
+            if self._unsynced and \
+                    time.monotonic() - self._synced_at >= self.fsync_interval:
+                self._sync()
+
+    def _read(self, file_name):
+        if self._fp is not None:
+            self._fp.flush()
+        if not os.path.exists(file_name):
+            return []
+        records = []
+        with open(file_name, 'r', encoding='utf8') as fp:
+            for line in fp:
+                try:
+                    records.append(tuple(json.loads(line)))
+                except ValueError:
+                    # a torn last line of a crash
+                    self.logger.warning("Skipped corrupt spool record")
+        return records
+
+    def drain(self):
+        """
+        Takes all spooled messages, collapsed to the latest per topic in
+        the order of their last update. They are kept in the replay file
+        (together with those of an unfinished replay) until `replayed`.
+        Returns:
+            Returns a list of (topic, payload, qos, retain) tuples.
+        """
+        with self._lock:
+            self._sync()
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+            self._unsynced = 0
+            if os.path.exists(self.file_name):
+                if os.path.exists(self.replay_file_name):
+                    with open(self.file_name, 'rb') as src, \
+                            open(self.replay_file_name, 'ab+') as dst:
+                        dst.seek(0, os.SEEK_END)
+                        if dst.tell():
+                            dst.seek(-1, os.SEEK_END)
+                            # a torn last line must not swallow the next one
+                            if dst.read(1) != b'\n':
+                                dst.write(b'\n')
+                        dst.write(src.read())
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                    os.remove(self.file_name)
+                else:
+                    os.replace(self.file_name, self.replay_file_name)
+            latest = OrderedDict()
+            for record in self._read(self.replay_file_name):
+                latest.pop(record[0], None)
+                latest[record[0]] = record
+        return list(latest.values())
+
+    def replayed(self):
+        """Removes the drained messages once they were republished."""
+        with self._lock:
+            if os.path.exists(self.replay_file_name):
+                os.remove(self.replay_file_name)
+
+    def close(self):
+        """Syncs the pending batch and closes the file."""
+        with self._lock:
+            self._sync()
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
@@ -0,0 +1,245 @@
+"""
+Per-command tracing with timed spans for the stages of a switch command.
+
+A trace is bound to the handling thread, so code deep down the switch path
+adds its spans with `span(name)` without passing the trace around; without
+a trace `span` does nothing. Finished traces are written, if sampled or
+slower than the threshold, as OTLP JSON (one `ExportTraceServiceRequest`
+per line, as written by the OpenTelemetry file exporter) to a rotating file.
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import attr
+from schema import And, Optional, Schema, Use
+
+from .util import LogMixin, queue_logging
+
+SERVICE_NAME = 'rc433mq'
+
+_local = threading.local()
+
+
+def _attributes(attributes):
+    return [
+        {'key': k, 'value': {'stringValue': str(v)}}
+        for k, v in sorted(attributes.items())
+    ]
+
+
+@attr.s
+class Span(object):
+    name = attr.ib()
+    span_id = attr.ib()
+    parent_id = attr.ib()
+    start = attr.ib()
+    end = attr.ib(default=None)
+    attributes = attr.ib(default=attr.Factory(dict))
+    error = attr.ib(default=None)
+
+    @property
+    def duration(self):
+        """Duration in seconds"""
+        return (self.end - self.start) / 1e9
+
+    def as_otlp(self, trace_id):
+        res = {
+            'traceId': trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': _attributes(self.attributes),
+            'status': {'code': 2, 'message': self.error}
+            if self.error else {'code': 1}
+        }
+        if self.parent_id:
+            res['parentSpanId'] = self.parent_id
+        return res
+
+
+@attr.s
+class Trace(object):
+    """
+    Spans of a single command. The first span is the root span.
+    """
+    name = attr.ib()
+    trace_id = attr.ib(default=attr.Factory(lambda: os.urandom(16).hex()))
+    spans = attr.ib(default=attr.Factory(list), repr=False)
+    _stack = attr.ib(default=attr.Factory(list), repr=False)
+
+    def start_span(self, name, attributes=None, start=None):
+        span = Span(
+            name=name,
+            span_id=os.urandom(8).hex(),
+            parent_id=self._stack[-1].span_id if self._stack else None,
+            start=time.time_ns() if start is None else start,
+            attributes=attributes or dict()
+        )
+        self.spans.append(span)
+        self._stack.append(span)
+        return span
+
+    def end_span(self, span, error=None):
+        span.end = time.time_ns()
+        span.error = error
+        if self._stack and self._stack[-1] is span:
+            self._stack.pop()
+
+    @property
+    def root(self):
+        return self.spans[0]
+
+    def as_otlp(self):
+        return {'resourceSpans': [{
+            'resource': {'attributes': _attributes(
+                {'service.name': SERVICE_NAME}
+            )},
+            'scopeSpans': [{
+                'scope': {'name': SERVICE_NAME},
+                'spans': [s.as_otlp(self.trace_id) for s in self.spans]
+            }]
+        }]}
+
+
+@attr.s
+class _OTLPLine(object):
+    # Serialized by the logging thread when the record is written
+    trace = attr.ib()
+
+    def __str__(self):
+        return json.dumps(self.trace.as_otlp(), separators=(',', ':'))
+
+
+def current():
+    """The trace bound to the calling thread or None."""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the enclosed block as span of the current trace.
+    Example:
+        >>> with span('transmit', pin=17):
+        ...     pass
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield None
+        return
+    s = trace.start_span(name, attributes)
+    try:
+        yield s
+    except Exception as why:
+        trace.end_span(s, error=repr(why))
+        raise
+    trace.end_span(s)
+
+
+@attr.s
+class Tracer(LogMixin):
+    """
+    Starts and finishes traces. A finished trace is written if it was
+    sampled (with probability `sample_rate`) or took at least
+    `slow_threshold` seconds.
+    """
+    SCHEMA = Schema({
+        Optional('sample_rate'): And(Use(float), lambda n: 0 <= n <= 1),
+        Optional('slow_threshold'): And(Use(float), lambda n: n >= 0),
+        Optional('file_name'): str,
+        Optional('max_bytes'): And(Use(int), lambda n: n > 0),
+        Optional('backup_count'): And(Use(int), lambda n: n >= 0)
+    })
+
+    sample_rate = attr.ib(default=0.01, converter=float)
+    # Above the longest nominal airtime, 2.24s of a code device
+    slow_threshold = attr.ib(default=3., converter=float)
+    file_name = attr.ib(default='logs/traces.jsonl')
+    max_bytes = attr.ib(default=2097152, converter=int)
+    backup_count = attr.ib(default=5, converter=int)
+    rng = attr.ib(default=attr.Factory(random.Random), repr=False)
+    counters = attr.ib(
+        default=attr.Factory(lambda: dict(traces=0, written=0, slow=0)),
+        init=False
+    )
+    _out = attr.ib(default=None, init=False, repr=False)
+    _handler = attr.ib(default=None, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._out = logging.getLogger('RC433Trace.{}'.format(id(self)))
+        self._out.propagate = False
+        self._out.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(
+            self.file_name, maxBytes=self.max_bytes,
+            backupCount=self.backup_count, encoding='utf8', delay=True
+        )
+        self._out.addHandler(handler)
+        # writing happens on a background thread
+        self._handler = queue_logging(logger=self._out)
+
+    @classmethod
+    def from_config(cls, file_name, base_path=None):
+        """
+        Loads the tracing config from a json file.
+        Args:
+            file_name (str): Path of the file to load the config from.
+            base_path (str): Directory a relative trace file is put in.
+        Returns:
+            Returns a `Tracer` initialized from the given json.
+        """
+        with open(file_name, 'r') as fp:
+            jsonf = cls.SCHEMA.validate(json.load(fp))
+
+        if base_path is not None and 'file_name' in jsonf:
+            jsonf['file_name'] = os.path.join(base_path, jsonf['file_name'])
+        return cls(**jsonf)
+
+    def start(self, name, received=None, **attributes):
+        """
+        Starts a trace bound to the calling thread.
+        Args:
+            name (str): name of the root span
+            received (float): `time.monotonic()` the client received the
+                command, adds a `queued` span for the time until now; the
+                broker gives no publish time to measure the delivery
+        Returns:
+            Returns the new `Trace`.
+        """
+        trace = Trace(name=name)
+        now = time.time_ns()
+        start = now
+        if received is not None:
+            start = now - int((time.monotonic() - received) * 1e9)
+        trace.start_span(name, attributes, start=start)
+        if received is not None:
+            trace.end_span(trace.start_span('queued', start=start))
+        _local.trace = trace
+        return trace
+
+    def finish(self, trace, error=None):
+        """Ends the root span, unbinds the trace and writes it if needed."""
+        trace.end_span(trace.root, error=error)
+        _local.trace = None
+        self.counters['traces'] += 1
+        slow = trace.root.duration >= self.slow_threshold
+        if slow:
+            self.counters['slow'] += 1
+            self.logger.warning(
+                "Slow command '%s' took %.3fs (trace %s)",
+                trace.name, trace.root.duration, trace.trace_id
+            )
+        if slow or self.rng.random() < self.sample_rate:
+            self.counters['written'] += 1
+            self._out.info('%s', _OTLPLine(trace))
+
+    def close(self):
+        self._handler.close()
@@ -0,0 +1,483 @@
+"""
+Transmitter child process.
+
+Even on a thread of its own the bit-banging shares the GIL with the network
+loop, the parsing and the logging of the consumer, and every GIL handoff
+disturbs the timing of the pulses. The `process` backend therefore hands the
+pulses to a child process which does nothing but transmit them with the
+actual backend (`RC433_PROCESS_BACKEND`, default `gpio`).
+
+Both directions are single-producer single-consumer ring buffers in shared
+memory: the pulses of a transmission go to the child as one compact record
+of 6 bytes per pulse, the completions (result and duration) come back. Each
+side only ever writes its own position, so the rings need no lock; a
+semaphore per ring wakes the reader up (and orders the memory accesses).
+
+Every request carries the `time.monotonic()` its transmission has to start
+by, so a child which falls behind skips the requests the parent already gave
+up on instead of sending them late.
+
+The parent supervises the child: a child which died or stopped its
+heartbeat is killed and restarted with an exponential delay. Transmissions
+it did not complete fail, as do those while it is down. The child is
+started by a fork server, as forking the multi-threaded consumer could copy
+locks held by its other threads.
+"""
+
+import atexit
+import itertools
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+from collections import defaultdict, deque
+from multiprocessing import shared_memory
+
+import attr
+
+from . import realtime
+from .util import LogMixin, percentile
+
+# head, tail, heartbeat (`time.monotonic()` of the child), stop flag
+_HEADER = struct.Struct('<QQdQ')
+_LENGTH = struct.Struct('<I')
+_WRAP = 0xFFFFFFFF
+# sequence number, number of pulses, deadline / sequence number, result,
+# microseconds
+_REQUEST = struct.Struct('<IId')
+_PULSE = struct.Struct('<BBI')
+_COMPLETION = struct.Struct('<IBI')
+# result of a request skipped for its deadline
+_SKIPPED = 2
+
+
+@attr.s
+class RingBuffer(object):
+    """
+    Ring of byte records in shared memory for one producer and one
+    consumer. `head` and `tail` count the bytes written and read, a record
+    is a length and the data, padded to 8 bytes, and never wraps around.
+    Example:
+        >>> ring = RingBuffer.create(4096)
+        >>> ring.put(b'pulses')
+        True
+        >>> RingBuffer.attach(ring.name).get()
+        b'pulses'
+    """
+    shm = attr.ib(repr=False)
+    owner = attr.ib(default=False)
+
+    @classmethod
+    def create(cls, size):
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=_HEADER.size + size)
+        shm.buf[:_HEADER.size] = bytes(_HEADER.size)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def capacity(self):
+        return self.shm.size - _HEADER.size
+
+    def _header(self):
+        return _HEADER.unpack_from(self.shm.buf)
+
+    def _set(self, index, fmt, value):
+        struct.pack_into(fmt, self.shm.buf, index * 8, value)
+
+    @property
+    def heartbeat(self):
+        return self._header()[2]
+
+    def beat(self):
+        self._set(2, '<d', time.monotonic())
+
+    @property
+    def stopping(self):
+        return bool(self._header()[3])
+
+    def request_stop(self):
+        self._set(3, '<Q', 1)
+
+    def __len__(self):
+        head, tail, _, _ = self._header()
+        return head - tail
+
+    def put(self, data):
+        """Appends a record, returns False if the ring is full."""
+        head, tail, _, _ = self._header()
+        size = (_LENGTH.size + len(data) + 7) & ~7
+        offset = head % self.capacity
+        skip = 0
+        if offset + size > self.capacity:
+            skip = self.capacity - offset
+        if size > self.capacity or head + skip + size - tail > self.capacity:
+            return False
+        if skip:
+            # The rest of the buffer is left out
+            _LENGTH.pack_into(self.shm.buf, _HEADER.size + offset, _WRAP)
+            offset = 0
+        start = _HEADER.size + offset
+        _LENGTH.pack_into(self.shm.buf, start, len(data))
+        self.shm.buf[start + _LENGTH.size:start + _LENGTH.size + len(data)] = \
+            data
+        # The data is complete before the head moves past it
+        self._set(0, '<Q', head + skip + size)
+        return True
+
+    def get(self):
+        """Takes the oldest record, None if the ring is empty."""
+        head, tail, _, _ = self._header()
+        if head == tail:
+            return None
+        offset = tail % self.capacity
+        length, = _LENGTH.unpack_from(self.shm.buf, _HEADER.size + offset)
+        if length == _WRAP:
+            tail += self.capacity - offset
+            offset = 0
+            length, = _LENGTH.unpack_from(self.shm.buf, _HEADER.size)
+        start = _HEADER.size + offset + _LENGTH.size
+        data = bytes(self.shm.buf[start:start + length])
+        self._set(1, '<Q', tail + ((_LENGTH.size + length + 7) & ~7))
+        return data
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def encode_pulses(seq, pulses, deadline=float('inf')):
+    """
+    Packs the pulses `(pin, level, duration)` of a transmission, which has
+    to start by the `time.monotonic()` `deadline`.
+    """
+    data = bytearray(_REQUEST.size + _PULSE.size * len(pulses))
+    _REQUEST.pack_into(data, 0, seq, len(pulses), deadline)
+    for i, (pin, level, duration) in enumerate(pulses):
+        _PULSE.pack_into(data, _REQUEST.size + i * _PULSE.size, pin, level,
+                         int(duration))
+    return bytes(data)
+
+
+def decode_pulses(data):
+    seq, count, deadline = _REQUEST.unpack_from(data)
+    return seq, deadline, \
+        list(_PULSE.iter_unpack(data[_REQUEST.size:]))[:count]
+
+
+def serve(requests, completions, doorbell, done, backend, guard=None):
+    """
+    Main of the child process: transmits the requests until the parent
+    asks it to stop or is gone.
+    Args:
+        requests (str): name of the shared memory of the requests
+        completions (str): name of the shared memory of the completions
+        doorbell: semaphore released for every request
+        done: semaphore released for every completion
+        backend (str): name of the transmit backend, see `app.backend`
+        guard (dict): settings of a `RealtimeGuard` to install
+    """
+    from .backend import BACKENDS
+
+    # The parent stops the child on Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = os.getppid()
+    requests, completions = RingBuffer.attach(requests), \
+        RingBuffer.attach(completions)
+    realtime.install(
+        realtime.RealtimeGuard(**guard) if guard is not None else None
+    )
+    transmitter = BACKENDS[backend]()
+    pins = set()
+    try:
+        while not requests.stopping and os.getppid() == parent:
+            requests.beat()
+            doorbell.acquire(timeout=0.5)
+            data = requests.get()
+            if data is None:
+                continue
+            seq, deadline, pulses = decode_pulses(data)
+            elapsed = 0
+            if time.monotonic() > deadline:
+                # The parent gave up on the request already
+                ok = _SKIPPED
+            else:
+                for pin in {pin for pin, _, _ in pulses} - pins:
+                    transmitter.setup(pin)
+                    pins.add(pin)
+                start = time.perf_counter()
+                try:
+                    ok = bool(transmitter.transmit(pulses))
+                except Exception:
+                    ok = False
+                elapsed = int((time.perf_counter() - start) * 1e6)
+            while not completions.put(_COMPLETION.pack(seq, ok, elapsed)):
+                time.sleep(0.001)
+            done.release()
+    finally:
+        transmitter.cleanup()
+        requests.close()
+        completions.close()
+
+
+@attr.s
+class _Request(object):
+    airtime = attr.ib()
+    done = attr.ib(default=attr.Factory(threading.Event))
+    result = attr.ib(default=False)
+
+
+@attr.s
+class TransmitterProcess(LogMixin):
+    """
+    Runs the transmissions in a supervised child process.
+    Example:
+        >>> transmitter = TransmitterProcess(backend='gpio')
+        >>> transmitter.start()
+        >>> transmitter.transmit([(17, 1, 300), (17, 0, 900)])
+        True
+    """
+    backend = attr.ib(default='gpio')
+    # bytes per ring, a frame of a system code device takes about 1KiB
+    size = attr.ib(default=65536, converter=int)
+    # seconds a transmission may take over its airtime
+    timeout = attr.ib(default=5., converter=float)
+    # seconds without heartbeat after which the child counts as hung
+    hang_timeout = attr.ib(default=10., converter=float)
+    restart_delay = attr.ib(default=0.5, converter=float)
+    max_restart_delay = attr.ib(default=30., converter=float)
+    # 'fork' is only safe before the consumer starts any threads
+    start_method = attr.ib(default='forkserver')
+    counters = attr.ib(default=attr.Factory(lambda: defaultdict(int)),
+                       init=False)
+    overruns = attr.ib(default=attr.Factory(lambda: deque(maxlen=1000)),
+                       init=False, repr=False)
+    process = attr.ib(default=None, init=False, repr=False)
+    _requests = attr.ib(default=None, init=False, repr=False)
+    _completions = attr.ib(default=None, init=False, repr=False)
+    _doorbell = attr.ib(default=None, init=False, repr=False)
+    _done = attr.ib(default=None, init=False, repr=False)
+    _pending = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _seq = attr.ib(default=attr.Factory(lambda: itertools.count(1)),
+                   init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+    _watcher = attr.ib(default=None, init=False, repr=False)
+    _running = attr.ib(default=False, init=False, repr=False)
+    _started = attr.ib(default=0., init=False, repr=False)
+    _failures = attr.ib(default=0, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        if self.backend == 'process':
+            raise ValueError("The child process cannot use the process "
+                             "backend itself")
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._spawn()
+        self._watcher = threading.Thread(
+            target=self._watch, name='transmitter-watch', daemon=True
+        )
+        self._watcher.start()
+
+    def stop(self, timeout=5.):
+        """Stops the child, transmissions still pending fail."""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        self._done.release()
+        if self._watcher is not None:
+            self._watcher.join(timeout)
+            self._watcher = None
+        with self._lock:
+            self._shutdown(timeout)
+
+    def _spawn(self):
+        context = multiprocessing.get_context(self.start_method)
+        self._requests = RingBuffer.create(self.size)
+        self._completions = RingBuffer.create(self.size)
+        self._doorbell = context.Semaphore(0)
+        self._done = context.Semaphore(0)
+        guard = realtime.current()
+        if guard is not None:
+            guard = {
+                a.name: getattr(guard, a.name)
+                for a in attr.fields(type(guard)) if a.init
+            }
+        self._requests.beat()
+        self.process = context.Process(
+            target=serve, name='rc433-transmitter', daemon=True,
+            args=(self._requests.name, self._completions.name,
+                  self._doorbell, self._done, self.backend, guard)
+        )
+        self.process.start()
+        self._started = time.monotonic()
+        self.logger.info("Started transmitter process %d (%s backend)",
+                         self.process.pid, self.backend)
+
+    def _shutdown(self, timeout):
+        # The rings are gone while the watcher waits to restart the child
+        if self._requests is None:
+            return
+        self._requests.request_stop()
+        self._doorbell.release()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self._fail_pending()
+        self._requests.close()
+        self._completions.close()
+        self._requests = self._completions = None
+
+    def _fail_pending(self):
+        for request in self._pending.values():
+            request.done.set()
+        self.counters['failed'] += len(self._pending)
+        self._pending = dict()
+
+    def transmit(self, pulses):
+        """
+        Sends the pulses through the child process.
+        Returns:
+            Returns True if the child transmitted the pulses; otherwise
+            False, also if the child is restarting or did not start the
+            transmission within `timeout`.
+        """
+        airtime = sum(duration for _, _, duration in pulses) / 1000000.
+        request = _Request(airtime=airtime)
+        with self._lock:
+            if not self._running:
+                return False
+            if self._requests is None:
+                self.counters['unavailable'] += 1
+                self.logger.warning("Transmitter process is restarting, "
+                                    "dropped pulses")
+                return False
+            seq = next(self._seq) & 0xFFFFFFFF
+            deadline = time.monotonic() + self.timeout
+            if not self._requests.put(encode_pulses(seq, pulses, deadline)):
+                self.counters['rejected'] += 1
+                self.logger.warning("Transmit ring full, dropped pulses")
+                return False
+            self._pending[seq] = request
+            self._doorbell.release()
+        if not request.done.wait(airtime + self.timeout):
+            with self._lock:
+                self._pending.pop(seq, None)
+            self.counters['timeouts'] += 1
+            self.logger.warning("Transmitter process did not answer")
+            return False
+        return request.result
+
+    def _watch(self):
+        while self._running:
+            self._done.acquire(timeout=0.5)
+            with self._lock:
+                if not self._running:
+                    return
+                self._collect()
+                why = self._check()
+                if why is None:
+                    continue
+                self.logger.error("Restarting the transmitter process: %s",
+                                  why)
+                self.counters['restarts'] += 1
+                self._shutdown(1.)
+                # Restarts in quick succession are delayed more and more
+                if time.monotonic() - self._started > 60.:
+                    self._failures = 0
+                delay = min(self.restart_delay * 2 ** self._failures,
+                            self.max_restart_delay)
+                self._failures += 1
+            time.sleep(delay)
+            with self._lock:
+                if self._running:
+                    self._spawn()
+
+    def _collect(self):
+        while True:
+            data = self._completions.get()
+            if data is None:
+                return
+            seq, ok, elapsed = _COMPLETION.unpack(data)
+            request = self._pending.pop(seq, None)
+            if ok == _SKIPPED:
+                self.counters['skipped'] += 1
+                if request is not None:
+                    request.done.set()
+                continue
+            if request is None:
+                continue
+            self.counters['transmitted' if ok else 'failed'] += 1
+            self.overruns.append(elapsed / 1e6 - request.airtime)
+            request.result = bool(ok)
+            request.done.set()
+
+    def _check(self):
+        if not self.process.is_alive():
+            return "exited with {}".format(self.process.exitcode)
+        silent = time.monotonic() - self._requests.heartbeat
+        if silent > self.hang_timeout + max(
+            [r.airtime for r in self._pending.values()] or [0.]
+        ):
+            return "no heartbeat for {:.1f}s".format(silent)
+        return None
+
+    def stats(self):
+        """
+        Returns:
+            Returns the counters and the mean, p99 and max overrun of the
+            transmissions over their airtime in seconds, measured in the
+            child.
+        """
+        overruns = list(self.overruns)
+        res = dict(self.counters)
+        res['overrun_mean'] = sum(overruns) / len(overruns) \
+            if overruns else None
+        res['overrun_p99'] = percentile(overruns, 99)
+        res['overrun_max'] = max(overruns) if overruns else None
+        return res
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    """
+    The transmitter process of the consumer, started on first use with the
+    backend named by `RC433_PROCESS_BACKEND` (default `gpio`).
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = TransmitterProcess(
+                backend=os.environ.get('RC433_PROCESS_BACKEND', 'gpio')
+            )
+            _shared.start()
+            atexit.register(_shared.stop)
+        return _shared
+
+
+def current():
+    """The transmitter process of the consumer or None if not used."""
+    return _shared
@@ -1,4 +1,10 @@
 import logging
+import logging.handlers
+import math
+import queue
+import time
+
+_LOGGERS = dict()
 
 
 class LogMixin(object):
@@ -12,4 +18,121 @@ class LogMixin(object):
     """
     @property
     def logger(self):
-        return logging.getLogger(self.__class__.__name__)
+        cls = self.__class__
+        logger = _LOGGERS.get(cls)
+        if logger is None:
+            logger = _LOGGERS.setdefault(cls, logging.getLogger(cls.__name__))
+        return logger
+
+
+class QueueLoggingHandler(logging.handlers.QueueHandler):
+    """
+    Hands log records to a `QueueListener` without blocking. The message
+    of a record is merged with its args right away, as they may change
+    later; the handlers of the listener format and write it on its thread.
+    If the queue is full the record is dropped and counted. The time spent
+    per record is measured to check it against the logging overhead budget.
+    """
+
+    def __init__(self, queue, budget_us=50.):
+        super().__init__(queue)
+        self.budget_us = float(budget_us)
+        self.listener = None
+        self.records = 0
+        self.dropped = 0
+        self.seconds = 0.
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def emit(self, record):
+        start = time.perf_counter()
+        super().emit(record)
+        with self.lock:
+            self.records += 1
+            self.seconds += time.perf_counter() - start
+
+    def close(self):
+        """Stops the listener after the queued records are handled."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+    def stats(self):
+        """
+        Returns:
+            Returns a dict with the number of handled and dropped records
+            and the mean time per record in microseconds, compared to the
+            budget.
+        """
+        with self.lock:
+            records, dropped, seconds = \
+                self.records, self.dropped, self.seconds
+        mean_us = seconds / records * 1e6 if records else 0.
+        return dict(
+            records=records,
+            dropped=dropped,
+            mean_us=mean_us,
+            budget_us=self.budget_us,
+            within_budget=mean_us <= self.budget_us
+        )
+
+
+class _QueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # Blocks until there is room, a full queue must not prevent stopping
+        self.queue.put(self._sentinel)
+
+
+def queue_logging(maxsize=10000, budget_us=50., logger=None):
+    """
+    Moves the handlers of a logger (default: root) behind a queue, so their
+    I/O runs on the thread of a `QueueListener` instead of the caller's.
+    Args:
+        maxsize (int): maximum number of queued records
+        budget_us (float): overhead budget per record in microseconds
+        logger: logger whose handlers are moved
+    Returns:
+        Returns the `QueueLoggingHandler`. Closing it, as `logging.shutdown`
+        does at exit, stops the listener after the queue is flushed.
+    """
+    logger = logger or logging.getLogger()
+    handlers = list(logger.handlers)
+    records = queue.Queue(int(maxsize))
+    handler = QueueLoggingHandler(records, budget_us=budget_us)
+    listener = _QueueListener(
+        records, *handlers, respect_handler_level=True
+    )
+    for h in handlers:
+        logger.removeHandler(h)
+    logger.addHandler(handler)
+    handler.listener = listener
+    listener.start()
+    return handler
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a sequence of numbers.
+    Args:
+        values: sequence of numbers, need not be sorted
+        q (float): percentile between 0 and 100
+    Returns:
+        Returns the value at the given percentile or None for no values.
+    Example:
+        >>> percentile([1, 2, 3, 4], 50)
+        2
+        >>> percentile([], 99) is None
+        True
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(int(math.ceil(q / 100. * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
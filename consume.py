@@ -2,38 +2,45 @@
     Example consumer to fit homeassistants mqtt switch
     https://www.home-assistant.io/components/switch.mqtt/
 '''
+import argparse
 import logging
 import os
 from logging.config import dictConfig
 
-import yaml
-from schema import And, Optional, Schema, Use
-
-from app.broker import MQTTPublisher, MQTTSubscriber
-from app.device import DeviceDict, DeviceRegistry, MemoryState
-from app.rc433 import RC433Factory
+# The transmitter child process re-imports this script as `__mp_main__`, so
+# its top level only imports what the child needs; the rest of the consumer
+# is imported and set up in `main`
+from app import transmitter
 
 
 base_path = os.path.abspath(os.path.dirname(__file__))
-
-global_config = yaml.load(open(os.path.join(base_path, 'conf/logging.yaml')))
-dictConfig(global_config['logging'])
 logger = logging.getLogger("RC433MQ")
 
-STATE_SCHEMA = Schema(And(str, Use(str.lower), lambda s: s in ('on', 'off')))
-TOPIC_SCHEMA = Schema({
-    'topic':
-    And(str, lambda s: s == 'rc433'),
-    'floor':
-    And(str, lambda s: s in ['groundfloor', 'firstfloor', 'secondfloor']),
-    'device':
-    And(str, lambda s: s[:2] in ['gf', 'ff', 'sf']),
-    Optional('command'):
-    str
-})
+
+def setup_logging():
+    """
+    Configures the logging from conf/logging.yaml.
+    Returns:
+        Returns the handler of the logging queue or None if not enabled.
+    """
+    import yaml
+
+    from app.util import queue_logging
+
+    with open(os.path.join(base_path, 'conf/logging.yaml')) as fp:
+        global_config = yaml.safe_load(fp)
+    dictConfig(global_config['logging'])
+    if not global_config.get('queue', {}).get('enabled', False):
+        return None
+    # File and console I/O happen on a background thread
+    return queue_logging(**{
+        k: v for k, v in global_config['queue'].items() if k != 'enabled'
+    })
 
 
 def get_devices():
+    from app.device import DeviceDict, DeviceRegistry, MemoryState
+
     config_file = os.path.join(base_path, 'conf/devices.json')
     logger.info("Loading devices...")
     try:
@@ -44,37 +51,181 @@ def get_devices():
         logger.error(str(why))
 
 
-if __name__ == '__main__':
+def state_topics(topics):
+    """
+    Maps the device names to their state topics, derived from the
+    `rc433/<floor>/<device>/switch` topics of the consumer config.
+    """
+    res = dict()
+    for topic in topics:
+        parts = topic.split('/')
+        if len(parts) == 4:
+            res[parts[2]] = '/'.join(parts[:3] + ['state'])
+    return res
 
-    def handle_state(client, userdata, message):
-        try:
-            TOPICS = ['topic', 'floor', 'device', 'command']
-            topic_dict = dict(zip(TOPICS, message.topic.split("/")))
-            TOPIC_SCHEMA.validate(topic_dict)
 
-            state = message.payload.decode("utf-8")
-            STATE_SCHEMA.validate(state)
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--rx-pin', type=int, default=None,
+        help='GPIO pin of a 433mhz receiver, enables the receive mode'
+    )
+    parser.add_argument(
+        '--rx-capture', default=None,
+        help='Decode a capture file of edges instead of a receiver'
+    )
+    parser.add_argument(
+        '--learn', action='store_true',
+        help='Append unknown received codes to conf/devices.json'
+    )
+    parser.add_argument(
+        '--cluster', default=None, metavar='CONFIG',
+        help='Run as node of a gateway cluster, e.g. conf/cluster.json; '
+             'the node name is taken from RC433_NODE'
+    )
+    parser.add_argument(
+        '--realtime', default=None, metavar='CONFIG',
+        help='Transmit in real-time mode, e.g. conf/realtime.json'
+    )
+    parser.add_argument(
+        '--socket', default=None, metavar='PATH',
+        help='Accept local commands on a Unix domain socket as well'
+    )
+    return parser.parse_args()
 
-            logger.info(
-                "Topic {topic_dict} received state {state}".format(**locals())
-            )
 
-            device = device_db.lookup(topic_dict['device'])
-            svc = RC433Factory.service(device)()
-            if svc.switch(device=device, state=state):
-                # return result
-                topic = "{topic}/{floor}/{device}/state".format(**topic_dict)
-                mqp.publish(topic=topic, payload=state, retain=True)
-        except Exception:
-            import traceback
-            logger.error(traceback.print_exc())
+def main():
+    from app.broker import MQTTSubscriber, QueuedMQTTPublisher
+    from app.cluster import ClusterMembership, ClusterSubscriber
+    from app.deadline import DeadlineQueue
+    from app.gateway import Gateway
+    from app.ingress import UnixSocketSubscriber
+    from app.profiler import CONTROL_TOPIC, SamplingProfiler
+    from app.ratelimit import AirtimeLimiter
+    from app.realtime import RealtimeGuard, install as install_realtime
+    from app.receiver import (DeviceLearner, GPIOEdgeSource, RC433Receiver,
+                              load_capture)
+    from app.scheduler import SCHEDULE_TOPIC, Scheduler
+    from app.snapshot import StateAggregator
+    from app.tracing import Tracer
+
+    args = parse_args()
+    log_handler = setup_logging()
 
     device_db = get_devices()
+    realtime = None
+    if args.realtime:
+        realtime = RealtimeGuard.from_config(args.realtime)
+        install_realtime(realtime)
+    if os.environ.get('RC433_BACKEND') == 'process':
+        # The child comes from the fork server, so the threads running here
+        # already (e.g. the logging queue) are not copied into it
+        transmitter.shared()
+    limiter = AirtimeLimiter.from_config(
+        os.path.join(base_path, 'conf/ratelimit.json')
+    )
     device_names = [dev.device.device_name for dev in device_db.list()]
     logger.info(
         "Loaded {} devices {}".format(str(len(device_names)), device_names)
     )
     config_file = os.path.join(base_path, 'conf/consumer.json')
-    mqs = MQTTSubscriber.from_config(config_file)
-    mqp = MQTTPublisher.from_config(config_file)
-    mqs.consume(handle_state)
+    if args.cluster:
+        mqs = ClusterSubscriber.from_config(config_file)
+        mqs.membership = ClusterMembership.from_config(args.cluster)
+    else:
+        mqs = MQTTSubscriber.from_config(config_file)
+    mqp = QueuedMQTTPublisher.from_config(config_file)
+    mqp.start()
+
+    profiler = SamplingProfiler(output_dir=os.path.join(base_path, 'logs'))
+    profiler.install_signal_handlers()
+    mqs.add_callback(CONTROL_TOPIC, profiler.handle_control)
+
+    tracer = None
+    tracing_config = os.path.join(base_path, 'conf/tracing.json')
+    if os.path.exists(tracing_config):
+        tracer = Tracer.from_config(tracing_config, base_path=base_path)
+    aggregator = None
+    if 'snapshot' in mqp.client_conf:
+        aggregator = StateAggregator.from_json(
+            mqp, mqp.client_conf['snapshot']
+        )
+        aggregator.seed(mqs)
+        aggregator.start()
+    deadlines = None
+    if 'deadlines' in mqs.client_conf:
+        deadlines = DeadlineQueue.from_json(mqs.client_conf['deadlines'])
+    gateway = Gateway(device_db, mqp, limiter=limiter, tracer=tracer,
+                      aggregator=aggregator, deadlines=deadlines)
+    gateway.start()
+    scheduler = None
+    if 'scheduler' in mqs.client_conf:
+        scheduler = Scheduler.from_json(
+            gateway.dispatch, mqs.client_conf['topics'],
+            mqs.client_conf['scheduler'],
+            owns=mqs.membership.owns if args.cluster else None
+        )
+        scheduler.start()
+        mqs.add_callback(SCHEDULE_TOPIC, scheduler.handle_control, qos=1)
+
+    rx_source = None
+    if args.rx_pin is not None or args.rx_capture:
+        topics = state_topics(mqs.client_conf['topics'])
+
+        def publish_received(device, state):
+            topic = topics.get(device.device_name)
+            if topic is not None:
+                mqp.publish(topic=topic, payload=state, retain=True)
+                if aggregator is not None:
+                    aggregator.update(device.device_name, state)
+
+        receiver = RC433Receiver(
+            device_db,
+            on_state=publish_received,
+            learner=DeviceLearner(
+                os.path.join(base_path, 'conf/devices.json')
+            ) if args.learn else None
+        )
+        if args.rx_capture:
+            receiver.feed(*load_capture(args.rx_capture))
+        else:
+            rx_source = GPIOEdgeSource(receiver, pin=args.rx_pin)
+            rx_source.start()
+
+    ingress = None
+    if args.socket:
+        ingress = UnixSocketSubscriber(args.socket, mqs.client_conf['topics'])
+        ingress.start(gateway.handle_state)
+
+    mqs.consume(gateway.enqueue_state)
+    if ingress is not None:
+        ingress.stop()
+        logger.info("Local ingress stats: {}".format(dict(ingress.counters)))
+    if rx_source is not None:
+        rx_source.stop()
+    logger.info("Publisher stats: {}".format(mqp.stats()))
+    logger.info("Airtime limiter stats: {}".format(limiter.stats()))
+    if tracer is not None:
+        logger.info("Tracing stats: {}".format(tracer.counters))
+    if log_handler is not None:
+        logger.info("Logging stats: {}".format(log_handler.stats()))
+    if realtime is not None:
+        logger.info("Real-time stats: {}".format(realtime.stats()))
+    if transmitter.current() is not None:
+        logger.info("Transmitter process stats: {}".format(
+            transmitter.current().stats()
+        ))
+    if scheduler is not None:
+        scheduler.stop()
+        logger.info("Scheduler stats: {}".format(scheduler.stats()))
+    gateway.stop()
+    if deadlines is not None:
+        logger.info("Deadline stats: {}".format(deadlines.stats()))
+    if aggregator is not None:
+        aggregator.stop()
+        logger.info("Snapshot stats: {}".format(aggregator.counters))
+    mqp.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,16 @@
 """
-    Example Producer setup
+    Load generator for the gateway: publishes switch commands for the
+    devices of conf/consumer.json and reports throughput and end-to-end
+    latency, measured by the acknowledgements on the `.../state` topics.
 """
 
+import argparse
+import json
 import logging
 import os
-import random
-import time
 
 from app.broker import MQTTPublisher
-from app.device import DeviceDict, DeviceRegistry, MemoryState
+from app.loadgen import DeviceChooser, LoadGenerator, device_topics
 
 level = logging.DEBUG
 logging.basicConfig(
@@ -19,49 +21,81 @@ logger = logging.getLogger("RC433MQ")
 base_path = os.path.abspath(os.path.dirname(__file__))
 
 
-def get_devices():
-    base_path = os.path.abspath(os.path.dirname(__file__))
-    config_file = os.path.join(base_path, 'conf/devices.json')
-    logger.info("Loading devices...")
-    try:
-        device_store = DeviceDict.from_json(config_file)
-        device_state = MemoryState()
-        return DeviceRegistry(device_store, device_state)
-    except Exception as why:
-        logger.error(str(why))
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--mode', choices=LoadGenerator.MODES, default='open',
+        help='open: send at a fixed rate, closed: wait for acknowledgements'
+    )
+    parser.add_argument(
+        '--rate', type=float, default=0.5,
+        help='commands (or scene bursts) per second in open mode'
+    )
+    parser.add_argument(
+        '--constant', action='store_true',
+        help='constant instead of poisson arrivals in open mode'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=1,
+        help='number of workers in closed mode'
+    )
+    parser.add_argument(
+        '--think', type=float, default=0.,
+        help='seconds a worker waits after an acknowledgement'
+    )
+    parser.add_argument(
+        '--distribution', choices=DeviceChooser.DISTRIBUTIONS,
+        default='uniform'
+    )
+    parser.add_argument('--hot-fraction', type=float, default=0.2)
+    parser.add_argument('--hot-share', type=float, default=0.8)
+    parser.add_argument('--scene-size', type=int, default=4)
+    parser.add_argument(
+        '--duration', type=float, default=60., help='seconds to run'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=10.,
+        help='seconds after which a command counts as lost'
+    )
+    parser.add_argument('--qos', type=int, choices=(0, 1, 2), default=0)
+    parser.add_argument(
+        '--config', default=os.path.join(base_path, 'conf/consumer.json')
+    )
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
 
-    devices = get_devices()
-    device_names = [dev.device.device_name for dev in devices.list()]
+    args = parse_args()
+    client = MQTTPublisher.from_config(args.config)
+    topics = device_topics(client.client_conf['topics'])
     logger.info("Loaded {} devices which are: {}".format(
-        str(len(device_names)), device_names))
-
-    config_file = os.path.join(base_path, 'conf/consumer.json')
-    client = MQTTPublisher.from_config(config_file)
+        str(len(topics)), sorted(topics)))
 
-    while True:
-        time.sleep(2)
-        id = random.randrange(len(device_names))
-        device = device_names[id]
-        state = "on" if id % 2 == 0 else "off"
-        # message = str(dict(
-        #         device=device,
-        #         state=state,
-        #         uuid=str(uuid.uuid4()),
-        #         ts=int(time.time())
-        #     )
-        # )
-        # logger.info("Send message {} to topic 'rc433'".format(message))
-        if device[:2] == 'gf':
-            floor = 'groundfloor'
-        elif device[:2] == 'ff':
-            floor = 'firstfloor'
-        elif device[:2] == 'sf':
-            floor = 'secondfloor'
-
-        logger.info("rc433/{}/{}/switch: {}".format(floor, device,
-                                                    state.upper()))
-        client.publish("rc433/{}/{}/switch".format(floor, device),
-                       state.upper())
+    client.connect()
+    generator = LoadGenerator(
+        client=client.client,
+        topics=topics,
+        chooser=DeviceChooser(
+            devices=list(topics),
+            distribution=args.distribution,
+            hot_fraction=args.hot_fraction,
+            hot_share=args.hot_share,
+            scene_size=args.scene_size
+        ),
+        mode=args.mode,
+        rate=args.rate,
+        constant=args.constant,
+        concurrency=args.concurrency,
+        think=args.think,
+        timeout=args.timeout,
+        qos=args.qos
+    )
+    generator.subscribe()
+    client.client.loop_start()
+    try:
+        report = generator.run(args.duration)
+    finally:
+        client.client.loop_stop()
+        client.cleanup()
+    logger.info("Report: {}".format(json.dumps(report, sort_keys=True)))
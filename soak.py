@@ -0,0 +1,104 @@
+"""
+    Soak test: replays hours of synthetic switch commands through the
+    consumer pipeline on a simulated clock and fails (exit code 1) if the
+    retained memory or the open file descriptors grow beyond a threshold.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+
+from app.broker import QueuedMQTTPublisher
+from app.device import DeviceDict, DeviceRegistry, MemoryState
+from app.ratelimit import AirtimeLimiter
+from app.soak import LoopbackClient, MemoryMonitor, SoakRunner
+
+base_path = os.path.abspath(os.path.dirname(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--hours', type=float, default=24., help='simulated hours to run'
+    )
+    parser.add_argument(
+        '--interval', type=float, default=5.,
+        help='mean simulated seconds between two commands'
+    )
+    parser.add_argument(
+        '--invalid', type=float, default=0.,
+        help='share of commands with an invalid state'
+    )
+    parser.add_argument(
+        '--warmup', type=float, default=600.,
+        help='simulated seconds before the baseline is taken'
+    )
+    parser.add_argument(
+        '--sample-interval', type=float, default=600.,
+        help='simulated seconds between two samples'
+    )
+    parser.add_argument(
+        '--max-memory-growth', type=int, default=1024,
+        help='allowed growth of the retained memory in KiB'
+    )
+    parser.add_argument(
+        '--max-fd-growth', type=int, default=0,
+        help='allowed growth of the open file descriptors'
+    )
+    parser.add_argument(
+        '--max-runtime', type=float, default=None,
+        help='real seconds after which the run ends early'
+    )
+    parser.add_argument(
+        '--broker', action='store_true',
+        help='publish the states to the broker of conf/consumer.json'
+    )
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--log-level', default='ERROR')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=args.log_level.upper()
+    )
+
+    config_file = os.path.join(base_path, 'conf/consumer.json')
+    with open(config_file, 'r') as fp:
+        topics = list(json.load(fp)['topics'])
+    registry = DeviceRegistry(
+        DeviceDict.from_json(os.path.join(base_path, 'conf/devices.json')),
+        MemoryState()
+    )
+    limiter = AirtimeLimiter.from_config(
+        os.path.join(base_path, 'conf/ratelimit.json')
+    )
+    # Waiting for the budget happens in real time, reject instead
+    limiter.policy = 'reject'
+
+    mqp = QueuedMQTTPublisher.from_config(config_file)
+    if not args.broker:
+        mqp.client = LoopbackClient()
+    mqp.start()
+
+    runner = SoakRunner(
+        registry, topics, mqp, limiter=limiter,
+        monitor=MemoryMonitor(
+            max_memory_growth=args.max_memory_growth * 1024,
+            max_fd_growth=args.max_fd_growth
+        ),
+        interval=args.interval, invalid=args.invalid,
+        rng=random.Random(args.seed)
+    )
+    res = runner.run(
+        args.hours * 3600, sample_interval=args.sample_interval,
+        warmup=args.warmup, max_runtime=args.max_runtime
+    )
+    mqp.stop()
+    print(json.dumps(res, indent=4))
+    sys.exit(0 if res['passed'] else 1)
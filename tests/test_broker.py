@@ -0,0 +1,244 @@
+import os
+import random
+import time
+
+import attr
+import paho.mqtt.client as mqtt
+
+from app.broker import Backoff, MQTTSubscriber, QueuedMQTTPublisher
+from app.spool import OutboundSpool
+
+
+@attr.s
+class FakeInfo(object):
+    mid = attr.ib()
+    rc = attr.ib(default=0)
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.published = []
+        self.on_publish = None
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload, qos, retain):
+        self.published.append((topic, payload))
+        return FakeInfo(mid=len(self.published))
+
+
+def _publisher(**publisher_conf):
+    mqp = QueuedMQTTPublisher.from_json({
+        'host': 'localhost', 'port': 1883, 'topics': {},
+        'publisher': publisher_conf
+    })
+    mqp.client = FakeClient()
+    return mqp
+
+
+def _wait_for(condition, timeout=2.):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_collapses_queued_states_per_topic():
+    mqp = _publisher()
+    mqp.publish('rc433/a/state', 'on', retain=True)
+    mqp.publish('rc433/b/state', 'on', retain=True)
+    mqp.publish('rc433/a/state', 'off', retain=True)
+    assert mqp.backlog == 2
+    mqp.start()
+    assert _wait_for(lambda: len(mqp.client.published) == 2)
+    assert mqp.client.published == [
+        ('rc433/a/state', 'off'), ('rc433/b/state', 'on')
+    ]
+    assert mqp.stats()['collapsed'] == 1
+    mqp.stop()
+
+
+def test_respects_max_inflight():
+    mqp = _publisher(max_inflight=2)
+    mqp.start()
+    for i in range(5):
+        mqp.publish('rc433/{}/state'.format(i), 'on')
+    assert _wait_for(lambda: len(mqp.client.published) == 2)
+    assert mqp.backlog == 5
+    mqp._on_publish(mqp.client, None, 1)
+    assert _wait_for(lambda: len(mqp.client.published) == 3)
+    stats = mqp.stats()
+    assert stats['acked'] == 1
+    assert stats['latency_p50'] is not None
+    mqp.stop(timeout=0.1)
+
+
+def test_drops_oldest_when_queue_is_full():
+    mqp = _publisher(max_queue=2)
+    for i in range(3):
+        mqp.publish('rc433/{}/state'.format(i), 'on')
+    assert list(mqp.pending) == ['rc433/1/state', 'rc433/2/state']
+    assert mqp.stats()['dropped'] == 1
+
+
+def test_spools_while_disconnected_and_replays(tmp_path):
+    spool = str(tmp_path / 'outbound.spool')
+    mqp = _publisher(spool=spool, fsync_batch=1)
+    mqp.start()
+    mqp.publish('rc433/a/state', 'on', retain=True)
+    mqp.publish('rc433/b/state', 'on', retain=True)
+    assert _wait_for(lambda: mqp.stats()['spooled'] == 2)
+    mqp.publish('rc433/a/state', 'off', retain=True)
+    assert _wait_for(lambda: mqp.stats()['spooled'] == 3)
+    assert mqp.client.published == []
+    assert len(mqp.spool) == 3
+
+    mqp._on_connect(mqp.client, None, {}, 0)
+    assert _wait_for(lambda: len(mqp.client.published) == 2)
+    assert mqp.client.published == [
+        ('rc433/b/state', 'on'), ('rc433/a/state', 'off')
+    ]
+    assert mqp.stats()['replayed'] == 2
+    assert len(mqp.spool) == 0
+    assert not os.path.exists(mqp.spool.replay_file_name)
+    mqp.stop(timeout=0.1)
+
+
+def test_spool_syncs_a_single_message_in_time(tmp_path):
+    mqp = _publisher(spool=str(tmp_path / 'outbound.spool'),
+                     fsync_interval=0.05)
+    mqp.start()
+    mqp.publish('rc433/a/state', 'on', retain=True)
+    mqp.publish('rc433/b/state', 'on', retain=True)
+    assert _wait_for(lambda: mqp.stats()['spooled'] == 2)
+    assert _wait_for(lambda: mqp.spool.sync_due() is None)
+    mqp.stop(timeout=0.1)
+
+
+def test_drained_messages_survive_a_crash_during_replay(tmp_path):
+    spool = OutboundSpool(str(tmp_path / 'outbound.spool'))
+    spool.append('rc433/a/state', 'on')
+    assert spool.drain() == [('rc433/a/state', 'on', 0, False)]
+    spool.append('rc433/b/state', 'on')
+    spool.close()
+
+    restarted = OutboundSpool(str(tmp_path / 'outbound.spool'))
+    assert restarted.drain() == [
+        ('rc433/a/state', 'on', 0, False), ('rc433/b/state', 'on', 0, False)
+    ]
+    restarted.replayed()
+    assert restarted.drain() == []
+
+
+def test_spools_inflight_messages_on_disconnect(tmp_path):
+    mqp = _publisher(spool=str(tmp_path / 'outbound.spool'))
+    mqp._on_connect(mqp.client, None, {}, 0)
+    mqp.start()
+    mqp.publish('rc433/a/state', 'on', retain=True)
+    assert _wait_for(lambda: len(mqp.inflight) == 1)
+    mqp._on_disconnect(mqp.client, None, 1)
+    assert mqp.inflight == {}
+    assert mqp.spool.drain() == [('rc433/a/state', 'on', 0, True)]
+    mqp.stop(timeout=0.1)
+
+
+class FakeSubscriberClient(object):
+    def __init__(self, results):
+        self.results = list(results)
+        self.subscriptions = []
+        self.reconnects = 0
+        self.disconnects = 0
+        self.subscribe_rc = mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, topics, qos=0):
+        self.subscriptions.append(topics)
+        return (self.subscribe_rc, 1)
+
+    def message_callback_add(self, topic, callback):
+        pass
+
+    def loop(self, timeout=1.0):
+        return self.results.pop(0)
+
+    def reconnect(self):
+        self.reconnects += 1
+
+    def disconnect(self):
+        self.disconnects += 1
+
+
+def _subscriber(**session):
+    mqs = MQTTSubscriber.from_json({
+        'host': 'localhost', 'port': 1883,
+        'topics': {'rc433/groundfloor/gf_lamp/switch': 1},
+        'session': session
+    })
+    mqs.backoff = Backoff(0.001, 0.004, rng=random.Random(1))
+    return mqs
+
+
+def test_backoff_grows_with_jitter():
+    backoff = Backoff(1, 8, rng=random.Random(1))
+    delays = [backoff.next() for _ in range(6)]
+    assert all(1 <= d <= 8 for d in delays)
+    assert delays[0] <= 1 and max(delays[3:]) > 2
+    backoff.reset()
+    assert backoff.next() == 1
+
+
+def test_persistent_session_has_stable_client_id(monkeypatch):
+    monkeypatch.delenv('MQTT_CLIENT_ID', raising=False)
+    client = _subscriber(client_id='rc433mq-test')._create_client()
+    assert client._client_id == b'rc433mq-test'
+    assert client._clean_session is False
+    monkeypatch.setenv('MQTT_CLIENT_ID', 'from-env')
+    assert _subscriber().client_id() == 'from-env'
+
+
+def test_resumed_session_skips_subscribing():
+    mqs = _subscriber()
+    mqs.client = FakeSubscriberClient([])
+    mqs._on_connect(mqs.client, None, {'session present': 0}, 0)
+    mqs._on_connect(mqs.client, None, {'session present': 1}, 0)
+    assert len(mqs.client.subscriptions) == 1
+    assert mqs.counters['resumed'] == 1
+    mqs._on_connect(mqs.client, None, {'session present': 0}, 0)
+    assert len(mqs.client.subscriptions) == 2
+
+
+def test_subscription_failure_reconnects_instead_of_raising():
+    mqs = _subscriber()
+    mqs.client = FakeSubscriberClient([])
+    mqs.client.subscribe_rc = mqtt.MQTT_ERR_NO_CONN
+    mqs._on_connect(mqs.client, None, {'session present': 0}, 0)
+    assert mqs.client.disconnects == 1
+    assert mqs.counters['subscribe_failures'] == 1
+
+
+def test_loop_reconnects_with_backoff():
+    mqs = _subscriber()
+    results = [mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_CONN_LOST,
+               mqtt.MQTT_ERR_NO_CONN, mqtt.MQTT_ERR_SUCCESS]
+    mqs.client = FakeSubscriberClient(results)
+    # Stops once the results are used up
+    mqs.client.results.append(KeyboardInterrupt)
+
+    def loop(timeout=1.0):
+        res = mqs.client.results.pop(0)
+        if res is KeyboardInterrupt:
+            mqs._stopping = True
+            return mqtt.MQTT_ERR_SUCCESS
+        return res
+
+    mqs.client.loop = loop
+    mqs.loop_forever()
+    assert mqs.client.reconnects == 2
+    assert mqs.counters['reconnect_attempts'] == 2
+    assert mqs.backoff.attempts == 2
@@ -0,0 +1,179 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+import attr
+import pytest
+
+from app.broker import MQTTPublisher
+from app.cluster import ClusterMembership, ClusterSubscriber, HashRing
+
+BASE_PATH = os.path.abspath(os.path.dirname(__file__))
+TOPICS = {
+    'rc433/groundfloor/gf_device{}/switch'.format(i): 0 for i in range(20)
+}
+
+
+@attr.s
+class FakeMessage(object):
+    topic = attr.ib()
+    payload = attr.ib()
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.topics = set()
+        self.published = []
+
+    def subscribe(self, topics, qos=0):
+        if isinstance(topics, str):
+            topics = [(topics, qos)]
+        self.topics.update(t for t, _ in topics)
+        return 0, 1
+
+    def unsubscribe(self, topics):
+        self.topics.difference_update(topics)
+
+    def publish(self, topic, payload, qos=0):
+        self.published.append((topic, payload))
+
+
+def _subscriber(node, nodes, **kwargs):
+    mqs = ClusterSubscriber.from_json(
+        {'host': 'localhost', 'port': 1883, 'topics': TOPICS}
+    )
+    mqs.membership = ClusterMembership(node, nodes, **kwargs)
+    mqs.client = FakeClient()
+    return mqs
+
+
+def test_hash_ring_only_moves_devices_of_lost_node():
+    devices = ['device{}'.format(i) for i in range(200)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b'])
+    owners = {d: before.owner(d) for d in devices}
+    assert set(owners.values()) == {'a', 'b', 'c'}
+    for device, owner in owners.items():
+        if owner != 'c':
+            assert after.owner(device) == owner
+
+
+def test_each_device_has_exactly_one_owner():
+    nodes = ['a', 'b', 'c']
+    members = [
+        ClusterMembership(node, nodes, assignments={'gf_device1': 'c'})
+        for node in nodes
+    ]
+    for topic in TOPICS:
+        owners = [m.node for m in members if m.owns(topic.split('/')[2])]
+        assert len(owners) == 1
+    assert members[2].owns('gf_device1')
+
+
+def test_failover_moves_subscriptions():
+    subscribers = [
+        _subscriber(node, ['a', 'b'], timeout=10., shared_group='rc433')
+        for node in ('a', 'b')
+    ]
+    for mqs in subscribers:
+        mqs._on_connect(mqs.client, None, None, 0)
+    topics = [mqs.client.topics for mqs in subscribers]
+    assert not (topics[0] & topics[1]) - {'rc433/$cluster/+'}
+    assert len(topics[0] | topics[1]) == len(TOPICS) + 1
+    assert all(t.startswith(('$share/rc433/', 'rc433/$cluster'))
+               for t in topics[0])
+
+    a = subscribers[0]
+    a._on_heartbeat(a.client, None, FakeMessage(
+        'rc433/$cluster/b', b'offline'
+    ))
+    assert len(a.client.topics) == len(TOPICS) + 1
+
+    a.membership.seen('b')
+    a._rebalance()
+    assert a.client.topics == topics[0]
+
+
+def test_reconnect_drops_subscriptions_of_persistent_session():
+    mqs = _subscriber('a', ['a', 'b'], timeout=10., shared_group='rc433')
+    mqs.membership.seen('b')
+    # The broker kept all subscriptions of a session when `a` was alone
+    mqs.client.topics.update(
+        mqs.membership.subscription(t) for t in TOPICS
+    )
+    mqs._on_connect(mqs.client, None, None, 0)
+    owned = {mqs.membership.subscription(t) for t in mqs.owned_topics()}
+    assert 0 < len(owned) < len(TOPICS)
+    assert mqs.client.topics == owned | {'rc433/$cluster/+'}
+
+
+def test_switch_messages_only_for_owned_devices():
+    mqs = _subscriber('a', ['a', 'b'], assignments={
+        'gf_device{}'.format(i): 'b' for i in range(20)
+    })
+    received = []
+    mqs._on_message_call = lambda c, u, m: received.append(m.topic)
+    for topic in TOPICS:
+        mqs._on_switch(mqs.client, None, FakeMessage(topic, b'on'))
+    assert received == []
+
+
+def test_membership_from_config(monkeypatch):
+    monkeypatch.setenv('RC433_NODE', 'pi-firstfloor')
+    config = os.path.join(BASE_PATH, '../conf/cluster.json')
+    members = ClusterMembership.from_config(config)
+    assert members.node == 'pi-firstfloor'
+    assert not members.owns('gf_kitchen_window')
+
+
+def _broker_available(host='localhost', port=1883):
+    try:
+        socket.create_connection((host, port), timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+
+@pytest.mark.skipif(not _broker_available(),
+                    reason='needs a local mosquitto on port 1883')
+def test_cluster_against_local_broker():
+    prefix = 'rc433test{}'.format(uuid.uuid4().hex[:6])
+    topics = {
+        '{}/groundfloor/gf_device{}/switch'.format(prefix, i): 1
+        for i in range(10)
+    }
+    received = {'a': [], 'b': []}
+    nodes = []
+    for node in ('a', 'b'):
+        mqs = ClusterSubscriber.from_json(
+            {'host': 'localhost', 'port': 1883, 'topics': topics}
+        )
+        mqs.membership = ClusterMembership(
+            node, ['a', 'b'], shared_group=prefix
+        )
+
+        def on_message(client, userdata, message, node=node):
+            received[node].append(message.topic)
+
+        threading.Thread(
+            target=mqs.consume, args=(on_message, ), daemon=True
+        ).start()
+        nodes.append(mqs)
+    time.sleep(1.)
+
+    publisher = MQTTPublisher.from_json(
+        {'host': 'localhost', 'port': 1883, 'topics': {}}
+    )
+    publisher.connect()
+    publisher.client.loop_start()
+    for topic in topics:
+        publisher.client.publish(topic, 'on', qos=1)
+    time.sleep(1.)
+    publisher.client.loop_stop()
+    for mqs in nodes:
+        mqs.cleanup()
+
+    handled = received['a'] + received['b']
+    assert sorted(handled) == sorted(topics)
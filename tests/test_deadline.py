@@ -0,0 +1,65 @@
+from app.deadline import DeadlineQueue, parse_payload
+
+
+class FakeClock(object):
+    def __init__(self, now=100.):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_commands_are_taken_earliest_deadline_first():
+    queue = DeadlineQueue(default=10, devices={'ff_tree': 60},
+                          clock=FakeClock())
+    tree = queue.submit('rc433/firstfloor/ff_tree/switch', b'on')
+    lamp = queue.submit('rc433/groundfloor/gf_lamp/switch', b'on')
+    urgent = queue.submit('rc433/groundfloor/gf_fan/switch', b'off', ttl=1)
+    assert (tree.deadline, lamp.deadline, urgent.deadline) == (160, 110, 101)
+    assert [queue.get(0) for _ in range(3)] == [urgent, lamp, tree]
+    assert queue.get(0) is None
+
+
+def test_newer_command_replaces_pending_one():
+    queue = DeadlineQueue(default=10, clock=FakeClock())
+    lamp = queue.submit('rc433/groundfloor/gf_lamp/switch', b'on', ttl=1)
+    fan = queue.submit('rc433/groundfloor/gf_fan/switch', b'on', ttl=5)
+    newer = queue.submit('rc433/groundfloor/gf_lamp/switch', b'off')
+    assert lamp.wait(0) is False
+    assert len(queue) == 2 and queue.counters['superseded'] == 1
+    assert [queue.get(0) for _ in range(2)] == [fan, newer]
+    assert queue.get(0) is None
+
+    for i in range(1000):
+        queue.submit('rc433/groundfloor/gf_lamp/switch', b'on', ttl=i + 1)
+    assert len(queue) == 1 and len(queue._heap) <= 2 + 64
+
+
+def test_expired_commands_are_discarded():
+    queue = DeadlineQueue(default=10, clock=FakeClock())
+    stale = queue.submit('rc433/groundfloor/gf_lamp/switch', b'on',
+                         received=80)
+    fresh = queue.submit('rc433/groundfloor/gf_fan/switch', b'off')
+    assert queue.get(0) is fresh
+    assert stale.wait(0) is False
+    assert queue.counters['expired'] == 1
+    assert queue.stats()['slack_min'] == 10
+
+
+def test_full_queue_rejects_commands():
+    queue = DeadlineQueue(max_pending=1)
+    queue.submit('rc433/groundfloor/gf_lamp/switch', b'on')
+    rejected = queue.submit('rc433/groundfloor/gf_fan/switch', b'off')
+    assert rejected.wait(0) is False
+    assert queue.counters['rejected'] == 1
+
+
+def test_parse_payload():
+    assert parse_payload(b'{"state": "ON", "ttl": 2}') == ('ON', 2.)
+    assert parse_payload(b'{"state": "off"}') == ('off', None)
+    assert parse_payload(b'on') == (b'on', None)
+    assert parse_payload(b'{"ttl": 2}') == (b'{"ttl": 2}', None)
+    for ttl in (b'NaN', b'Infinity', b'-1', b'0', b'"soon"'):
+        payload = b'{"state": "on", "ttl": ' + ttl + b'}'
+        # Fails the validation of the state and is dropped
+        assert parse_payload(payload) == (payload, None)
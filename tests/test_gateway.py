@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from app.backend import RecordingBackend
+from app.deadline import DeadlineQueue
+from app.device import DeviceDict, DeviceRegistry, MemoryState
+from app.gateway import Gateway
+from app.snapshot import StateAggregator
+from app.tracing import Tracer, span
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+def _gateway(tracer=None):
+    registry = DeviceRegistry(DeviceDict({
+        'gf_lamp': {'system_code': '10100', 'device_code': 'B'},
+        'gf_tree': {'system_code': '10100', 'device_code': 'C'}
+    }), MemoryState())
+    return Gateway(registry, FakePublisher(), tracer=tracer)
+
+
+def _read_traces(tracer):
+    tracer.close()
+    with open(tracer.file_name) as fp:
+        return [json.loads(line) for line in fp]
+
+
+def test_dispatch_switches_and_publishes(monkeypatch):
+    monkeypatch.setenv('RC433_BACKEND', 'recording')
+    gateway = _gateway()
+    assert gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'ON')
+    assert gateway.publisher.published == [
+        ('rc433/groundfloor/gf_lamp/state', 'ON')
+    ]
+    assert not gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'dim')
+    assert not gateway.dispatch('rc433/groundfloor/gf_none/switch', b'on')
+    assert len(gateway.publisher.published) == 1
+
+
+def test_dispatch_updates_aggregator(monkeypatch):
+    monkeypatch.setenv('RC433_BACKEND', 'recording')
+    gateway = _gateway()
+    gateway.aggregator = StateAggregator(FakePublisher())
+    gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'ON')
+    gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'dim')
+    assert gateway.aggregator.pending == {'gf_lamp': 'on'}
+
+
+def test_traces_have_stage_spans(monkeypatch, tmpdir):
+    monkeypatch.setenv('RC433_BACKEND', 'recording')
+    tracer = Tracer(sample_rate=1., file_name=str(tmpdir.join('t.jsonl')))
+    gateway = _gateway(tracer)
+    gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'on',
+                     received=time.monotonic() - 0.01)
+
+    traces = _read_traces(tracer)
+    assert len(traces) == 1
+    spans = traces[0]['resourceSpans'][0]['scopeSpans'][0]['spans']
+    names = [s['name'] for s in spans]
+    assert names == [
+        'handle_state', 'queued', 'validate', 'lookup', 'service',
+        'switch', 'gpio_setup', 'transmit', 'publish'
+    ]
+    root = spans[0]
+    assert len(root['traceId']) == 32
+    assert all(s['traceId'] == root['traceId'] for s in spans)
+    by_name = {s['name']: s for s in spans}
+    assert by_name['transmit']['parentSpanId'] == \
+        by_name['switch']['spanId']
+    queued = by_name['queued']
+    assert int(queued['endTimeUnixNano']) - \
+        int(queued['startTimeUnixNano']) >= 10 ** 7
+
+
+def test_only_sampled_or_slow_traces_are_written(monkeypatch, tmpdir):
+    monkeypatch.setenv('RC433_BACKEND', 'recording')
+    tracer = Tracer(sample_rate=0., slow_threshold=0.05,
+                    file_name=str(tmpdir.join('t.jsonl')))
+    gateway = _gateway(tracer)
+    gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'on')
+    monkeypatch.setattr(
+        RecordingBackend, 'transmit', lambda self, p: time.sleep(0.06) or 1
+    )
+    gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'off')
+    gateway.dispatch('rc433/groundfloor/gf_lamp/switch', b'dim')
+
+    traces = _read_traces(tracer)
+    assert len(traces) == 1
+    assert tracer.counters == dict(traces=3, written=1, slow=1)
+
+
+def test_span_without_trace_is_noop():
+    with span('transmit') as s:
+        assert s is None
+
+
+def test_gateway_switches_by_deadline(monkeypatch):
+    monkeypatch.setenv('RC433_BACKEND', 'recording')
+    gateway = _gateway()
+    gateway.deadlines = DeadlineQueue(default=10)
+    order = []
+    taken, release = threading.Event(), threading.Event()
+
+    def handle(topic, payload, received, deadline=None):
+        taken.set()
+        release.wait(5)
+        order.append((topic.split('/')[2], payload))
+        return Gateway._handle(gateway, topic, payload, received, deadline)
+
+    gateway._handle = handle
+    gateway.start()
+    try:
+        for device, payload in (
+                ('gf_lamp', b'{"state": "on", "ttl": 30}'),
+                ('gf_lamp', b'{"state": "off", "ttl": 20}'),
+                ('gf_fan', b'{"state": "on", "ttl": 0.000001}'),
+                ('gf_lamp', b'{"state": "ON", "ttl": 30}'),
+                ('gf_tree', b'{"state": "off", "ttl": 5}')):
+            message = mqtt.MQTTMessage(
+                topic='rc433/groundfloor/{}/switch'.format(device).encode()
+            )
+            message.payload = payload
+            message.timestamp = time.monotonic()
+            gateway.enqueue_state(None, None, message)
+            # The first command is taken right away, the others wait for it
+            taken.wait(5)
+        release.set()
+        end = time.monotonic() + 5
+        while len(gateway.deadlines) and time.monotonic() < end:
+            time.sleep(0.005)
+    finally:
+        gateway.stop()
+    # Earliest deadline first, but the newest command of a device wins
+    assert order == [('gf_lamp', 'on'), ('gf_tree', 'off'), ('gf_lamp', 'ON')]
+    assert gateway.deadlines.counters['expired'] == 1
+    assert gateway.deadlines.counters['superseded'] == 1
+    assert gateway.publisher.published[-1] == (
+        'rc433/groundfloor/gf_lamp/state', 'ON'
+    )
+
+
+def test_commands_with_invalid_ttl_are_dropped(monkeypatch):
+    monkeypatch.setenv('RC433_BACKEND', 'recording')
+    gateway = _gateway()
+    gateway.deadlines = DeadlineQueue(default=10)
+    gateway.start()
+    try:
+        for ttl in (b'NaN', b'-Infinity', b'0'):
+            message = mqtt.MQTTMessage(
+                topic=b'rc433/groundfloor/gf_lamp/switch'
+            )
+            message.payload = b'{"state": "on", "ttl": ' + ttl + b'}'
+            message.timestamp = time.monotonic()
+            assert gateway.handle_state(None, None, message) is False
+    finally:
+        gateway.stop()
+    assert gateway.publisher.published == []
+    assert gateway.deadlines.counters['expired'] == 0
@@ -0,0 +1,112 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from app.device import DeviceDict, DeviceRegistry, MemoryState
+from app.gateway import Gateway
+from app.ingress import UnixSocketSubscriber, send_commands
+from app.simulator import Simulator
+
+TOPICS = [
+    'rc433/groundfloor/gf_lamp/switch',
+    'rc433/firstfloor/ff_tree/switch'
+]
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+def _ingress(tmp_path):
+    registry = DeviceRegistry(DeviceDict({
+        'gf_lamp': {'system_code': '10100', 'device_code': 'B'},
+        'ff_tree': {'system_code': '10100', 'device_code': 'C'}
+    }), MemoryState())
+    gateway = Gateway(registry, FakePublisher(),
+                      service_factory=Simulator().service)
+    ingress = UnixSocketSubscriber(str(tmp_path / 'rc433mq.sock'), TOPICS)
+    ingress.start(gateway.handle_state)
+    return ingress, gateway
+
+
+def test_pipelined_batch_is_dispatched_in_order(tmp_path):
+    ingress, gateway = _ingress(tmp_path)
+    try:
+        replies = send_commands(ingress.path, [
+            ('gf_lamp', 'on'), ('ff_tree', 'OFF'), ('gf_lamp', 'off'),
+            ('gf_none', 'on'), ('ff_tree', 'dim'),
+            ('rc433/firstfloor/ff_tree/switch', 'on')
+        ])
+    finally:
+        ingress.stop()
+    assert replies == [
+        'OK gf_lamp on', 'OK ff_tree off', 'OK gf_lamp off',
+        'ERR gf_none unknown device', 'ERR ff_tree failed',
+        'OK rc433/firstfloor/ff_tree/switch on'
+    ]
+    assert gateway.publisher.published == [
+        ('rc433/groundfloor/gf_lamp/state', 'on'),
+        ('rc433/firstfloor/ff_tree/state', 'OFF'),
+        ('rc433/groundfloor/gf_lamp/state', 'off'),
+        ('rc433/firstfloor/ff_tree/state', 'on')
+    ]
+    assert ingress.counters['commands'] == 6
+    assert ingress.counters['ok'] == 4
+
+
+def test_slow_batch_does_not_hold_up_other_connections(tmp_path):
+    handled = []
+
+    def on_message(client, userdata, message):
+        handled.append(message.topic)
+        if message.topic == TOPICS[0]:
+            time.sleep(0.2)
+
+    ingress = UnixSocketSubscriber(str(tmp_path / 'rc433mq.sock'), TOPICS)
+    ingress.start(on_message)
+    batch = threading.Thread(
+        target=send_commands, args=(ingress.path, [('gf_lamp', 'on')] * 5)
+    )
+    try:
+        batch.start()
+        while not handled:
+            time.sleep(0.01)
+        start = time.monotonic()
+        assert send_commands(ingress.path, [('ff_tree', 'on')]) == [
+            'OK ff_tree on'
+        ]
+        assert time.monotonic() - start < 0.6
+        batch.join()
+    finally:
+        ingress.stop()
+    assert handled.index(TOPICS[1]) < 3
+
+
+def test_partial_lines_and_cleanup(tmp_path):
+    ingress, _ = _ingress(tmp_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(ingress.path)
+        sock.sendall(b'gf_lamp')
+        sock.sendall(b' on\nbogus\n')
+        data = b''
+        while data.count(b'\n') < 2:
+            data += sock.recv(1024)
+    assert data == b'OK gf_lamp on\nERR bogus malformed\n'
+    ingress.stop()
+    assert not (tmp_path / 'rc433mq.sock').exists()
+
+
+def test_refuses_to_replace_other_files(tmp_path):
+    path = tmp_path / 'important.txt'
+    path.write_text('keep me')
+    ingress = UnixSocketSubscriber(str(path), TOPICS)
+    with pytest.raises(FileExistsError):
+        ingress.connect()
+    assert path.read_text() == 'keep me'
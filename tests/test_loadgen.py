@@ -0,0 +1,97 @@
+import random
+import threading
+
+import attr
+import pytest
+
+from app.loadgen import (DeviceChooser, LatencyTracker, LoadGenerator,
+                         device_topics)
+
+TOPICS = device_topics([
+    'rc433/groundfloor/gf_device{}/switch'.format(i) for i in range(10)
+])
+
+
+@attr.s
+class FakeMessage(object):
+    topic = attr.ib()
+    payload = attr.ib()
+    retain = attr.ib(default=False)
+
+
+class LoopbackClient(object):
+    """Acknowledges every switch command like the gateway would."""
+
+    def __init__(self, delay=0.001):
+        self.delay = delay
+        self.on_message = None
+        self.subscribed = []
+
+    def subscribe(self, topics):
+        self.subscribed.extend(topics)
+
+    def publish(self, topic, payload, qos=0):
+        state = topic.rsplit('/', 1)[0] + '/state'
+        message = FakeMessage(state, payload.lower().encode('utf-8'))
+        threading.Timer(
+            self.delay, self.on_message, args=(self, None, message)
+        ).start()
+
+
+def test_tracker_correlates_and_supersedes():
+    now = [0.]
+    tracker = LatencyTracker(clock=lambda: now[0])
+    tracker.sent('a', 'on')
+    tracker.sent('a', 'off')
+    tracker.sent('a', 'on')
+    now[0] = 1.
+    assert tracker.acked('a', 'off') == 1.
+    assert tracker.acked('b', 'on') is None
+    now[0] = 20.
+    tracker.expire(10.)
+    report = tracker.report(2.)
+    assert report['acked'] == 1
+    assert report['superseded'] == 1
+    assert report['unexpected'] == 1
+    assert report['lost'] == 1
+    assert report['throughput'] == 0.5
+
+
+def test_chooser_distributions():
+    devices = ['d{}'.format(i) for i in range(10)]
+    rng = random.Random(1)
+    hotspot = DeviceChooser(devices, 'hotspot', hot_fraction=0.2,
+                            hot_share=0.9, rng=rng)
+    picks = [hotspot.choose()[0] for _ in range(1000)]
+    assert sum(p in ('d0', 'd1') for p in picks) > 850
+    scene = DeviceChooser(devices, 'scene', scene_size=4, rng=rng)
+    assert len(set(scene.choose())) == 4
+
+
+@pytest.mark.parametrize('mode', LoadGenerator.MODES)
+def test_load_generator_against_loopback(mode):
+    generator = LoadGenerator(
+        client=LoopbackClient(),
+        topics=TOPICS,
+        chooser=DeviceChooser(list(TOPICS), rng=random.Random(2)),
+        mode=mode, rate=200, concurrency=4, timeout=1.
+    )
+    generator.subscribe()
+    report = generator.run(0.3)
+    assert report['sent'] > 10
+    assert report['acked'] + report['superseded'] == report['sent']
+    assert report.get('lost', 0) == 0
+    assert 0 < report['p50'] <= report['p99'] < 1.
+    assert report['throughput'] > 0
+
+
+def test_retained_states_are_ignored():
+    generator = LoadGenerator(
+        client=LoopbackClient(), topics=TOPICS,
+        chooser=DeviceChooser(list(TOPICS))
+    )
+    generator._on_message(None, None, FakeMessage(
+        TOPICS['gf_device1'][1], b'on', retain=True
+    ))
+    assert generator.tracker.report(1.)['pending'] == 0
+    assert 'unexpected' not in generator.tracker.counters
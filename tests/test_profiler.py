@@ -0,0 +1,97 @@
+import os
+import signal
+import threading
+import time
+
+import attr
+
+from app.profiler import SamplingProfiler
+
+
+@attr.s
+class FakeMessage(object):
+    payload = attr.ib()
+
+
+def busy_transmitter(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def _busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=busy_transmitter, args=(stop, ), name='transmitter'
+    )
+    thread.start()
+    return thread, stop
+
+
+def test_samples_busy_threads(tmpdir):
+    profiler = SamplingProfiler(interval=0.001, output_dir=str(tmpdir))
+    assert not profiler.running
+    thread, stop = _busy_thread()
+    sleeper = threading.Thread(target=stop.wait, name='sleeper')
+    sleeper.start()
+    assert profiler.start()
+    assert not profiler.start()
+    time.sleep(0.1)
+    file_name = profiler.stop()
+    stop.set()
+    thread.join()
+    sleeper.join()
+
+    with open(file_name) as fp:
+        lines = fp.read().splitlines()
+    assert any(
+        line.startswith('transmitter;') and 'busy_transmitter' in line
+        for line in lines
+    )
+    assert not any(line.startswith(('profiler;', 'sleeper;'))
+                   for line in lines)
+    assert profiler.idle > 0
+    assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+    assert profiler.stop() is None
+
+
+def test_control_topic_and_bounded_window(tmpdir):
+    profiler = SamplingProfiler(
+        interval=0.001, max_duration=0.05, output_dir=str(tmpdir)
+    )
+    profiler.handle_control(None, None, FakeMessage(b'start 10'))
+    assert profiler.running
+    time.sleep(0.2)
+    assert not profiler.running
+    assert len(tmpdir.listdir()) == 1
+
+    profiler.handle_control(None, None, FakeMessage(b'start'))
+    profiler.handle_control(None, None, FakeMessage(b'stop'))
+    assert not profiler.running
+    assert not any(t.name == 'profiler' for t in threading.enumerate())
+
+
+def test_malformed_control_messages_are_ignored(tmpdir):
+    profiler = SamplingProfiler(output_dir=str(tmpdir))
+    for payload in (b'start abc', b'start -1', b'start inf', b'\xff'):
+        profiler.handle_control(None, None, FakeMessage(payload))
+    assert not profiler.running
+
+
+def test_signals_are_handled_by_a_watching_thread(tmpdir):
+    profiler = SamplingProfiler(interval=0.001, output_dir=str(tmpdir))
+    previous = signal.getsignal(signal.SIGUSR1), \
+        signal.getsignal(signal.SIGUSR2)
+    profiler.install_signal_handlers()
+    try:
+        os.kill(os.getpid(), signal.SIGUSR1)
+        end = time.monotonic() + 5
+        while not profiler.running and time.monotonic() < end:
+            time.sleep(0.01)
+        assert profiler.running
+        os.kill(os.getpid(), signal.SIGUSR2)
+        while profiler.running and time.monotonic() < end:
+            time.sleep(0.01)
+        assert not profiler.running
+    finally:
+        signal.signal(signal.SIGUSR1, previous[0])
+        signal.signal(signal.SIGUSR2, previous[1])
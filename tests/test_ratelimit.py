@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from app.backend import RecordingBackend
+from app.device import CodeDevice, SystemDevice
+from app.ratelimit import AirtimeLimiter, CommandExpired, RateLimitExceeded
+from app.rc433 import RC433Code, RC433Switch
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_airtime_from_encoding():
+    switch = RC433Switch(backend=RecordingBackend())
+    device = SystemDevice(
+        device_name='test', system_code='00001', device_code='A'
+    )
+    assert switch.airtime(device) == pytest.approx(0.384)
+    code = RC433Code()
+    device = CodeDevice(device_name='test', code_on=1, code_off=2)
+    assert code.airtime(device) == pytest.approx(5 * 10 * 128 * 350e-6)
+
+
+def test_reject_policy_with_burst_and_sustained_rate():
+    clock = FakeClock()
+    limiter = AirtimeLimiter(
+        transmitter_rate=0.1, transmitter_burst=1., device_rate=1.,
+        device_burst=10., policy='reject', clock=clock
+    )
+    limiter.acquire(17, 'a', 0.5)
+    limiter.acquire(17, 'b', 0.5)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(17, 'c', 0.5)
+    clock.now = 5.
+    limiter.acquire(17, 'c', 0.5)
+    # another transmitter has its own budget
+    limiter.acquire(27, 'd', 0.5)
+    stats = limiter.stats()
+    assert stats['allowed'] == 4
+    assert stats['rejected'] == 1
+    assert stats['throttled'] == 1
+    assert stats['airtime'] == pytest.approx(2.)
+
+
+def test_device_budget_does_not_starve_others():
+    clock = FakeClock()
+    limiter = AirtimeLimiter(
+        transmitter_rate=1., transmitter_burst=10., device_rate=0.01,
+        device_burst=0.4, policy='reject', clock=clock
+    )
+    limiter.acquire(17, 'noisy', 0.384)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(17, 'noisy', 0.384)
+    limiter.acquire(17, 'quiet', 0.384)
+
+
+def test_delay_policy_waits_for_budget():
+    limiter = AirtimeLimiter(
+        transmitter_rate=1., transmitter_burst=0.05, policy='delay',
+        max_delay=1.
+    )
+    assert limiter.acquire(17, 'a', 0.05) == 0.
+    assert limiter.acquire(17, 'a', 0.05) >= 0.04
+    assert limiter.stats()['delayed'] == 1
+
+
+def test_delay_policy_rejects_beyond_max_delay():
+    limiter = AirtimeLimiter(
+        transmitter_rate=0.1, transmitter_burst=0.1, max_delay=0.5
+    )
+    limiter.acquire(17, 'a', 0.1)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(17, 'a', 0.1)
+
+
+def test_delay_policy_does_not_wait_past_deadline():
+    clock = FakeClock()
+    limiter = AirtimeLimiter(
+        transmitter_rate=0.1, transmitter_burst=0.1, max_delay=5., clock=clock
+    )
+    limiter.acquire(17, 'a', 0.1, deadline=0.)
+    with pytest.raises(CommandExpired):
+        limiter.acquire(17, 'a', 0.1, deadline=0.5)
+    assert limiter.stats()['expired'] == 1
+    clock.now = 1.
+    assert limiter.acquire(17, 'a', 0.1, deadline=1.) == 0.
+
+
+def test_switch_is_limited():
+    limiter = AirtimeLimiter(transmitter_burst=0.4, policy='reject')
+    device = SystemDevice(
+        device_name='test', system_code='00001', device_code='A'
+    )
+    svc = RC433Switch(limiter=limiter, backend=RecordingBackend())
+    assert svc.switch(device=device, state='on')
+    with pytest.raises(RateLimitExceeded):
+        svc.switch(device=device, state='off')
+    assert len(svc.backend.transmissions) == 1
+
+
+def test_limiter_from_config():
+    base_path = os.path.abspath(os.path.dirname(__file__))
+    config = os.path.join(base_path, '../conf/ratelimit.json')
+    limiter = AirtimeLimiter.from_config(config)
+    assert limiter.policy == 'delay'
+
+
+def test_shipped_config_allows_on_and_off_of_code_devices():
+    limiter = AirtimeLimiter.from_config(
+        os.path.join(os.path.dirname(__file__), '..', 'conf',
+                     'ratelimit.json')
+    )
+    limiter.policy = 'reject'
+    airtime = RC433Code().airtime(None)
+    for _ in range(4):
+        limiter.acquire(17, 'ff_tree', airtime)
+    # a scene of 8 code devices on another transmitter
+    for i in range(8):
+        limiter.acquire(4, 'ff_device{}'.format(i), airtime)
+    defaults = AirtimeLimiter()
+    assert defaults.device_burst >= 4 * airtime
+    assert defaults.transmitter_burst >= 8 * airtime
@@ -1,5 +1,10 @@
+import numpy as np
+
+from app import backend as backends
+from app.backend import PigpioBackend, RecordingBackend
 from app.device import SystemDevice
 from app.rc433 import RC433Factory, RC433Switch
+from app.receiver import decode_pulses, system_command
 
 
 def test_rc433_factory():
@@ -12,3 +17,62 @@ def test_rc433_factory():
 
 def test_rc44_factory_stateful_device():
     pass
+
+
+def test_rc433_switch_transmits_via_backend():
+    backend = RecordingBackend()
+    device = SystemDevice(
+        device_name='test', system_code='10100', device_code='C'
+    )
+    svc = RC433Switch(pin=4, backend=backend)
+    assert svc.switch(device=device, state='on')
+    assert backend.pins == [4]
+    assert len(backend.transmissions) == 1
+    frame_length = 16 * 8 * RC433Switch.PULSE_LENGTH
+    assert backend.airtime == RC433Switch.REPEAT * frame_length
+
+    pulses = backend.transmissions[0]
+    assert all(pin == 4 for pin, _, _ in pulses)
+    levels = np.array([level for _, level, _ in pulses])
+    assert np.all(levels[1:] != levels[:-1])
+
+    ts = np.cumsum([0] + [duration for _, _, duration in pulses])
+    words, _, _, _ = decode_pulses(ts, np.append(levels, 1))
+    assert len(words) == RC433Switch.REPEAT
+    assert {system_command(w) for w in words} == {('10100', 'C', 'on')}
+
+
+class FakePigpio(object):
+    OUTPUT = 1
+
+    def __init__(self):
+        self.connections = []
+
+    def pi(self, host):
+        self.connections.append(host)
+        return FakePi()
+
+    @staticmethod
+    def pulse(on, off, duration):
+        return on, off, duration
+
+
+class FakePi(object):
+    connected = True
+
+    def __getattr__(self, name):
+        return lambda *args: 0
+
+
+def test_pigpio_backends_share_one_connection(monkeypatch):
+    fake = FakePigpio()
+    monkeypatch.setattr(backends, 'pigpio', fake)
+    monkeypatch.setattr(backends, '_connections', dict())
+    device = SystemDevice(
+        device_name='test', system_code='10100', device_code='C'
+    )
+    for _ in range(3):
+        svc = RC433Switch(pin=4, backend=PigpioBackend(host='pi'))
+        assert svc.switch(device=device, state='on')
+        del svc
+    assert fake.connections == ['pi']
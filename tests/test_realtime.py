@@ -0,0 +1,59 @@
+import gc
+import os
+
+import pytest
+
+from app import realtime
+from app.device import SystemDevice
+from app.realtime import RealtimeGuard, burst
+from app.simulator import Simulator
+
+
+@pytest.fixture
+def guard():
+    guard = RealtimeGuard(cpu=min(os.sched_getaffinity(0)))
+    realtime.install(guard)
+    yield guard
+    realtime.install(None)
+
+
+def test_burst_disables_gc_and_restores_affinity(guard):
+    affinity = os.sched_getaffinity(0)
+    assert gc.isenabled()
+    with burst(0.):
+        assert not gc.isenabled()
+        assert os.sched_getaffinity(0) == {guard.cpu}
+        with burst():
+            pass
+        assert not gc.isenabled()
+    assert gc.isenabled()
+    assert os.sched_getaffinity(0) == affinity
+    stats = guard.stats()
+    assert stats['bursts'] == 2
+    assert stats['affinity'] is True
+    assert stats['overrun_max'] >= 0
+
+
+def test_unprivileged_settings_are_skipped(guard, monkeypatch):
+    def not_permitted(*args):
+        raise PermissionError(1, 'Operation not permitted')
+
+    monkeypatch.setattr(os, 'sched_setscheduler', not_permitted)
+    guard.priority = 50
+    with burst():
+        assert not gc.isenabled()
+    with burst():
+        pass
+    assert guard.capabilities['fifo'] is False
+    assert guard.counters['bursts'] == 2
+    assert gc.isenabled()
+
+
+def test_transmissions_run_in_bursts(guard):
+    device = SystemDevice(
+        device_name='test', system_code='10100', device_code='C'
+    )
+    report = Simulator().switch(device, 'on')
+    assert report['frames'] == 10
+    assert guard.counters['bursts'] == 1
+    assert len(guard.overruns) == 1
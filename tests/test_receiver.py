@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+
+from app.device import DeviceDict, DeviceRegistry, MemoryState
+from app.receiver import (DeviceLearner, RC433Receiver, decode_pulses,
+                          encode_word, load_capture, save_capture,
+                          system_command, system_word)
+
+
+def _registry():
+    return DeviceRegistry(DeviceDict({
+        'code': {'code_on': 1361, 'code_off': 1364},
+        'system': {'system_code': '10100', 'device_code': 'B'}
+    }), MemoryState())
+
+
+def _frames(words, pulse_length=300, repeat=1):
+    ts, levels, start = [], [], 0.
+    for word in words:
+        for _ in range(repeat):
+            t, lv = encode_word(word, pulse_length=pulse_length, start=start)
+            ts.append(t[:-1])
+            levels.append(lv[:-1])
+            start = t[-1]
+    return np.concatenate(ts + [[start]]), np.concatenate(levels + [[1]])
+
+
+def test_decode_frames_with_jitter():
+    words = [0, 0xFFFFFF, 1361, system_word('01000', 'E', 'off')]
+    ts, levels = _frames(words, pulse_length=350)
+    jitter = np.random.RandomState(0).uniform(-30, 30, len(ts))
+    decoded, _, pulse_lengths, rest = decode_pulses(ts + jitter, levels)
+    assert decoded.tolist() == words
+    assert np.allclose(pulse_lengths, 350, rtol=0.05)
+    assert rest == len(ts) - 1
+
+
+def test_system_command_roundtrip():
+    for code in ('A', 'C', 'E'):
+        for state in ('on', 'off'):
+            word = system_word('11000', code, state)
+            assert system_command(word) == ('11000', code, state)
+    assert system_command(0xFFFFFF) is None
+
+
+def test_receiver_updates_state_in_chunks():
+    registry = _registry()
+    received = []
+    rx = RC433Receiver(
+        registry, on_state=lambda d, s: received.append((d.device_name, s))
+    )
+    ts, levels = _frames(
+        [1361, system_word('10100', 'B', 'on')], repeat=3
+    )
+    # split the edges in the middle of a frame
+    rx.feed(ts[:70], levels[:70])
+    rx.feed(ts[70:], levels[70:])
+    assert received == [('code', 'on'), ('system', 'on')]
+    assert registry.lookup('system').state
+
+
+def test_learn_unknown_codes(tmpdir):
+    devices = tmpdir.join('devices.json')
+    devices.write(json.dumps({'code': {'code_on': 1361, 'code_off': 1364}}))
+    registry = DeviceRegistry(DeviceDict.from_json(str(devices)),
+                              MemoryState())
+    rx = RC433Receiver(registry, learner=DeviceLearner(str(devices)))
+    capture = str(tmpdir.join('capture.txt'))
+    save_capture(capture, *_frames(
+        [4001, 4004, system_word('00001', 'D', 'on')], repeat=2
+    ))
+    rx.feed(*load_capture(capture))
+
+    learned = json.loads(devices.read())
+    assert learned['learned_4001'] == {'code_on': 4001, 'code_off': 4004}
+    assert learned['learned_00001_D'] == {
+        'system_code': '00001', 'device_code': 'D'
+    }
+    assert rx.lookup(4004)[1] == 'off'
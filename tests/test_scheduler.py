@@ -0,0 +1,164 @@
+import json
+import random
+import time
+
+import paho.mqtt.client as mqtt
+
+from app.scheduler import Scheduler, next_daily
+
+TOPICS = [
+    'rc433/groundfloor/gf_lamp/switch',
+    'rc433/secondfloor/sf_bedroom_bed/switch'
+]
+
+
+class FakeClock(object):
+    def __init__(self, now=1000000.):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeGateway(object):
+    def __init__(self):
+        self.commands = []
+
+    def dispatch(self, topic, payload, received=None):
+        self.commands.append((topic, payload))
+        return True
+
+
+def _scheduler(**kwargs):
+    return Scheduler(FakeGateway().dispatch, TOPICS, clock=FakeClock(),
+                     **kwargs)
+
+
+def _message(payload):
+    message = mqtt.MQTTMessage(topic=b'rc433/$schedule/set')
+    message.payload = json.dumps(payload).encode('utf-8')
+    return message
+
+
+def test_jobs_fire_in_order_of_due_time():
+    scheduler = _scheduler()
+    dues = list(range(1000))
+    random.Random(7).shuffle(dues)
+    for due in dues:
+        scheduler.add('gf_lamp', 'on' if due % 2 else 'off', delay=due,
+                      job_id=str(due))
+    for due in range(0, 1000, 3):
+        assert scheduler.cancel(str(due))
+    assert not scheduler.cancel('0')
+
+    scheduler.clock.now += 999
+    assert scheduler.run_pending() == 666
+    commands = scheduler.dispatch.__self__.commands
+    assert [state for _, state in commands[:4]] == ['on', 'off', 'off', 'on']
+    assert scheduler.stats()['pending'] == 0
+    assert scheduler.run_pending() == 0
+
+
+def test_recurring_jobs_skip_missed_occurrences():
+    scheduler = _scheduler()
+    job = scheduler.add('sf_bedroom_bed', 'off', every=60, job_id='bed')
+    assert job.due == scheduler.clock.now + 60
+    scheduler._dirty = False
+    scheduler.clock.now += 60 * 10 + 5
+    assert scheduler.run_pending() == 1
+    assert job.due == scheduler.clock.now + 55
+    assert job.fired == 1 and scheduler.pending() == [job]
+    # Firing a recurring job does not rewrite the saved jobs
+    assert not scheduler._dirty
+
+    now = time.time()
+    assert now < next_daily('18:00', now) <= now + 24 * 3600
+
+
+def test_replacing_a_job_compacts_the_heap():
+    scheduler = _scheduler()
+    for i in range(10000):
+        scheduler.add('gf_lamp', 'on', delay=i, job_id='lamp')
+    assert len(scheduler.jobs) == 1
+    assert len(scheduler._heap) <= 2 * len(scheduler.jobs) + 65
+
+
+def test_jobs_of_devices_owned_by_other_nodes_are_skipped():
+    scheduler = _scheduler(owns=lambda device: device == 'gf_lamp')
+    scheduler.add('gf_lamp', 'on', delay=1)
+    scheduler.add('sf_bedroom_bed', 'off', delay=1)
+    scheduler.clock.now += 1
+    assert scheduler.run_pending() == 2
+    assert scheduler.dispatch.__self__.commands == [(TOPICS[0], 'on')]
+    assert scheduler.counters['not_owned'] == 1
+    assert scheduler.counters['fired'] == 1
+
+
+def test_handle_control_sets_and_cancels_jobs():
+    scheduler = _scheduler()
+    scheduler.handle_control(None, None, _message({
+        'id': 'bed-off', 'device': 'sf_bedroom_bed', 'state': 'OFF',
+        'delay': 1800
+    }))
+    scheduler.handle_control(None, None, _message({
+        'id': 'evening', 'topic': 'rc433/groundfloor/gf_lamp/switch',
+        'state': 'on', 'daily': '18:00'
+    }))
+    for invalid in ({'device': 'gf_none', 'state': 'on', 'delay': 1},
+                    {'device': 'gf_lamp', 'state': 'dim', 'delay': 1},
+                    {'device': 'gf_lamp', 'state': 'on'},
+                    {'device': 'gf_lamp', 'state': 'on', 'daily': '25:00'},
+                    {'device': 'gf_lamp', 'state': 'on', 'at': 'nan'},
+                    {'device': 'gf_lamp', 'state': 'on', 'at': 'inf'},
+                    {'device': 'gf_lamp', 'state': 'on', 'every': 'inf'}):
+        scheduler.handle_control(None, None, _message(invalid))
+    assert scheduler.counters['invalid'] == 7
+    assert {job.id for job in scheduler.pending()} == {'bed-off', 'evening'}
+    assert scheduler.jobs['bed-off'].state == 'off'
+
+    scheduler.handle_control(None, None, _message({'cancel': 'bed-off'}))
+    assert list(scheduler.jobs) == ['evening']
+
+
+def test_jobs_persist_across_restarts(tmp_path):
+    path = str(tmp_path / 'jobs.json')
+    scheduler = _scheduler(path=path, grace=30)
+    scheduler.add('gf_lamp', 'on', delay=10, job_id='soon')
+    scheduler.add('gf_lamp', 'off', delay=100, job_id='later')
+    scheduler.add('sf_bedroom_bed', 'off', every=60, job_id='bed')
+    scheduler.save()
+
+    restarted = _scheduler(path=path, grace=30)
+    restarted.clock.now += 80
+    assert restarted.load() == 2
+    assert restarted.counters['missed'] == 1
+    assert restarted.jobs['later'].due == scheduler.jobs['later'].due
+    assert restarted.jobs['bed'].due == restarted.clock.now + 40
+    restarted.clock.now += 40
+    assert restarted.run_pending() == 2
+    restarted.save()
+
+    # A recurring job keeps its schedule from an older saved due time
+    again = _scheduler(path=path, grace=30)
+    again.clock.now += 80 + 40 + 30
+    assert again.load() == 1
+    assert again.jobs['bed'].due == again.clock.now + 30
+
+
+def test_worker_fires_with_subsecond_accuracy(tmp_path):
+    gateway = FakeGateway()
+    scheduler = Scheduler(gateway.dispatch, TOPICS,
+                          path=str(tmp_path / 'jobs.json'))
+    scheduler.start()
+    try:
+        scheduler.add('gf_lamp', 'on', delay=0.05)
+        scheduler.add('gf_lamp', 'off', delay=0.1)
+        end = time.monotonic() + 5
+        while len(gateway.commands) < 2 and time.monotonic() < end:
+            time.sleep(0.005)
+    finally:
+        scheduler.stop()
+    assert [state for _, state in gateway.commands] == ['on', 'off']
+    assert scheduler.stats()['late_max'] < 0.5
+    with open(str(tmp_path / 'jobs.json')) as fp:
+        assert json.load(fp) == []
@@ -0,0 +1,68 @@
+import pytest
+
+from app.device import CodeDevice, SystemDevice
+from app.rc433 import RC433Code, RC433Switch
+from app.receiver import system_command
+from app.simulator import Simulator
+
+
+def test_records_and_decodes_system_device_frames():
+    sim = Simulator()
+    device = SystemDevice(
+        device_name='test', system_code='10100', device_code='C'
+    )
+    report = sim.switch(device, 'off')
+    assert report['frames'] == RC433Switch.REPEAT
+    assert {system_command(w) for w in report['words']} == {
+        ('10100', 'C', 'off')
+    }
+    assert report['on_air'] == pytest.approx(
+        RC433Switch(backend=sim.backend()).airtime(device)
+    )
+    assert report['overrun'] == pytest.approx(0)
+    assert report['deviation_max'] == pytest.approx(0)
+
+
+@pytest.mark.parametrize('state, code', [('on', 1361), ('OFF', 1364)])
+def test_code_device_sends_code_of_state(state, code):
+    sim = Simulator()
+    device = CodeDevice(device_name='test', code_on=1361, code_off=1364)
+    report = sim.switch(device, state)
+    assert report['tx_calls'] == RC433Code.REPEAT
+    assert report['frames'] == RC433Code.REPEAT * RC433Code.TX_REPEAT
+    assert set(report['words']) == {code}
+    assert report['on_air'] == pytest.approx(
+        RC433Code().airtime(device)
+    )
+    assert report['deviation_max'] == pytest.approx(0)
+
+
+def test_reports_timing_deviations():
+    sim = Simulator()
+    # 20% too long pulses of a system code frame
+    device = SystemDevice(
+        device_name='test', system_code='11111', device_code='A'
+    )
+    svc = sim.service(device, pin=4)
+    with sim.command('slow', pulse_length=300):
+        svc.backend.sleep = lambda s: sim.clock.sleep(s * 1.2)
+        svc.switch(device=device, state='on')
+    report = sim.report()[-1]
+    assert report['frames'] == RC433Switch.REPEAT
+    assert report['overrun'] == pytest.approx(0.2 * report['nominal'])
+    assert report['deviation_max'] == pytest.approx(0.2 * 31 * 300)
+
+
+def test_services_only_reset_their_own_pins():
+    sim = Simulator()
+    # e.g. the pin of a second transmitter
+    sim.gpio.setup(27, sim.gpio.OUT)
+    system = SystemDevice(
+        device_name='test', system_code='10100', device_code='C'
+    )
+    code = CodeDevice(device_name='test', code_on=1361, code_off=1364)
+    for device, pin in ((system, 4), (code, 17)):
+        svc = sim.service(device, pin=pin)
+        svc.switch(device=device, state='on')
+        del svc
+    assert sim.gpio.outputs == {27}
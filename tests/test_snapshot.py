@@ -0,0 +1,108 @@
+import json
+import time
+
+from app.snapshot import DELTA_TOPIC, SNAPSHOT_TOPIC, StateAggregator
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, json.loads(payload), retain))
+
+
+def test_flush_publishes_coalesced_delta_and_snapshot():
+    aggregator = StateAggregator(FakePublisher(), epoch=1)
+    aggregator.update('gf_lamp', 'ON')
+    aggregator.update('ff_tree', 'on')
+    aggregator.update('gf_lamp', 'off')
+    assert aggregator.flush() == 1
+    assert aggregator.publisher.published == [
+        (DELTA_TOPIC, {'epoch': 1, 'seq': 1,
+                       'states': {'gf_lamp': 'off', 'ff_tree': 'on'}}, False),
+        (SNAPSHOT_TOPIC, {'epoch': 1, 'seq': 1,
+                          'states': {'gf_lamp': 'off', 'ff_tree': 'on'}}, True)
+    ]
+    assert aggregator.counters['coalesced'] == 1
+
+    aggregator.update('ff_tree', 'on')
+    assert aggregator.flush() is None
+    assert aggregator.counters['unchanged'] == 1
+    aggregator.update('gf_lamp', 'on')
+    assert aggregator.flush() == 2
+    delta, snapshot = aggregator.publisher.published[2:]
+    assert delta[1]['states'] == {'gf_lamp': 'on'}
+    assert snapshot[1] == {
+        'epoch': 1, 'seq': 2, 'states': {'gf_lamp': 'on', 'ff_tree': 'on'}
+    }
+
+
+def test_worker_publishes_after_window():
+    aggregator = StateAggregator(FakePublisher(), window=0.05)
+    aggregator.start()
+    aggregator.update('gf_lamp', 'on')
+    aggregator.update('ff_tree', 'on')
+    end = time.monotonic() + 2
+    while not aggregator.publisher.published and time.monotonic() < end:
+        time.sleep(0.005)
+    aggregator.update('gf_lamp', 'off')
+    aggregator.stop()
+    topics = [topic for topic, _, _ in aggregator.publisher.published]
+    assert topics == [DELTA_TOPIC, SNAPSHOT_TOPIC] * 2
+    assert aggregator.publisher.published[0][1]['states'] == {
+        'gf_lamp': 'on', 'ff_tree': 'on'
+    }
+    assert aggregator.seq == 2
+
+
+class FakeSubscriber(object):
+    def __init__(self):
+        self.callbacks = {}
+
+    def add_callback(self, topic, callback, qos=0):
+        self.callbacks[topic] = callback
+
+
+class FakeMessage(object):
+    def __init__(self, payload):
+        self.payload = json.dumps(payload).encode('utf-8')
+
+
+def test_snapshot_is_seeded_from_the_previous_run():
+    aggregator = StateAggregator(FakePublisher(), epoch=2)
+    subscriber = FakeSubscriber()
+    aggregator.seed(subscriber)
+    aggregator.update('gf_lamp', 'on')
+    assert aggregator.flush() == 1
+    # Only the delta until the previous snapshot is known
+    assert [p[0] for p in aggregator.publisher.published] == [DELTA_TOPIC]
+
+    subscriber.callbacks[SNAPSHOT_TOPIC](None, None, FakeMessage({
+        'epoch': 1, 'seq': 9, 'states': {'gf_lamp': 'off', 'ff_tree': 'on'}
+    }))
+    assert aggregator.publisher.published[-1] == (
+        SNAPSHOT_TOPIC, {'epoch': 2, 'seq': 1,
+                         'states': {'gf_lamp': 'on', 'ff_tree': 'on'}}, True
+    )
+    # Later snapshots are our own
+    subscriber.callbacks[SNAPSHOT_TOPIC](None, None, FakeMessage({
+        'epoch': 2, 'seq': 1, 'states': {'sf_bed': 'on'}
+    }))
+    assert 'sf_bed' not in aggregator.states
+
+
+def test_snapshot_is_published_after_the_seed_timeout():
+    aggregator = StateAggregator(FakePublisher(), window=0.01,
+                                 seed_timeout=0.1)
+    aggregator.seed(FakeSubscriber())
+    aggregator.start()
+    aggregator.update('gf_lamp', 'on')
+    end = time.monotonic() + 5
+    while len(aggregator.publisher.published) < 2 and \
+            time.monotonic() < end:
+        time.sleep(0.01)
+    aggregator.stop()
+    assert [p[0] for p in aggregator.publisher.published] == [
+        DELTA_TOPIC, SNAPSHOT_TOPIC
+    ]
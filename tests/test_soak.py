@@ -0,0 +1,67 @@
+import os
+import random
+
+from app.broker import QueuedMQTTPublisher
+from app.device import DeviceDict, DeviceRegistry, MemoryState
+from app.ratelimit import AirtimeLimiter
+from app.soak import LoopbackClient, MemoryMonitor, SoakRunner
+
+TOPICS = [
+    'rc433/groundfloor/gf_kitchen_window/switch',
+    'rc433/firstfloor/ff_floor_tree/switch',
+    'rc433/secondfloor/sf_bedroom_bed/switch'
+]
+
+
+class LeakingClient(LoopbackClient):
+    def __init__(self):
+        super(LeakingClient, self).__init__()
+        self.history = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.history.append((topic, payload, bytearray(256)))
+        return super(LeakingClient, self).publish(topic, payload, qos, retain)
+
+
+def _runner(client, max_memory_growth):
+    registry = DeviceRegistry(
+        DeviceDict.from_json(
+            os.path.join(os.path.dirname(__file__), '../conf/devices.json')
+        ),
+        MemoryState()
+    )
+    mqp = QueuedMQTTPublisher.from_json(
+        {'host': 'localhost', 'port': 1883, 'topics': {}}
+    )
+    mqp.client = client
+    mqp.start()
+    return SoakRunner(
+        registry, TOPICS, mqp,
+        limiter=AirtimeLimiter(policy='reject'),
+        monitor=MemoryMonitor(max_memory_growth=max_memory_growth),
+        invalid=0.1, rng=random.Random(7)
+    )
+
+
+def test_soak_run_passes_without_leaks():
+    runner = _runner(LoopbackClient(), max_memory_growth=1048576)
+    res = runner.run(900, sample_interval=300, warmup=300)
+    runner.publisher.stop()
+    assert res['passed'], res
+    assert res['samples'] >= 3
+    assert res['messages'] > 100
+    assert 0 < res['switched'] < res['messages']
+    assert res['fd_growth'] == 0
+    # States of a device still queued are collapsed
+    published = runner.publisher.client.published
+    assert published + runner.publisher.counters['collapsed'] == \
+        res['switched']
+
+
+def test_soak_run_detects_growth():
+    runner = _runner(LeakingClient(), max_memory_growth=32768)
+    res = runner.run(900, sample_interval=300, warmup=300)
+    runner.publisher.stop()
+    assert not res['passed']
+    assert res['memory_growth'] > 32768
+    assert any('test_soak.py' in line for line in res['top_allocations'])
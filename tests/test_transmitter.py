@@ -0,0 +1,106 @@
+import os
+import signal
+import time
+
+from app.backend import ProcessBackend
+from app.device import SystemDevice
+from app.rc433 import RC433Switch
+from app.transmitter import RingBuffer, TransmitterProcess, decode_pulses, \
+    encode_pulses
+
+
+def test_ring_buffer_wraps_around():
+    ring = RingBuffer.create(64)
+    try:
+        for i in range(50):
+            data = bytes([i]) * (i % 20)
+            assert ring.put(data)
+            assert ring.get() == data
+        assert ring.get() is None
+    finally:
+        ring.close()
+
+    ring = RingBuffer.create(64)
+    try:
+        assert ring.put(b'x' * 24) and ring.put(b'y' * 24)
+        assert not ring.put(b'z')
+        assert RingBuffer.attach(ring.name).get() == b'x' * 24
+        assert len(ring) == 32
+    finally:
+        ring.close()
+
+
+def test_pulses_are_packed():
+    pulses = [(17, 0, 0), (17, 1, 300), (4, 0, 9300)]
+    assert decode_pulses(encode_pulses(7, pulses, 12.5)) == (7, 12.5, pulses)
+
+
+def _wait(predicate, timeout=5.):
+    end = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < end:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_child_transmits_and_is_restarted():
+    transmitter = TransmitterProcess(backend='gpio', restart_delay=0.05)
+    transmitter.start()
+    try:
+        device = SystemDevice(
+            device_name='test', system_code='10100', device_code='C'
+        )
+        svc = RC433Switch(pin=4, backend=ProcessBackend(transmitter))
+        assert svc.switch(device=device, state='on')
+        assert transmitter.counters['transmitted'] == 1
+        assert transmitter.stats()['overrun_max'] >= 0
+
+        pid = transmitter.process.pid
+        os.kill(pid, signal.SIGKILL)
+        assert _wait(lambda: transmitter.process.pid != pid)
+        assert transmitter.counters['restarts'] == 1
+        assert transmitter.transmit([(4, 1, 300), (4, 0, 900)])
+    finally:
+        transmitter.stop()
+    assert not transmitter.process.is_alive()
+    assert not transmitter.transmit([(4, 1, 300)])
+
+
+def test_transmit_and_stop_while_child_restarts():
+    transmitter = TransmitterProcess(backend='gpio', restart_delay=30.)
+    transmitter.start()
+    os.kill(transmitter.process.pid, signal.SIGKILL)
+    assert _wait(lambda: transmitter.counters['restarts'] == 1)
+    assert not transmitter.transmit([(4, 1, 300)])
+    assert transmitter.counters['unavailable'] == 1
+    transmitter.stop(timeout=1.)
+    assert not transmitter.running
+
+
+def test_child_skips_requests_timed_out_in_parent():
+    transmitter = TransmitterProcess(backend='gpio', timeout=0.1)
+    transmitter.start()
+    try:
+        pid = transmitter.process.pid
+        os.kill(pid, signal.SIGSTOP)
+        assert not transmitter.transmit([(4, 1, 300)])
+        os.kill(pid, signal.SIGCONT)
+        assert _wait(lambda: transmitter.counters['skipped'] == 1)
+        assert transmitter.counters['transmitted'] == 0
+        assert transmitter.transmit([(4, 1, 300)])
+    finally:
+        transmitter.stop()
+
+
+def test_hung_child_is_restarted():
+    transmitter = TransmitterProcess(backend='gpio', hang_timeout=0.2,
+                                     restart_delay=0.05, timeout=0.1)
+    transmitter.start()
+    try:
+        pid = transmitter.process.pid
+        os.kill(pid, signal.SIGSTOP)
+        assert not transmitter.transmit([(4, 1, 300)])
+        assert transmitter.counters['timeouts'] == 1
+        assert _wait(lambda: transmitter.process.pid != pid)
+        assert transmitter.transmit([(4, 1, 300)])
+    finally:
+        transmitter.stop()
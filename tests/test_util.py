@@ -0,0 +1,90 @@
+import logging
+import time
+
+from app.backend import RecordingBackend
+from app.device import SystemDevice
+from app.rc433 import RC433Switch
+from app.util import LogMixin, queue_logging
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        time.sleep(0.01)
+        self.messages.append(self.format(record))
+
+
+class CountingStr(object):
+    calls = 0
+
+    def __str__(self):
+        CountingStr.calls += 1
+        return 'counted'
+
+
+def test_logger_is_cached():
+    class Dummy(LogMixin):
+        pass
+
+    assert Dummy().logger is Dummy().logger
+    assert Dummy().logger.name == 'Dummy'
+
+
+def test_queue_logging_does_not_block_on_slow_handlers():
+    logger = logging.getLogger('test_queue_logging')
+    logger.propagate = False
+    slow = SlowHandler()
+    logger.addHandler(slow)
+    logger.setLevel(logging.INFO)
+    handler = queue_logging(budget_us=1000., logger=logger)
+
+    start = time.perf_counter()
+    for i in range(20):
+        logger.info("message %s", i)
+    assert time.perf_counter() - start < 0.1
+
+    handler.close()
+    assert slow.messages[-1] == 'message 19'
+    stats = handler.stats()
+    assert stats['records'] == 20
+    assert stats['dropped'] == 0
+    assert stats['within_budget']
+
+
+def test_queue_logging_drops_when_full():
+    logger = logging.getLogger('test_queue_logging_full')
+    logger.propagate = False
+    logger.addHandler(SlowHandler())
+    handler = queue_logging(maxsize=1, logger=logger)
+    for i in range(10):
+        logger.warning("message %s", i)
+    handler.close()
+    assert handler.stats()['dropped'] > 0
+
+
+def test_queue_logging_merges_args_in_the_caller():
+    logger = logging.getLogger('test_queue_logging_args')
+    logger.propagate = False
+    slow = SlowHandler()
+    logger.addHandler(slow)
+    handler = queue_logging(logger=logger)
+    states = ['on']
+    # keeps the listener busy while the args change
+    logger.warning("first")
+    logger.warning("states %s", states)
+    states.append('off')
+    handler.close()
+    assert slow.messages == ['first', "states ['on']"]
+
+
+def test_debug_messages_are_formatted_lazily():
+    logging.getLogger('RC433Switch').setLevel(logging.INFO)
+    device = SystemDevice(
+        device_name='test', system_code='00001', device_code='A'
+    )
+    device.device_name = CountingStr()
+    RC433Switch(backend=RecordingBackend()).switch(device, 'on')
+    assert CountingStr.calls == 0